@@ -31,14 +31,8 @@ import time
 #import csv # probably not needed once download processes zip
 import pandas as pd
 import numpy as np
-import tensorflow as tf
 from numpy import savetxt
 #from tabulate import tabulate # for verbose tables, showing data
-from tensorflow.keras.utils import to_categorical # for one-hot encoding
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
-import matplotlib.pyplot as plt # for plotting - pandas uses matplotlib
 from time import gmtime, strftime, localtime #for displaying Linux UTC timestamps in hh:mm:ss
 from datetime import datetime, date, timedelta
 import urllib.request # to get files from web w/o !wget
@@ -80,8 +74,8 @@ verbose = True
 
 # dataset parameters
 all_channel_list = [] # this will get populated from the IR1 dataframe column names
-xform.time_steps = 500 # IR1 dataframes are set to 100Hz
-xform.stride = 500 # how far to move for next window, if = times_steps no overlap
+window_cfg = dict(time_steps = 500, # IR1 dataframes are set to 100Hz
+                  stride = 500) # how far to move for next window, if = times_steps no overlap
 # The label_map_<dataset> contains a mapping from strings to ints for all
 # possible labels in the entire dataset.   This allows for predictable conversion
 # regardless of the slices. The embedding of "label" is to allow for a common
@@ -146,21 +140,24 @@ Much appreciation to Vangelis Metsis and Alex Katrompas for the [initial loader]
 
 """
 
-# Assign labels to each frame in the time synchronization data
-def assign_label(frame_number, offset): # original
-    for _, row in df_labels.iterrows():
-        if row['start_frame'] <= frame_number - (offset - 1) <= row['end_frame']:
-            return row['label']
-    return 'unknown'
-
 # Function to process the IMU data file
-def process_data_file(file_path, archive):
+# channels are the IR1 column names e.g. '2794_Accel_X', None = all columns.
+# Returns df = None if none of the channels come from this sensor.
+def process_data_file(file_path, archive, channels = None):
     with archive.open(file_path) as f:
         # Get the sensor_ID from the first line of the file, e.g. "sensor_ID	2794"
         sensor_id = f.readline().decode('utf-8').split('\t')[1].strip()
+        if channels is None:
+            usecols = None
+        elif any(ch.startswith(f'{sensor_id}_') for ch in channels):
+            # only parse the requested columns plus the time and count
+            usecols = lambda col: (col in ('Count', 'SysTime')
+                                   or f'{sensor_id}_{col}' in channels)
+        else:
+            return None, sensor_id
 
         # Read the rest of the file into a Pandas DataFrame
-        df = pd.read_csv(f, delim_whitespace=True)
+        df = pd.read_csv(f, delim_whitespace=True, usecols=usecols)
 
     # Check if 'Count' column contains any string values
     if df['Count'].apply(lambda x: isinstance(x, str)).any():
@@ -237,9 +234,7 @@ if interactive:
     print()
 
 #for key in subjects:
-df_labels = pd.DataFrame() # workaround so df_labels is avail for assign_labels
-def get_cmu_imu_df(sub_key = 'S07'):
-    global df_labels # same workaround from two lines up
+def get_cmu_imu_df(sub_key = 'S07', channels = None):
     subject_id = sub_key
     subject_starting_frame = subjects[sub_key]
     if verbose:
@@ -302,9 +297,13 @@ def get_cmu_imu_df(sub_key = 'S07'):
         print('df_labels.tail()')
         display(df_labels.tail())
 
-    #this call fails after conversion to function - name 'df_labels' is not defined
-    #workaround above was to declare a global, see first lines of this cell
-    df_time_sync['label'] = df_time_sync['frame_number'].apply(assign_label, offset=subject_starting_frame)
+    # Assign labels to each frame in the time synchronization data, frames
+    # outside the annotations are 'unknown', the first matching row wins
+    frames = df_time_sync['frame_number'].to_numpy() - (subject_starting_frame - 1)
+    df_time_sync['label'] = xform.get_interval_labels(frames, df_labels,
+                                                      start_col = 'start_frame', stop_col = 'end_frame',
+                                                      label_cols = ['label'], fill_values = ['unknown'],
+                                                      overlap = 'first')['label']
 
     # Convert the system_time column to a datetime object
     df_time_sync['system_time'] = df_time_sync['system_time'].str.replace('_', ':')
@@ -330,7 +329,11 @@ def get_cmu_imu_df(sub_key = 'S07'):
         for file_path in file_paths:
             if verbose:
                 print(f'Processing {file_path}...')
-            df_temp, sensor_id = process_data_file(file_path, archive)
+            df_temp, sensor_id = process_data_file(file_path, archive, channels)
+            if df_temp is None:
+                if verbose:
+                    print(f'Skipping sensor {sensor_id}, no requested channels')
+                continue
             df_main = merge_dataframes(df_main, df_temp)
 
     # This is the start of additional code Lee added.
@@ -408,7 +411,9 @@ if interactive:
     #df_all.iloc[0:17*30].plot(subplots=True, figsize=(20, 10)) # only 1st 17 secs
     df_all.plot(subplots=True, figsize=(20, 10))
 
-def get_cmu_mocap_ir1_dict(incl_frame_num = False):
+ir1_cache_version = '1' # change when the IR1 code above changes, see xform.get_cached_ir1
+
+def get_cmu_mocap_ir1_dict(incl_frame_num = False, channels = None):
     """reads the CMU Motion Cap dataset brownie files and converts to an IR1
     dataframe.  The goal here is to capture and convert all raw data into
     a 2D dataframe of rows = datetime index of each sample, columns = {channels,
@@ -416,14 +421,23 @@ def get_cmu_mocap_ir1_dict(incl_frame_num = False):
     and convert the string labels to mapped ints prior to switch to ndarrays.
     Args:
         incl_frame_num - boolean, default = False, True enables faster plotting
+        channels - list of IR1 channel names e.g. ['2794_Accel_X'], only these
+            columns are parsed from the IMU files, None = all channels
     Returns: 
         dict containing key = df_name and item = IR1 dataframe."""
     print("Building dictionary of IR1 dataframes, with downloads this takes ~15 minutes to run")
+    print("(seconds once the IR1s are in the cache, set xform.ir1_cache_dir to enable)")
     ir1_df_dict = dict() # an empty dictionary
     for key in subjects:
         ir1_fname = key+'_Brownie_3DMGX1'
         print('Processing',ir1_fname)
-        df = get_cmu_imu_df(sub_key = key)
+        # the video zip is only used for the frame time sync but is part of
+        # the key since it changes the IR1, it's only hashed once, see xform.get_file_hash
+        source_files = [f'{RPATH}brownie_imu_data/{key}_Brownie_Video.zip',
+                        f'{RPATH}brownie_imu_data/{key}_Brownie_3DMGX1.zip',
+                        f'{RPATH}brownie_imu_data/{key}_Brownie.zip']
+        df = xform.get_cached_ir1(ir1_fname, source_files, ir1_cache_version,
+                                  get_cmu_imu_df, key, channels)
         if not incl_frame_num:
             df.drop(['frame_number'], axis=1, inplace=True)
         ir1_df_dict[ir1_fname]=df
@@ -34,17 +34,15 @@ import shutil #https://docs.python.org/3/library/shutil.html
 from shutil import unpack_archive # to unzip
 #from shutil import make_archive # to create zip for storage
 import requests #for downloading zip file
-from scipy import io #for loadmat, matlab conversion
 import time
 import pandas as pd
 import numpy as np
 from numpy import savetxt
-import matplotlib.pyplot as plt # for plotting - pandas uses matplotlib
-from tabulate import tabulate # for verbose tables
-from tensorflow.keras.utils import to_categorical # for one-hot encoding
 import gc #trying to resolve crash on reshape method
 
 interactive = False # enables functions for exploring data and dataframes
+if interactive:
+    import matplotlib.pyplot as plt # only the example cells plot, import is slow
 
 #Helper functions especially useful in colab
 from requests import get
@@ -365,6 +363,7 @@ if interactive:
     print(np.asarray((unique_elements, counts_elements)))
 
 def plot_subjects():
+    import matplotlib.pyplot as plt
     uniques, s_num = np.unique(sub, return_inverse=True)
     print (uniques)
     plt.plot(s_num) 
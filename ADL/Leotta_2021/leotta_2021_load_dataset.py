@@ -39,11 +39,9 @@ import numpy as np
 import time
 from datetime import datetime, date # to timestamp log file
 # from tabulate import tabulate # for verbose tables, showing data
-import matplotlib.pyplot as plt
 # from tensorflow.keras.utils import to_categorical # for one-hot encoding
 # from sklearn.model_selection import train_test_split
 # from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
 
 """# Load shared transform (xforms) functions and utils from IMICS Public Repo
 
@@ -99,6 +97,9 @@ label_map_leotta = {"label":     {'OTHER':0,'RELAX':1,'KEYBOARD_WRITING':2,
 leotta_comp_accel = ['ankle_accel_x', 'ankle_accel_y', 'ankle_accel_z',
                      'hip_accel_x', 'hip_accel_y', 'hip_accel_z',
                      'wrist_accel_x', 'wrist_accel_y', 'wrist_accel_z']
+# every channel df_from_csv can produce, in IR1 column order
+leotta_channel_list = [loc + '_accel_' + axis for loc in ('ankle', 'hip', 'wrist')
+                       for axis in ('x', 'y', 'z', 'ttl')]
 
 # runs when saved as .py, skip cell if developing/debugging
 interactive = False 
@@ -134,11 +135,15 @@ if interactive:
 
 def df_from_csv (
     sub_num, # 1 - 8
-    sensor_loc): # ankle, hip, wrist
+    sensor_loc, # ankle, hip, wrist
+    channels = None): # None = all four accel channels
     """reads Leotta_2021 csv, returns df with accel x/y/z/ttl, label, sub_num
     args:
         sub_num (int) subject number from 1 to 8
         sensor_loc (string) sensor location ankle, hip, or wrist
+        channels (list) leotta_channel_list entries to keep, channels for
+            other locations are ignored.  Only the accelerometer columns
+            needed are parsed.
     returns:
         An IR1 format dataframe, note labels are int encoded as in the raw dataset"""
     fnameX = sensor_loc + '_X_0' + str(sub_num) +  '.csv'
@@ -147,9 +152,19 @@ def df_from_csv (
     ffnamey = os.path.join(dataset_dir, sensor_loc, fnamey)
     if verbose:
         print ('df_from_csv processing: ', ffnameX, ffnamey)
-    df = pd.read_csv(ffnameX)
-    if (sensor_loc == 'wrist'): # Centrepoint device has different header name
-        df.rename(columns={'Timestamp UTC': 'Timestamp'}, inplace=True)
+    loc_channels = [i for i in leotta_channel_list if i.startswith(sensor_loc + '_')]
+    if channels is not None:
+        channels = [i for i in channels if i in loc_channels]
+    source_channels, keep_channels = xforms.get_ir1_source_channels(
+        channels, loc_channels, {loc_channels[3] : loc_channels[:3]})
+    # the timestamp and labels are always needed for the join and label checks
+    raw_columns = dict(zip(loc_channels[:3], ['Accelerometer X','Accelerometer Y','Accelerometer Z']))
+    read_channels = [i for i in source_channels if i in raw_columns]
+    # Centrepoint device on the wrist has a different timestamp header name
+    time_column = 'Timestamp UTC' if (sensor_loc == 'wrist') else 'Timestamp'
+    # usecols skips temperature, gyro and magnetometer while parsing
+    df = pd.read_csv(ffnameX, usecols = [time_column] + [raw_columns[i] for i in read_channels])
+    df.rename(columns={time_column: 'Timestamp'}, inplace=True)
     # the imported Timestamp is an object - need to convert to DateTime
     # in order to set the index to DateTime format.  Enables resampling etc.
     # Leaving these here - helpful to debug if leveraging this code!
@@ -158,14 +173,13 @@ def df_from_csv (
         #print(df.info(verbose=True))  
     df['Timestamp'] = pd.to_datetime(df['Timestamp']) 
     df.set_index('Timestamp', drop = True, inplace = True)
-    if (sensor_loc != 'wrist'): # Centrepoint doesn't have non-accel columnns
-        df = df.drop(['Temperature','Gyroscope X','Gyroscope Y','Gyroscope Z',
-                      'Magnetometer X','Magnetometer Y','Magnetometer Z'], axis=1)
-    df_sqd = df.pow(2)[['Accelerometer X','Accelerometer Y','Accelerometer Z']] #square each accel
-    df_sum = df_sqd.sum(axis=1) #add sum of squares, new 1 col df
-    df.loc[:,'accel_ttl'] = df_sum.pow(0.5)-1  # sqrt and remove 1g due to gravity
-    del df_sqd, df_sum
-    df.columns = [sensor_loc + '_accel_x', sensor_loc + '_accel_y', sensor_loc + '_accel_z', sensor_loc + '_accel_ttl']
+    df.columns = read_channels # usecols keeps the file order, which is x/y/z
+    if loc_channels[3] in keep_channels:
+        df_sqd = df.pow(2)[loc_channels[:3]] #square each accel
+        df_sum = df_sqd.sum(axis=1) #add sum of squares, new 1 col df
+        df.loc[:,loc_channels[3]] = df_sum.pow(0.5)-1  # sqrt and remove 1g due to gravity
+        del df_sqd, df_sum
+    df = df[keep_channels].copy() # drop axes only read to compute the ttl
     # tighten up the column types for space savings, probably should be function in utils or xforms
     # change to 32-bit, credit/ref https://stackoverflow.com/questions/69188132/how-to-convert-all-float64-columns-to-float32-in-pandas
     # Select columns with 'float64' dtype  
@@ -193,13 +207,14 @@ if interactive:
     display(df_hip.head())
     display(df_wrist.head())
 
-def df_from_one_sub (sub_num): # 1 - 8
-    """reads 3 csv files for a single subject, combines an returns a single dataframe"""
+def df_from_one_sub (sub_num, channels = None): # 1 - 8
+    """reads 3 csv files for a single subject, combines an returns a single dataframe
+    containing channels (None = all of leotta_channel_list)"""
     my_sub_num = sub_num # not sure necessary but easier to follow...
-    df_ankle = df_from_csv(sub_num = my_sub_num, sensor_loc = 'ankle')
-    df_hip = df_from_csv(sub_num = my_sub_num, sensor_loc = 'hip')
+    df_ankle = df_from_csv(sub_num = my_sub_num, sensor_loc = 'ankle', channels = channels)
+    df_hip = df_from_csv(sub_num = my_sub_num, sensor_loc = 'hip', channels = channels)
     #wrist is a bit more complicated since the sample rate is different
-    df_wrist = df_from_csv(sub_num = my_sub_num, sensor_loc = 'wrist')
+    df_wrist = df_from_csv(sub_num = my_sub_num, sensor_loc = 'wrist', channels = channels)
     df_wrist = xforms.to_fixed_ir1_timedelta(df_wrist,new_time_step='10ms')
 
     if ((df_ankle['label'].equals(df_hip['label']))
@@ -225,14 +240,21 @@ if interactive:
     print(df_temp.info(verbose=True))
     display(df_temp.head())
 
-def get_leotta_ir1_dict():
+ir1_cache_version = '2' # change when the IR1 code above changes, see xforms.get_cached_ir1
+
+def get_leotta_source_files(sub_num):
+    """Returns the raw csv files of one subject, the cache keys use them."""
+    return [os.path.join(dataset_dir, loc, loc + xy + str(sub_num) + '.csv')
+            for loc in ('ankle', 'hip', 'wrist') for xy in ('_X_0', '_Y_0')]
+
+def get_leotta_ir1_dict(channels = None):
     """reads the Leotta dataset and converts each "session file" to an IR1
     dataframe.  The goal here is to capture and convert all raw data into
     a 2D dataframe of rows = datetime index of each sample, columns = {channels,
     label(s), subject_num}.  Additional methods may be used to drop channels,
     and convert the string labels to mapped ints prior to switch to ndarrays.
     Args:
-        none 
+        channels = list of leotta_channel_list entries to read, None = all
     Returns: a dict containing key = df_name and item = IR1 dataframes."""
     unzip_leotta()
     ir1_df_dict = dict() # an empty dictionary
@@ -240,7 +262,8 @@ def get_leotta_ir1_dict():
         ir1_name = "Leotta_Sub" + str(i)
         if verbose:
             print('get_leotta_ir1_dict is processing subject number', i, "as", ir1_name)
-        df_temp = df_from_one_sub (sub_num = i)
+        df_temp = xforms.get_cached_ir1(ir1_name, get_leotta_source_files(i), ir1_cache_version,
+                                        df_from_one_sub, i, channels)
         ir1_df_dict[ir1_name]=df_temp # key is root name in the file
     return ir1_df_dict
 if interactive:
@@ -254,31 +277,6 @@ if interactive:
 
 """# Convert IR1 dataframes to IR2 numpy arrays"""
 
-# this should be moved to xforms once better tested.
-def one_hot_by_label_dict(y, label_map_in):
-    """One hot encode using dictionary so that the encoding is consistent
-    even if some classes are missing from the train set (happens especially
-    on X-fold Cross-Validation with sparse labels)
-    params:
-        y = numpy array with integer encoding
-        label_map_in = dict with 'label' entry containing all possible classes
-    returns:
-        y = one-hot encoded ndarray, # columns = # classes in dict entry."""
-    # ref: https://stackoverflow.com/questions/66644733/how-to-add-your-own-categories-into-the-onehotencoder
-    if verbose:
-        print("y shape into one_hot_by_label_dict is",y.shape)
-        print("length of label map", len(label_map_in['label']), "equals the max number of classes")
-        unique, counts = np.unique(y, return_counts=True)
-        print("y counts\n",np.asarray((unique, counts)).T)
-    #all_categories = np.array([str(i) for i in range(len(label_map['label']))])
-    all_categories = [[str(i) for i in range(len(label_map_in['label']))]]
-    enc = OneHotEncoder(categories = all_categories, sparse = False)
-    y_oh = enc.fit_transform(y)
-    y_oh = y_oh.astype('uint8')
-    if verbose:
-        print("Shape of returned array", y_oh.shape)
-    return y_oh
-
 # this should be moved to xforms once better tested and there should also be
 # a version for integer encoded labels
 def drop_ir2_one_hot_column(x, y, sub, ss_times, y_col_index = 0):
@@ -296,93 +294,89 @@ def drop_ir2_one_hot_column(x, y, sub, ss_times, y_col_index = 0):
     ss_times = ss_times[remove_index]
     return x, y, sub, ss_times
 
+def get_leotta_ir3(store_dir, label_method, window_cfg = None, channels = None):
+    """builds the IR3 for all subjects, called by xforms.get_cached_ir3 when
+    the IR3 is not in the cache.  Unlike get_ir3_from_dict windows with NaN
+    or unknown labels are kept.  Much of this was pulled from xforms
+    get_ir3_from_dict.  Only channels are read from the csv files.
+    Returns X, y, sub, ss_times, channel_list"""
+    ir1_dict = get_leotta_ir1_dict(channels)
+    ir2_views = []
+    for df_name, df in ir1_dict.items():
+        if verbose:
+            print("get_leotta_ir3 is processing",df_name)
+        df = xforms.assign_ints_ir1_labels(df,label_mapping_dict=label_map_leotta)
+        if (df['sub'].nunique() != 1):
+            print("WARNING: IR1", df_name, "contains multiple subjects")
+        ir2_views.append(xforms.get_ir2_view_from_ir1(df, label_method = label_method,
+                                                       window_cfg = window_cfg))
+    num_windows = sum([len(i) for i in ir2_views])
+    channel_list = ir2_views[0].channel_list
+    X = np.empty((num_windows, ir2_views[0].win_len, len(channel_list)), dtype = 'float32')
+    y = np.empty((num_windows, 1), dtype = 'int8')
+    sub = np.empty((num_windows, 1), dtype = 'int16')
+    ss_times = np.empty((num_windows, 2), dtype = 'datetime64[ns]')
+    start = 0
+    for ir2_view in ir2_views:
+        start = xforms.gather_ir2_view(ir2_view, X, y, sub, ss_times, start)
+    return X, y, sub, ss_times, channel_list
+
 def leotta_2021_load_dataset(
     incl_val_group = False, # split train into train and validate
     one_hot_encode = False, # make y into multi-column one-hot encoded
+    channels = None # leotta_channel_list entries, None = drop leotta_comp_accel
     ):
     """Loads the Leotta dataset zip from current directory, processes the data,
     and returns arrays by separating into _train, _validate, and _test arrays
-    for X and y based on split_sub dictionary."""
-    # dataset parameters, these are set as globals in the xforms code
-    xforms.time_steps = 300 # three seconds at 100Hz
-    xforms.stride = 300 # no overlap of the sliding windows
+    for X and y based on split_sub dictionary.  Set xforms.ir1_cache_dir and
+    xforms.ir3_cache_dir to cache the IR1 and IR3, both are off by default."""
+    # sliding window parameters, passed to xforms rather than set as globals
+    window_cfg = dict(time_steps = 300, # three seconds at 100Hz
+                      stride = 300) # no overlap of the sliding windows
     global log_info
     log_info = "Generated by leotta_2021_load_data.ipynb\n"
     today = date.today()
     log_info += today.strftime("%B %d, %Y") + "\n"
     log_info += "sub dict = " + str(subj_alloc_dict) + "\n"
-    # Iterate through the IR1s in the dictionary, determine train-vs-test
-    # then convert to IR2.  Much of this code was pulled from xform get_ir3_from_dict
-    # which was used by TWristAR and heavily modified here.  This seems pretty 
-    # close to being a generic version that could be put into transforms.
     label_map = label_map_leotta
-    ir1_dict = get_leotta_ir1_dict()
-
-    # Empty lists - it is better to make lists versus appending in the loop
-    x_train_list, y_train_list, sub_train_list, ss_times_train_list = ([] for i in range(4))
-    x_valid_list, y_valid_list, sub_valid_list, ss_times_valid_list = ([] for i in range(4))
-    x_test_list, y_test_list, sub_test_list, ss_times_test_list = ([] for i in range(4))
-    # iterate through the IR1 dataframes in the dictionary, process and allocate
-    # to the train/valid/test lists.
-    for df_name, df in ir1_dict.items():
-        if verbose:
-            print("leotta_2021_load_dataset is processing",df_name)
-        df = xforms.assign_ints_ir1_labels(df,label_mapping_dict=label_map)
-        df = xforms.drop_ir1_columns(df, drop_col_list = leotta_comp_accel)
-        if (df['sub'].nunique() != 1):
-            print("WARNING: IR1", df_name, "contains multiple subjects")
-        sub_num = df['sub'].mode()[0] # since only one column it is a series not df
-        x_temp, y_temp, sub_temp, ss_times_temp, ch_list_temp = xforms.get_ir2_from_ir1(df)
-        if sub_num in subj_alloc_dict['train_subj']:
-            if verbose:
-                print('Allocating Subject',sub_num, 'to train')
-            x_train_list.append(x_temp)
-            y_train_list.append(y_temp)
-            sub_train_list.append(sub_temp)
-            ss_times_train_list.append(ss_times_temp)
-        elif sub_num in subj_alloc_dict['valid_subj']:
-            if verbose:
-                print('Allocating Subject',sub_num, 'to valid')
-            x_valid_list.append(x_temp)
-            y_valid_list.append(y_temp)
-            sub_valid_list.append(sub_temp)
-            ss_times_valid_list.append(ss_times_temp)
-        elif sub_num in subj_alloc_dict['test_subj']:
-            if verbose:
-                print('Allocating Subject',sub_num, 'to test')
-            x_test_list.append(x_temp)
-            y_test_list.append(y_temp)
-            sub_test_list.append(sub_temp)
-            ss_times_test_list.append(ss_times_temp)
-        else:
-            print('WARNING: Subject',sub_num,'not found in subj_alloc_dict, discarding')
-
-    # https://stackoverflow.com/questions/27516849/how-to-convert-list-of-numpy-arrays-into-single-numpy-array
-    x_train = np.vstack(x_train_list)
-    y_train = np.vstack(y_train_list)
-    sub_train = np.vstack(sub_train_list)
-    ss_times_train = np.vstack(ss_times_train_list)
-    x_train, y_train, sub_train, ss_times_train = xforms.unify_ir2_labels(x_train, y_train, sub_train, ss_times_train, method = 'drop')
+    if channels is None: # most often only the vector magnitudes are used
+        channels = [i for i in leotta_channel_list if i not in leotta_comp_accel]
+    # The train and valid IR3 drops mixed windows, test uses the mode label.
+    # Both are built for all subjects and cached, the subject allocation is
+    # then just an index so changing subj_alloc_dict does not rebuild anything.
+    ir3_params = dict(dataset = 'Leotta_2021',
+                      time_steps = window_cfg['time_steps'], stride = window_cfg['stride'],
+                      resample = {'wrist':'10ms', 'labels':'nearest'}, label_map = label_map,
+                      drop_labels = [], channels = channels,
+                      ir1_version = ir1_cache_version)
+    source_files = [ffname for i in range(1,9) for ffname in get_leotta_source_files(i)]
+    X, y, sub, ss_times, cache_info = xforms.get_cached_ir3(dict(ir3_params, label_method = 'drop'),
+                                                            get_leotta_ir3, 'drop', window_cfg, channels,
+                                                            source_files = source_files)
+    log_info += cache_info
+    train_index = np.isin(sub[:, 0], subj_alloc_dict['train_subj'])
+    x_train, y_train, sub_train, ss_times_train = X[train_index], y[train_index], sub[train_index], ss_times[train_index]
+    valid_index = np.isin(sub[:, 0], subj_alloc_dict['valid_subj'])
+    x_valid, y_valid, sub_valid, ss_times_valid = X[valid_index], y[valid_index], sub[valid_index], ss_times[valid_index]
     #print(utils.tabulate_numpy_arrays({'x_train':x_train, 'y_train':y_train, 'sub_train':sub_train, 'ss_times_train': ss_times_train}))
 
-    x_valid = np.vstack(x_valid_list)
-    y_valid = np.vstack(y_valid_list)
-    sub_valid = np.vstack(sub_valid_list)
-    ss_times_valid = np.vstack(ss_times_valid_list)
-    x_valid, y_valid, sub_valid, ss_times_valid = xforms.unify_ir2_labels(x_valid, y_valid, sub_valid, ss_times_valid, method = 'drop')
-    #print(utils.tabulate_numpy_arrays({'x_valid':x_valid, 'y_valid':y_valid, 'sub_valid':sub_valid, 'ss_times_valid': ss_times_valid}))
-
-    x_test = np.vstack(x_test_list)
-    y_test = np.vstack(y_test_list)
-    sub_test = np.vstack(sub_test_list)
-    ss_times_test = np.vstack(ss_times_test_list)
-    x_test, y_test, sub_test, ss_times_test = xforms.unify_ir2_labels(x_test, y_test, sub_test, ss_times_test, method = 'mode')
-    #print(utils.tabulate_numpy_arrays({'x_test':x_test, 'y_test':y_test, 'sub_test':sub_test, 'ss_times_test': ss_times_test}))
+    X, y, sub, ss_times, cache_info = xforms.get_cached_ir3(dict(ir3_params, label_method = 'mode'),
+                                                            get_leotta_ir3, 'mode', window_cfg, channels,
+                                                            source_files = source_files)
+    log_info += cache_info
+    test_index = np.isin(sub[:, 0], subj_alloc_dict['test_subj'])
+    x_test, y_test = X[test_index], y[test_index]
+    #print(utils.tabulate_numpy_arrays({'x_test':x_test, 'y_test':y_test}))
+    unallocated = set(np.unique(sub)) - set(subj_alloc_dict['train_subj'] +
+                      subj_alloc_dict['valid_subj'] + subj_alloc_dict['test_subj'])
+    if unallocated:
+        print('WARNING: Subjects',sorted(unallocated),'not found in subj_alloc_dict, discarding')
 
     if (one_hot_encode):
-        y_train = one_hot_by_label_dict(y = y_train, label_map_in = label_map)
-        y_valid = one_hot_by_label_dict(y = y_valid, label_map_in = label_map)
-        y_test = one_hot_by_label_dict(y = y_test, label_map_in = label_map)
+        # one column per label_map class even if missing from a group
+        y_train = xforms.one_hot_encode_labels(y_train, label_map = label_map)
+        y_valid = xforms.one_hot_encode_labels(y_valid, label_map = label_map)
+        y_test = xforms.one_hot_encode_labels(y_test, label_map = label_map)
 
         x_train, y_train, sub_train, ss_times_train = drop_ir2_one_hot_column(x_train, y_train, sub_train, ss_times_train, y_col_index = 0)
         x_valid, y_valid, sub_valid, ss_times_valid = drop_ir2_one_hot_column(x_valid, y_valid, sub_valid, ss_times_valid, y_col_index = 0)
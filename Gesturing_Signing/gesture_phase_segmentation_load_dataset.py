@@ -39,15 +39,10 @@ import time
 import pandas as pd
 import numpy as np
 from numpy import savetxt
-from tabulate import tabulate # for verbose tables, showing data
-from tensorflow.keras.utils import to_categorical # for one-hot encoding
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
+# tabulate (verbose tables) is imported by the functions using it, keeps the import light
 from time import gmtime, strftime, localtime #for displaying Linux UTC timestamps in hh:mm:ss
 from datetime import datetime, date
 import urllib.request # to get files from web w/o !wget
-import matplotlib.pyplot as plt
 
 def get_py_file(fname, url):
     """checks for local file, if none downloads from URL.
@@ -76,8 +71,11 @@ interactive = True # for exploring data and functions interactively
 verbose = True
 
 # Gesture-Phase-Segmentation Dataset unique params
-xform.time_steps = 30
-xform.stride = 5
+window_cfg = dict(time_steps = 30, stride = 5) # passed to xform, not set as its globals
+# The recordings have gaps, gap splitting is opt-in since it changes the
+# windows, window_cfg = dict(window_cfg, **gps_gap_cfg) to turn it on.
+gps_gap_cfg = dict(gap_tolerance = 0.5, # no window may span a gap
+                   gap_fill = 30) # but gaps of up to 30 samples are interpolated
 # the label map should contain all possible labels, it is used to convert from
 # IR1 dataframe string labels of type categorical (saves a ton of memory) to
 # integers for the IR2 and beyond numpy ndarrays.
@@ -115,44 +113,61 @@ def get_gesture_phase_dataset():
 if interactive:
     get_gesture_phase_dataset()
 
-def get_gps_ir1_dict(include_story = False):
+ir1_cache_version = '1' # change when the IR1 code below changes, see xform.get_cached_ir1
+gps_fn_list = ['a1_raw.csv', 'a2_raw.csv', 'a3_raw.csv',
+               'b1_raw.csv', 'b3_raw.csv', 'c1_raw.csv','c3_raw.csv']
+# x,y,z of the left hand, right hand, head, spine, left wrist and right wrist
+gps_channel_list = [part + axis for part in ('lh', 'rh', 'h', 's', 'lw', 'rw')
+                    for axis in ('x', 'y', 'z')]
+
+def get_gps_session_ir1(ffname, subject, story, include_story = False, channels = None):
+    """reads one Gesture-Phase-Segmentation raw .csv file into an IR1
+    dataframe, called by get_gps_ir1_dict.  Only channels (gps_channel_list
+    entries, None = all) are parsed from the csv."""
+    _, keep_channels = xform.get_ir1_source_channels(channels, gps_channel_list)
+    df = pd.read_csv(ffname, usecols = keep_channels + ['timestamp', 'phase'])
+    df = df[keep_channels + ['timestamp', 'phase']] # usecols keeps the file order
+    # change to 32-bit, credit/ref https://stackoverflow.com/questions/69188132/how-to-convert-all-float64-columns-to-float32-in-pandas
+    # Select columns with 'float64' dtype
+    float64_cols = list(df.select_dtypes(include='float64'))
+    # The same code again calling the columns
+    df[float64_cols] = df[float64_cols].astype('float32')
+    # b1_raw has an instance of alternate spelling.  Change to match others.
+    df['phase'] = df['phase'].replace({'Preparação':'Preparation'})
+    # Seems better to explicitly type the other columns vs object.
+    df['phase']=df['phase'].astype('category')
+
+    df['sub'] = subject
+    df['sub'] = [ ord(x) - 96 for x in df['sub']] # ord is unicode char
+    df['sub']=df['sub'].astype('int8')
+    if include_story:
+        df['story'] = story
+        df['story']=df['story'].astype('int8')
+    df.rename(columns={"phase": "label"}, inplace = True, errors="raise") # phase was GPS dataset specific
+
+    # kinect sample rate is 15 or 30 fps, timestamp appears to
+    # be a running counter not an actual UTC time.
+    df['datetime'] = pd.to_datetime(df['timestamp'], unit='ms')
+    df.set_index('datetime',inplace=True)
+    df = df.drop('timestamp', axis=1)
+    return df
+
+def get_gps_ir1_dict(include_story = False, channels = None):
     """reads the Gesture-Phase-Segmentation raw .csv files in the global
     'dataset_dir'. This version uses dict to preserve original filenames.
+    channels = list of gps_channel_list entries to read, None = all
     Returns: a dict containing IR1 dataframes."""
-    fn_list = ['a1_raw.csv', 'a2_raw.csv', 'a3_raw.csv',
-           'b1_raw.csv', 'b3_raw.csv', 'c1_raw.csv','c3_raw.csv']
     get_gesture_phase_dataset()
     ir1_df_dict = dict() # an empty dictionary
-    for item in fn_list:
+    for item in gps_fn_list:
         subject = item[0] # the first letter of the filename a,b,c
         story = item[1] # the number after subject letter, 1,2,3
         ffname = os.path.join(dataset_dir,item)
         # print(subject, story, ffname)
-        df = pd.read_csv(ffname)
-        # change to 32-bit, credit/ref https://stackoverflow.com/questions/69188132/how-to-convert-all-float64-columns-to-float32-in-pandas
-        # Select columns with 'float64' dtype
-        float64_cols = list(df.select_dtypes(include='float64'))
-        # The same code again calling the columns
-        df[float64_cols] = df[float64_cols].astype('float32')
-        # b1_raw has an instance of alternate spelling.  Change to match others.
-        df['phase'] = df['phase'].replace({'Preparação':'Preparation'})
-        # Seems better to explicitly type the other columns vs object.
-        df['phase']=df['phase'].astype('category')
-
-        df['sub'] = subject
-        df['sub'] = [ ord(x) - 96 for x in df['sub']] # ord is unicode char
-        df['sub']=df['sub'].astype('int8')
-        if include_story:
-            df['story'] = story
-            df['story']=df['story'].astype('int8')
-        df.rename(columns={"phase": "label"}, inplace = True, errors="raise") # phase was GPS dataset specific
-
-        # kinect sample rate is 15 or 30 fps, timestamp appears to
-        # be a running counter not an actual UTC time.
-        df['datetime'] = pd.to_datetime(df['timestamp'], unit='ms')
-        df.set_index('datetime',inplace=True)
-        df = df.drop('timestamp', axis=1)
-        ir1_df_dict[item.split('.')[0]]=df # key is root name of csv
+        ir1_name = item.split('.')[0] # key is root name of csv
+        ir1_df_dict[ir1_name] = xform.get_cached_ir1(ir1_name, [ffname], ir1_cache_version,
+                                                     get_gps_session_ir1, ffname, subject,
+                                                     story, include_story, channels)
     return ir1_df_dict
 if interactive:
     ir1_dict = get_gps_ir1_dict()
@@ -201,35 +216,42 @@ if interactive:
     my_df.plot(subplots=True, figsize=(20, 10)) # yay Pandas
 
 # find timegaps and split so that the resulting IR1 dataframes
-# represent a continuous recording session
-# use resampe/mean/interpolate to fill small gaps and make
-# larger ones NaN.   Then get a dataframe of just the NaN
-# rows and use that index to split the dataframe
-# NOTE:  This is dataset specific in that it only handles one big gap
+# represent a continuous recording session.  Gaps of up to gap_fill samples
+# are interpolated, larger ones split the IR1.  The windowing does the same
+# thing when gps_gap_cfg is added to window_cfg so this is just for exploring.
 # Interesting that the plots merge and don't show separately
 if interactive:
     my_df = ir1_dict['a1_raw']
-    max_gaps_to_fill = 30
-    # good resample explanation https://datastud.dev/posts/time-series-resample
-    rs_df = my_df.resample('33ms').mean().interpolate(limit = max_gaps_to_fill)
-    display(rs_df['lhx'].plot(figsize=(20, 10))) # NaN will not be plotted by default
-    nan_rows = rs_df[rs_df['lhx'].isnull()] # notnull also available
-    if (len(nan_rows.index)==0):
-        print("No gaps exceeding",max_gaps_to_fill,"found")
+    run_starts, run_stops = xform.get_ir1_runs(my_df.index, tolerance = gps_gap_cfg['gap_tolerance'],
+                                               max_fill = gps_gap_cfg['gap_fill'])
+    if (len(run_starts)==1):
+        print("No gaps exceeding",gps_gap_cfg['gap_fill'],"samples found")
     else:
-        print(len(nan_rows.index), "rows with gaps large than",max_gaps_to_fill,"found")
-        gap_start, gap_end = nan_rows.index[0], nan_rows.index[-1]
-        print("Start of gap", gap_start)
-        print(" End of gap ", gap_end)
-        df1 = rs_df.loc[rs_df.index[0]:gap_start]
-        df1 = df1.iloc[:-max_gaps_to_fill] # drop the filled gap
-        df2 = rs_df.loc[gap_end:rs_df.index[-1]]
-        df2 = df2.iloc[1:] # drop the one NaN row due to slice
-        display(df1['lhx'].plot(figsize=(20, 10)))
-        display(df2['lhx'].plot(figsize=(20, 10)))
+        print(len(run_starts) - 1, "gaps larger than",gps_gap_cfg['gap_fill'],"samples found")
+        for run_start, run_stop in zip(run_starts, run_stops):
+            print("Run from", my_df.index[run_start], "to", my_df.index[run_stop - 1])
+            run_df = xform.fill_ir1_gaps(my_df.iloc[run_start:run_stop], gps_gap_cfg['gap_fill'])
+            display(run_df['lhx'].plot(figsize=(20, 10)))
 
 """# The dataset specific code to generate the dictionary of IR1 dataframes is complete.  Now use Shared Transforms to generate the final output arrays."""
 
+def get_gps_ir3(store_dir, label_method, assembly = 'prealloc', executor = 'serial',
+                window_cfg = window_cfg, channels = None):
+    """builds the IR3 for all subjects, called by xform.get_cached_ir3 when
+    the IR3 is not in the cache.  Only channels (None = all) are read.
+    Returns X, y, sub, ss_times, channel_list"""
+    ir1_dict = get_gps_ir1_dict(channels = channels)
+    if assembly != 'prealloc':
+        store_dir = None # only prealloc can write the store, saved after
+    X, y, sub, ss_times, xys_info = xform.get_ir3_from_dict(ir1_dict, label_map = label_map_gps,
+                                                           label_method = label_method,
+                                                           assembly = assembly,
+                                                           store_dir = store_dir,
+                                                           executor = executor,
+                                                           window_cfg = window_cfg)
+    channel_list = [col for col in ir1_dict[list(ir1_dict)[0]].columns if col not in ('label', 'sub')]
+    return X, y, sub, ss_times, channel_list
+
 def gesture_phase_segmentation_load_dataset(
     incl_val_group = False, # split train into train and validate
     split_subj = dict
@@ -238,30 +260,52 @@ def gesture_phase_segmentation_load_dataset(
                 test_subj = [3]),
     one_hot_encode = True, # make y into multi-column one-hot, one for each activity
     return_info_dict = False, # return dict of meta info along with ndarrays
-    suppress_warn = False # special case for stratified warning
+    suppress_warn = False, # special case for stratified warning
+    ir3_assembly = 'prealloc', # or 'vstack', see xform.get_ir3_from_dict
+    ir3_executor = 'serial', # 'thread' or 'process' to window sessions in parallel
+    ir3_store_dir = None, # IR3 cache directory, None = xform.ir3_cache_dir (None = off)
+    channels = None # subset of gps_channel_list, only these are read from the csv files
     ):
     """Downloads the Phase-Gesture-Segmentation dataset from UCI repository.
     Each csv file is converted into an IR1 dataframe and placed into a dictionary.
     Since this dataset is so small all subjects are placed into the train set
     and the validation set is a stratification of the train set.   The test set
     is empty by default (usually the test set is pulled out before model tuning)
+    The IR1 and IR3 are only cached if xform.ir1_cache_dir / ir3_store_dir
+    (or xform.ir3_cache_dir) are set.
     """
+    from tabulate import tabulate
     log_info = "Generated by Gesture-Phase-Segmentation_load_dataset.ipynb\n"
     today = date.today()
     log_info += today.strftime("%B %d, %Y") + "\n"
     log_info += "sub dict = " + str(split_subj) + "\n"
 
-    ir1_dict = get_gps_ir1_dict()
-
-    # split the IR1 dict by subject so each can be processed separately.
-    ir1_dict_train,ir1_dict_valid,ir1_dict_test = split_ir1_dict_by_sub(ir1_dict, split_subj_dict = split_subj)
-    if True:  # change back to verbose when done debugging!
-        print("Train:", ir1_dict_train.keys())
-        print("Valid:",ir1_dict_valid.keys())
-        print("Test :",ir1_dict_test.keys())
-    x_train, y_train, sub_train, ss_times_train, xys_info = xform.get_ir3_from_dict(ir1_dict_train, label_map = label_map_gps, label_method = 'drop')
+    # The train IR3 drops mixed windows, the test IR3 uses the mode label.
+    # Both are built for all subjects and cached, the subject split is then
+    # just an index so changing split_subj does not rebuild anything.
+    # gps_channel_list order, the IR1 columns (and X channels) are in that order
+    channels = [ch for ch in gps_channel_list if channels is None or ch in channels]
+    log_info += "Keeping channels" + str(channels) + "\n"
+    ir3_params = dict(dataset = 'Gesture_Phase_Segmentation',
+                      **window_cfg, # time_steps, stride and the gap settings
+                      resample = None, label_map = label_map_gps, drop_labels = [99],
+                      channels = channels, ir1_version = ir1_cache_version)
+    source_files = [os.path.join(dataset_dir, item) for item in gps_fn_list]
+    X, y, sub, ss_times, cache_info = xform.get_cached_ir3(dict(ir3_params, label_method = 'drop'),
+                                                           get_gps_ir3, 'drop', ir3_assembly, ir3_executor, window_cfg,
+                                                           channels, cache_dir = ir3_store_dir,
+                                                           source_files = source_files)
+    log_info += cache_info
+    train_index = np.isin(sub[:, 0], split_subj['train_subj'])
+    x_train, y_train = X[train_index], y[train_index]
     #x_valid, y_valid, sub_valid, ss_times_valid, xys_info = xform.get_ir3_from_dict(ir1_dict_valid, label_map = label_map_gps)
-    x_test, y_test, sub_test, ss_times_test, xys_info = xform.get_ir3_from_dict(ir1_dict_test, label_map = label_map_gps, label_method = 'mode')
+    X, y, sub, ss_times, cache_info = xform.get_cached_ir3(dict(ir3_params, label_method = 'mode'),
+                                                           get_gps_ir3, 'mode', ir3_assembly, ir3_executor, window_cfg,
+                                                           channels, cache_dir = ir3_store_dir,
+                                                           source_files = source_files)
+    log_info += cache_info
+    test_index = np.isin(sub[:, 0], split_subj['test_subj'])
+    x_test, y_test = X[test_index], y[test_index]
 
     # headers = ("Initial Array","shape", "object type", "data type")
     # mydata = [("X", X.shape, type(X), X.dtype),
@@ -272,11 +316,9 @@ def gesture_phase_segmentation_load_dataset(
     # log_info += tabulate(mydata, headers=headers) + "\n"
 
     if (one_hot_encode):
-        # using newer code, ints only, from Fusion of Learned Reps work
-        enc = OneHotEncoder(categories='auto', sparse=False)
-        y_train = enc.fit_transform(y_train)
-        #y_valid = enc.fit_transform(y_valid)
-        y_test = enc.fit_transform(y_test)
+        # classes from the label map so train and test have the same columns
+        y_train = xform.one_hot_encode_labels(y_train, label_map = label_map_gps)
+        y_test = xform.one_hot_encode_labels(y_test, label_map = label_map_gps)
         # integer encode
         # y_vector_train = np.ravel(y_train) #encoder won't take column vector
         # y_vector_valid = np.ravel(y_valid) #encoder won't take column vector
@@ -313,7 +355,17 @@ def gesture_phase_segmentation_load_dataset(
         # activities for inclusion in validation.  See
         # https://github.com/imics-lab/Semi-Supervised-HAR-e4-Wristband
         # https://scikit-learn.org/stable/modules/generated/sklearn.model_selection.train_test_split.html
-        x_train, x_valid, y_train, y_valid = train_test_split(x_train, y_train, test_size=0.10, random_state=42, stratify=y_train)
+        # stratified index split of the train arrays, replaces train_test_split
+        # Note: this split is not the one train_test_split(random_state = 42)
+        # gave before, the same seed picks different windows (numpy Generator
+        # permutation per class, not sklearn's StratifiedShuffleSplit) and the
+        # arrays stay in time order instead of being shuffled.  Class
+        # proportions are the same, earlier validation scores are not directly
+        # comparable.
+        train_index, valid_index = xform.get_stratified_split_index(
+            xform.get_class_index(y_train), test_size = 0.10, seed = 42)
+        x_valid, y_valid = x_train[valid_index], y_train[valid_index]
+        x_train, y_train = x_train[train_index], y_train[train_index]
 
     # test_index = np.nonzero(np.isin(sub_num, split_subj['test_subj']))
     # x_test = X[test_index]
@@ -344,6 +396,7 @@ def gesture_phase_segmentation_load_dataset(
 """# Main is setup to be a demo and bit of unit test."""
 
 if __name__ == "__main__":
+    from tabulate import tabulate
     verbose = False
     print("Get Gesture Phase Segmentation using defaults - simple and easy!")
     x_train, y_train, x_test, y_test \
@@ -62,13 +62,23 @@ import glob # to generate lists of files in directory - unix style pathnames
 import pandas as pd
 import numpy as np
 #import matplotlib.pyplot as plt # for plotting - pandas uses matplotlib
-from tabulate import tabulate # for verbose tables
-from tensorflow.keras.utils import to_categorical # for one-hot encoding
 
 interactive = True # run example calls for each function as Jupyter Notebook
 
 interactive = False # skip to run as interactive, executes main as .py
 
+# shared transform (xforms) functions from IMICS Public Repo, used for one-hot
+try:
+    import load_data_transforms as xforms
+except:
+    r = requests.get('https://raw.githubusercontent.com/imics-lab/load_data_time_series/main/load_data_transforms.py')
+    with open('load_data_transforms.py', 'wb') as fd:
+        fd.write(r.content)
+    import load_data_transforms as xforms
+
+#Class indices match the ones generated by Keras image import
+mobiact_act_map = {'JOG': 0, 'JUM': 1, 'STD': 2, 'STN': 3, 'STU': 4, 'WAL': 5}
+
 # Trying to figure out how to download automatically to eliminate drive mount
 # gdown doesn't work even with confirm=t option - could be google
 # limiting downloads from scripts (the link works fine when signed in)
@@ -238,7 +248,8 @@ def mobiact_adl_load_dataset(
         incl_ttl_accel (bool): returns the magnitude of accel vector minus 1g
         incl_val_group (bool): return includes x_valid and y_valid arrays (default is False)
         split_sub (dict): subject numbers assigned to train, valid, test groups
-        one_hot_encode (bool): return one-hot-encoded y arrays
+        one_hot_encode (bool): return uint8 one-hot-encoded y arrays, else
+            int8 labels per mobiact_act_map
 
     Returns:
         trainX, trainy, validX, validy, testX, testy np arrays
@@ -252,55 +263,35 @@ def mobiact_adl_load_dataset(
     # should be a better way to do this
     # FIXME:  Third dimension must follow accel return values - in all three lines
     trainX = np.zeros(shape=(1,500,4)) #otherwise accumulates when run more than once
-    trainy = np.zeros(shape=(1,6))
+    trainy = np.zeros(shape=(1,1),dtype='int8')
     validX = np.zeros(shape=(1,500,4))
-    validy = np.zeros(shape=(1,6))
+    validy = np.zeros(shape=(1,1),dtype='int8')
     testX = np.zeros(shape=(1,500,4))
-    testy = np.zeros(shape=(1,6))
+    testy = np.zeros(shape=(1,1),dtype='int8')
     for i in df_flist.index:
         if ((df_flist['GRP'][i])=='train'):
             #print ("processing train file", df_flist['fname'][i])
             df = get_df_from_file(df_flist['fname'][i])
             tempX = split_df_npX(df)
             trainX = np.vstack([trainX, tempX])
-            tempy = np.zeros(shape=(tempX.shape[0],6)) # 6 is number of ACT
-            #one hot encoding of ACT
-            #Class indices are  {'JOG': 0, 'JUM': 1, 'STD': 2, 'STN': 3, 'STU': 4, 'WAL': 5}
-            #to match the ones generated by Keras image import
-            if ((df_flist['ACT'][i])=='JOG'): tempy[:,0]=1
-            if ((df_flist['ACT'][i])=='JUM'): tempy[:,1]=1
-            if ((df_flist['ACT'][i])=='STD'): tempy[:,2]=1
-            if ((df_flist['ACT'][i])=='STN'): tempy[:,3]=1
-            if ((df_flist['ACT'][i])=='STU'): tempy[:,4]=1
-            if ((df_flist['ACT'][i])=='WAL'): tempy[:,5]=1
+            tempy = np.full(shape=(tempX.shape[0],1), dtype='int8',
+                            fill_value=mobiact_act_map[df_flist['ACT'][i]])
             trainy = np.vstack([trainy, tempy])
         if ((df_flist['GRP'][i])=='valid'):
             #print ("processing test file", df_flist['fname'][i])
             df = get_df_from_file(df_flist['fname'][i])
             tempX = split_df_npX(df)
             validX = np.vstack([validX, tempX])
-            tempy = np.zeros(shape=(tempX.shape[0],6)) # 6 is number of ACT
-            #one hot encoding of ACT
-            if ((df_flist['ACT'][i])=='JOG'): tempy[:,0]=1
-            if ((df_flist['ACT'][i])=='JUM'): tempy[:,1]=1
-            if ((df_flist['ACT'][i])=='STD'): tempy[:,2]=1
-            if ((df_flist['ACT'][i])=='STN'): tempy[:,3]=1
-            if ((df_flist['ACT'][i])=='STU'): tempy[:,4]=1
-            if ((df_flist['ACT'][i])=='WAL'): tempy[:,5]=1
+            tempy = np.full(shape=(tempX.shape[0],1), dtype='int8',
+                            fill_value=mobiact_act_map[df_flist['ACT'][i]])
             validy = np.vstack([validy, tempy])
         if ((df_flist['GRP'][i])=='test'):
             #print ("processing test file", df_flist['fname'][i])
             df = get_df_from_file(df_flist['fname'][i])
             tempX = split_df_npX(df)
             testX = np.vstack([testX, tempX])
-            tempy = np.zeros(shape=(tempX.shape[0],6)) # 6 is number of ACT
-            #one hot encoding of ACT
-            if ((df_flist['ACT'][i])=='JOG'): tempy[:,0]=1
-            if ((df_flist['ACT'][i])=='JUM'): tempy[:,1]=1
-            if ((df_flist['ACT'][i])=='STD'): tempy[:,2]=1
-            if ((df_flist['ACT'][i])=='STN'): tempy[:,3]=1
-            if ((df_flist['ACT'][i])=='STU'): tempy[:,4]=1
-            if ((df_flist['ACT'][i])=='WAL'): tempy[:,5]=1
+            tempy = np.full(shape=(tempX.shape[0],1), dtype='int8',
+                            fill_value=mobiact_act_map[df_flist['ACT'][i]])
             testy = np.vstack([testy, tempy])
     # delete first row placeholders
     trainX = np.delete(trainX, (0), axis=0) 
@@ -320,6 +311,10 @@ def mobiact_adl_load_dataset(
         trainX = np.delete(trainX, [0,1,2], axis = 2)
         validX = np.delete(validX, [0,1,2], axis = 2)
         testX = np.delete(testX, [0,1,2], axis = 2)
+    if (one_hot_encode):
+        trainy = xforms.one_hot_encode_labels(trainy, num_classes=6)
+        validy = xforms.one_hot_encode_labels(validy, num_classes=6)
+        testy = xforms.one_hot_encode_labels(testy, num_classes=6)
     if (incl_val_group):
         return trainX, trainy, validX, validy, testX, testy
     else:
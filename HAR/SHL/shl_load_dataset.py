@@ -43,17 +43,13 @@ interactive = False
 verbose = False
 
 import os
+import json # for the source sidecar manifest
 import shutil #https://docs.python.org/3/library/shutil.html
 from shutil import unpack_archive # to unzip
 import requests #for downloading zip file
 import numpy as np
 import pandas as pd
-from tabulate import tabulate # for verbose tables, showing data
-import matplotlib.pyplot as plt
-from tensorflow.keras.utils import to_categorical # for one-hot encoding
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
+# tabulate (verbose tables) is imported by the functions using it, keeps the import light
 import time
 from datetime import date
 import gc # trying to resolve high memory useage
@@ -79,6 +75,15 @@ def get_url_file(url, fname, chunk_size=1024*1024):
         #info_dict['info_text'] += "\ndataset downloaded from " + url + '\n'
     else:
         print("File", ffname, "found, skipping download")
+"""# Load shared transform (xforms) functions from IMICS Public Repo"""
+
+try:
+    import load_data_transforms as xforms
+except:
+    get_url_file(url = 'https://raw.githubusercontent.com/imics-lab/load_data_time_series/main/load_data_transforms.py',
+                 fname = 'load_data_transforms.py')
+    import load_data_transforms as xforms
+
 if (interactive):
     get_url_file(
         url='http://www.shl-dataset.org/wp-content/uploads/SHLDataset_preview_v1_part1.zip',
@@ -135,52 +140,125 @@ def get_column_names():
 # Coarse Labels Null=0, Still=1, Walking=2, Run=3, Bike=4, Car=5, Bus=6, Train=7, Subway=8 
 # t_names = ['Still', 'Walking', 'Run', 'Bike', 'Car', 'Bus', 'Train', 'Subway']
 
+ir1_cache_version = '2' # change when the IR1 code below changes, part of the IR3 cache key
+# session directories of each user in the preview dataset
+shl_src_list = [['220617','260617','270617'],
+                ['140617','140717','180717'],
+                ['030717','070717','140617']]
+
+shl_channel_list = ['accel_x', 'accel_y', 'accel_z', 'accel_ttl'] # IR3 X channels
+# source column for each channel, accel_ttl is computed from the three axes
+shl_source_columns = {'accel_x' : 'Acceleration X [m/s2]',
+                      'accel_y' : 'Acceleration Y [m/s2]',
+                      'accel_z' : 'Acceleration Z [m/s2]'}
+shl_derived_channels = {'accel_ttl' : ['accel_x', 'accel_y', 'accel_z']}
+
+# Parsed source columns are kept as .npy files in this sub directory of
+# xforms.ir1_cache_dir so only the first read parses the text.  This is the
+# only SHL IR1 level cache (the IR1 is cheap to rebuild from the columns), it
+# is off if xforms.ir1_cache_dir or shl_sidecar_dir is None.
+shl_sidecar_dir = 'shl_npy'
+
+def parse_shl_source_columns(ffname, names, columns):
+    """Parses only Time and columns of a space delimited SHL source file.
+    Returns a dict of column name to ndarray, Time as int64 nanoseconds and
+    the others as float32."""
+    dtypes = {col: 'float32' for col in columns}
+    # Time in ms (~1.5e12) is exact in float64, the to_datetime of the float
+    # was what gave 08:33:18.009999872 for 18.010, so round to int64 ms
+    # first and do the ns conversion in integers.
+    dtypes['Time'] = 'float64'
+    df = pd.read_csv(ffname, sep = r'\s+', index_col = False, header = 0,
+                     names = names, usecols = ['Time'] + columns, dtype = dtypes)
+    data = {'Time': np.rint(df['Time'].to_numpy()).astype('int64') * 1000000}
+    for col in columns:
+        data[col] = df[col].to_numpy()
+    return data
+
+def get_shl_source_columns(ffname, names, columns):
+    """Returns parse_shl_source_columns(ffname, names, columns) using the
+    binary sidecar in xforms.ir1_cache_dir/shl_sidecar_dir/<User>_<session>.
+    Columns already in the sidecar are loaded from .npy, only the missing
+    ones are parsed and then added, so another channel subset doesn't parse
+    the whole file again.  The sidecar is rebuilt if the size or modification
+    time of ffname or ir1_cache_version changes.  Nothing is written next to
+    the source files."""
+    if xforms.ir1_cache_dir is None or shl_sidecar_dir is None:
+        return parse_shl_source_columns(ffname, names, columns)
+    session_dir, session = os.path.split(os.path.dirname(os.path.abspath(ffname)))
+    sidecar_dir = os.path.join(xforms.ir1_cache_dir, shl_sidecar_dir,
+                               os.path.basename(session_dir) + '_' + session)
+    base_fname = os.path.splitext(os.path.basename(ffname))[0]
+    manifest_fname = os.path.join(sidecar_dir, base_fname + '_manifest.json')
+    stat = os.stat(ffname)
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+              'version': ir1_cache_version}
+    manifest = {'source': source, 'columns': {}}
+    if os.path.isfile(manifest_fname):
+        with open(manifest_fname, 'r') as file_object:
+            stored = json.load(file_object)
+        if stored['source'] == source:
+            manifest = stored
+    missing = [col for col in columns if col not in manifest['columns']]
+    if missing or 'Time' not in manifest['columns']:
+        if verbose:
+            print('Parsing', ffname, 'columns', missing)
+        parsed = parse_shl_source_columns(ffname, names, missing)
+        if not os.path.isdir(sidecar_dir):
+            os.makedirs(sidecar_dir)
+        for col, values in parsed.items():
+            if col not in manifest['columns']:
+                fname = base_fname + '_' + str(names.index(col)) + '.npy'
+                np.save(os.path.join(sidecar_dir, fname), values)
+                manifest['columns'][col] = fname
+        # the manifest is written last so an interrupted parse isn't used
+        with open(manifest_fname, 'w') as file_object:
+            json.dump(manifest, file_object, indent = 1)
+    return {col: np.load(os.path.join(sidecar_dir, manifest['columns'][col]))
+            for col in ['Time'] + columns}
+
 def get_ir1_from_shl_source(
     src_dir = 'undefined', # the directory of the source files
-    sub_num = 1 # this is based on the directory, must be passed
+    sub_num = 1, # this is based on the directory, must be passed
+    channels = None # subset of shl_channel_list, None = all
     ): 
     """processes the Hips_Motion.txt and Label.txt SHL source files and adds the
-    subject number into a returned pandas dataframe in IR1 format"""
+    subject number into a returned pandas dataframe in IR1 format.
+    Only the motion columns needed for channels are parsed (straight to
+    float32) and, with xforms.ir1_cache_dir set, they are read from the
+    session sidecar after the first time, see get_shl_source_columns."""
     motion_columns, label_columns = get_column_names()
+    source_channels, keep_channels = xforms.get_ir1_source_channels(
+        channels, shl_channel_list, shl_derived_channels)
+    read_columns = [shl_source_columns[ch] for ch in source_channels
+                    if ch in shl_source_columns]
     ffnameX = os.path.join(src_dir,'Hips_Motion.txt')
     ffnamey = os.path.join(src_dir,'Label.txt')
     print("Processing Hip Motion and Labels in", src_dir, "subject number", sub_num)
-    df = pd.read_csv(ffnameX, delim_whitespace=True, index_col = False, header=0, names = motion_columns)
-    # whitespace is because the text files are space delimited not comma delimited.
-    # setting index_col to False means the time will come in as a column and is
-    # easier to fix.
-    # this is drove me crazy, the time after conversion is off by several
-    # hundred nanoseconds. 08:33:18.009999872 orginally was 18.010 ms
-    # this screws up the indexing, convert to int before conversion!!! 
-    df = df.astype({'Time': 'int64'}) # change future index from float64 to int64
-    df['Time'] = pd.to_datetime(df['Time'], unit= 'ms') # convert to datetime
-    df.set_index('Time', drop = True, inplace = True)
-    drop_columns = motion_columns.copy() # get full column list
-    # remove the columns to *keep* - not the ones to be dropped
-    drop_columns.remove('Time')
-    drop_columns.remove('Acceleration X [m/s2]')
-    drop_columns.remove('Acceleration Y [m/s2]')
-    drop_columns.remove('Acceleration Z [m/s2]')
-    df.drop(drop_columns, axis = 1, inplace = True)
-    # calculate total accel - length of accel vector minus 1g (gravity)
-    df_sqd = df.pow(2)[['Acceleration X [m/s2]','Acceleration Y [m/s2]','Acceleration Z [m/s2]']] #square each accel
-    df_sum = df_sqd.sum(axis=1) #add sum of squares, new 1 col df
-    df.loc[:,'accel_ttl'] = df_sum.pow(0.5)-9.8  # sqrt and remove 1g due to gravity
-    del df_sqd, df_sum
-    # the input data has been processed, now build dataframe from labels
-    dfy = pd.read_csv(ffnamey, delim_whitespace=True, index_col = False, header=0, names = label_columns)
-    #dfy = dfy[['Time','Coarse label']] # drop all but coarse label, has warning
-    dfy = dfy.loc[:,('Time','Coarse label')] # better way per pandas docs
-    dfy['Time'] = pd.to_datetime(dfy['Time'], unit= 'ms') # convert to datetime
-    dfy.set_index('Time', drop = True, inplace = True)
-    # combine the two by indices
-    df = df.join(dfy) # join based on time index
-    df.rename({"Coarse label": "label"}, axis="columns", inplace = True) # for consistency
+    motion = get_shl_source_columns(ffnameX, motion_columns, read_columns)
+    index = pd.DatetimeIndex(motion['Time'].astype('datetime64[ns]'), name = 'Time')
+    df = pd.DataFrame({col: motion[col] for col in read_columns}, index = index)
+    if 'accel_ttl' in keep_channels:
+        # calculate total accel - length of accel vector minus 1g (gravity)
+        axes = [motion[shl_source_columns[ch]] for ch in shl_derived_channels['accel_ttl']]
+        df['accel_ttl'] = np.sqrt(sum(np.square(i) for i in axes)) - np.float32(9.8)
+    # drop the axes that were only read to compute accel_ttl
+    df = df[[shl_source_columns.get(ch, ch) for ch in keep_channels]]
+    # the input data has been processed, now add the coarse labels
+    labels = get_shl_source_columns(ffnamey, label_columns, ['Coarse label'])
+    label = labels['Coarse label']
+    if not np.isnan(label).any():
+        label = label.astype('int8')
+    if np.array_equal(labels['Time'], motion['Time']):
+        df['label'] = label # same rows, no need to join on the time index
+    else:
+        dfy = pd.DataFrame({'label': label},
+                           index = pd.DatetimeIndex(labels['Time'].astype('datetime64[ns]'), name = 'Time'))
+        df = df.join(dfy) # join based on time index
     df['sub'] = sub_num # add column with subject number
     # check for gaps in time, if dataframe has gaps resample and sliding window
     # operations may generate erroneous results.
-    # ack https://stackoverflow.com/questions/42554704/how-to-spot-gaps-between-pandas-dataframe-indexes
-    num_gaps = sum(df.index.to_series().diff() > pd.Timedelta('00:00:00.010'))
+    num_gaps = np.count_nonzero(np.diff(motion['Time']) > pd.Timedelta('00:00:00.010').value)
     if (num_gaps > 0):
         print('WARNING: Found',num_gaps,'in dataframe, time should be contiguous')
     return df
@@ -191,14 +269,14 @@ if (interactive):
 
 def resample_ir1(df, new_time_step='50ms'):
     # modified version of to_fixed_timedelta in MobiAct
-    """resamples an IR1 DateTime indexed dataframe to new_time_step.  Will
-    return NaN per resample method (happens on irregular samples)"""
+    """resamples an IR1 DateTime indexed dataframe to new_time_step using
+    xforms.resample_ir1_fixed, channels are averaged and interpolated, label
+    and sub are taken from the nearest sample instead of being averaged."""
     if verbose:
         print("Resampling",new_time_step,": Original #rows = ",len(df.index))
-    df = df.resample(new_time_step).mean()
-    df = df.interpolate() #linear interpolation for nan
+    df, report = xforms.resample_ir1_fixed(df, new_time_step, label_method = 'nearest')
     if verbose:
-        print("Resampled: New #rows = ",len(df.index))
+        print("Resampled: New #rows = ",len(df.index), "filled", report['filled'])
     return df
 if (interactive):
     print(my_df.head())
@@ -270,16 +348,9 @@ def clean_ir2(X, y, sub):
     if (nans.size!=0):
         print("WARNING! Cleaned output arrays still contain NaN entries")
         print("execute print(X[99]) # to view single sample")
-    # Now get rid of segments with multiple labels
-    # Not happy with this code, must be a better way but it seems to work...
-    idx = []
-    for i in range(y.shape[0]):
-        if np.all(y[i] == y[i][0]):
-            idx.append(True)
-            
-        else:
-            idx.append(False)
-            #print('Discarding Row:', i)
+    # Now get rid of segments with multiple labels, compare every label in
+    # the window against the first one (vectorized, was a loop over windows)
+    idx = np.all(y == y[:, :1], axis = 1)
     X = X[idx]
     y = y[idx]
     sub = sub[idx]
@@ -320,10 +391,13 @@ if interactive:
 
 verbose = False
 
-def stack_ir2_into_ir3():
+def stack_ir2_into_ir3(channels = None):
     """Uses pipeline to build individual IR1 (dataframes) and IR2 (ndarrays)
     for the SHL dataset.  Stacks the IR2 arrays into an IR3 which consists
-    of X (channel data), y (labels), sub (subject numbers)"""
+    of X (channel data), y (labels), sub (subject numbers).
+    channels is a subset of shl_channel_list, None = all channels"""
+    if channels is None:
+        channels = shl_channel_list
     log_info = "Generated by SHL_load_dataset\n"
     today = date.today()
     log_info += today.strftime("%B %d, %Y") + "\n"
@@ -343,19 +417,17 @@ def stack_ir2_into_ir3():
     # source files setup, now go into each dir and process
     # raw data to IR1 (df) then IR2 (np) then IR3 (stacked IR2s)
     # this is hard-coded and uses DRAM hogging append, fingers crossed...
-    X3 = np.zeros(shape=(1,100,4)) # need to fix this so not hardcoded!
+    X3 = np.zeros(shape=(1,100,len(channels)))
     y3 = np.zeros(shape=(1,1), dtype='int') # unicode 10 char
     sub3 = np.zeros(shape=(1,1),dtype='int') # one subject number per entry
-    src_list = [['220617','260617','270617'],
-                ['140617','140717','180717'],
-                ['030717','070717','140617']]
-    for index, dir_nums in enumerate(src_list):
+    for index, dir_nums in enumerate(shl_src_list):
         for index2, num in enumerate(dir_nums):
             src_dir = os.path.join(my_dir,'SHLDataset_preview_v1',
                             ('User'+ str(index+1)),num)
             if (os.path.exists(src_dir)):
                 sub_num = index + 1
-                df_ir1 = get_ir1_from_shl_source(src_dir,sub_num)
+                # the parsed columns are cached by get_shl_source_columns
+                df_ir1 = get_ir1_from_shl_source(src_dir, sub_num, channels)
                 df_ir1 = resample_ir1(df_ir1,new_time_step='50ms') # resample to 20Hz
                 X2, y2, sub2 = get_ir2_from_ir1(df_ir1, time_steps = 100, stride = 100)
                 X2, y2, sub2 = clean_ir2(X2, y2, sub2)
@@ -384,70 +456,80 @@ if (interactive):
     mydata = [("my_X:", my_X.shape, type(my_X), my_X.dtype),
             ("my_y:", my_y.shape ,type(my_y), my_y.dtype),
             ("my_sub:", my_sub.shape, type(my_sub), my_sub.dtype)]
+    from tabulate import tabulate
     print(tabulate(mydata, headers=headers))
 
-if False: #change to true to save X, y, sub numpy files interactively
+if False: #change to true to save X, y, sub as an IR3 store interactively
     output_dir = '/content/drive/MyDrive/Processed_Datasets/shl/ir3_20hz'
-    xys_info = 'xys_info not implemented'
     if (os.path.isdir(output_dir)):
-        #quick check for existing files, '.ipynb_checkpoints' file 
-        #makes it more complicated to see if directory is empty
-        if (not os.path.isfile(output_dir + '/X.npy')):
+        if (not os.path.isfile(output_dir + '/manifest.json')):
             summary = "SHL early version\n"
-            summary += "Saved to " + output_dir + "\n"
-            summary = "This version downsampled to 20Hz\n"
+            summary += "This version downsampled to 20Hz\n"
             summary += "Generated by SHL_load_dataset.ipynb" 
             summary += " on " + time.strftime('%b-%d-%Y_%H%M', time.localtime())
-
-            info_fname = output_dir +'/'+'info.txt'
-            full_info = summary + "\n" + xys_info + "\n"
-            print(full_info)
-
-            with open(info_fname, "w") as file_object:
-                file_object.write(full_info)
-
-            if True:
-                np.save(output_dir + '/'+'X.npy',my_X)
-                np.save(output_dir + '/'+'y.npy',my_y)
-                np.save(output_dir + '/'+'sub.npy',my_sub)
+            print(summary)
+            # no ss_times from this loader yet, stored as NaT
+            xforms.save_ir3_store(output_dir, my_X, my_y, my_sub,
+                                  channel_list = shl_channel_list,
+                                  info = summary)
         else:
-            print("Error "+output_dir+" contains X.npy, please delete files")
+            print("Error "+output_dir+" contains an IR3 store, please delete files")
     else:
         print(output_dir + " not found, please create directory")
 
+def get_shl_source_files():
+    """Returns the Hips_Motion and Label files of every session, the IR3
+    cache key uses them."""
+    return [os.path.join(my_dir, 'SHLDataset_preview_v1', 'User' + str(index + 1), num, fname)
+            for index, dir_nums in enumerate(shl_src_list) for num in dir_nums
+            for fname in ('Hips_Motion.txt', 'Label.txt')]
+
+def get_shl_ir3(store_dir, channels = None):
+    """called by xforms.get_cached_ir3 when the IR3 is not in the cache,
+    there are no ss_times from this loader yet.
+    Returns X, y, sub, ss_times (None), channel_list"""
+    if channels is None:
+        channels = shl_channel_list
+    X, y, sub = stack_ir2_into_ir3(channels)
+    return X, y, sub, None, channels
+
 def shl_load_dataset(
-    use_saved_xysub = True, # get X,y,sub from zip, True = faster to used saved ones
+    use_saved_xysub = True, # use the cached X,y,sub if available (xforms.ir3_cache_dir set), False = rebuild
     incl_val_group = False, # split train into train and validate
     split_subj = dict
                 (train_subj = [1],
                 validation_subj = [2],
                 test_subj = [3]),
     one_hot_encode = True, # make y into multi-column one-hot, one for each activity
-    return_info_dict = False # return dict of meta info along with ndarrays
+    return_info_dict = False, # return dict of meta info along with ndarrays
+    channels = None # subset of shl_channel_list, only these are read from source
     ):
     
     """Downloads The University of Sussex-Huawei Locomotion and Transportation
     Dataset (SHL), processes each sessions data into a Pandas Dataframe Intermediate
     Representation (IR1)  returned arrays by separating
     into _train, _validate, and _test arrays for X and y based on split_sub
-    dictionary."""
+    dictionary.  The caches are opt-in, set xforms.ir1_cache_dir and
+    xforms.ir3_cache_dir to keep the parsed sessions and the IR3 on disk."""
+    from tabulate import tabulate
     print("shl_load_dataset: use_saved_xysub =", use_saved_xysub)
     log_info = "Generated by SHL_load_dataset\n"
     today = date.today()
     log_info += today.strftime("%B %d, %Y") + "\n"
     log_info += "sub dict = " + str(split_subj) + "\n"
-    if (not use_saved_xysub):
-        X, y, sub = stack_ir2_into_ir3()
-    else:
-        # read previously stored X, y, sub arrays instead of creating from zip
-        # saves time when running multiple train/test split experiments
-        # e.g. passing different subject dictionaries to this method
-        # create & save X, y, sub using Leotta_2021_get_X_y_sub.ipynb interactively
-        input_dir = '/content/drive/MyDrive/Processed_Datasets/shl/ir3_20hz'
-        X = np.load(input_dir + '/'+'X.npy')
-        y = np.load(input_dir + '/'+'y.npy')
-        sub = np.load(input_dir + '/'+'sub.npy')
-        log_info += "X, y, sub loaded from "+str(input_dir)+"\n"
+    if channels is None:
+        channels = shl_channel_list
+    # stack_ir2_into_ir3 takes an hour+, the IR3 is kept in the xforms IR3
+    # cache (memory-mapped) so different subject dictionaries reuse it.
+    # use_saved_xysub = False forces a rebuild.
+    ir3_params = dict(dataset = 'SHL', time_steps = 100, stride = 100,
+                      resample = dict(step = '50ms', labels = 'nearest'), label_method = 'drop', label_map = None,
+                      drop_labels = [0], channels = channels,
+                      ir1_version = ir1_cache_version)
+    X, y, sub, ss_times, cache_info = xforms.get_cached_ir3(ir3_params, get_shl_ir3, channels,
+                                                            refresh = not use_saved_xysub,
+                                                            source_files = get_shl_source_files())
+    log_info += cache_info
     # write initial array info to log_info
     headers = ("Initial Array","shape", "object type", "data type")
     mydata = [("X", X.shape, type(X), X.dtype),
@@ -458,25 +540,15 @@ def shl_load_dataset(
     log_info += tabulate(mydata, headers=headers) + "\n"
     #remove component accel if needed <deleted - need to implement drop columns>
  
-    #One-Hot-Encode y...there must be a better way when starting with strings
-    #https://machinelearningmastery.com/how-to-one-hot-encode-sequence-data-in-python/
-
     if (one_hot_encode):
-        # integer encode
-        y_vector = np.ravel(y) #encoder won't take column vector
-        le = LabelEncoder()
-        integer_encoded = le.fit_transform(y_vector) #convert from string to int
-        name_mapping = dict(zip(le.classes_, le.transform(le.classes_)))
+        # coarse labels 1..8 after the Null windows are dropped, a fixed class
+        # list keeps the column order stable even if a class is not present
+        shl_classes = list(range(1, 9))
+        y = xforms.one_hot_encode_labels(y, classes = shl_classes)
         if (verbose):
-            print("One-hot-encoding: category names -> int -> one-hot \n")
-            print(name_mapping) # seems risky as interim step before one-hot
-        log_info += "One Hot:" + str(name_mapping) +"\n\n"
-        onehot_encoder = OneHotEncoder(sparse=False)
-        integer_encoded = integer_encoded.reshape(len(integer_encoded), 1)
-        onehot_encoded = onehot_encoder.fit_transform(integer_encoded)
-        #print("One-hot-encoding",onehot_encoder.categories_)
-        y=onehot_encoded
-        #return X,y
+            print("One-hot-encoding: coarse label -> one-hot column")
+            print(shl_classes)
+        log_info += "One Hot:" + str(shl_classes) +"\n\n"
     # split by subject number pass in dictionary
     sub_num = np.ravel(sub[ : , 0] ) # convert shape to (1047,)
     if (not incl_val_group):
@@ -520,6 +592,7 @@ def shl_load_dataset(
             return x_train, y_train, x_test, y_test
 
 if __name__ == "__main__":
+    from tabulate import tabulate
     print("Without saved IR3 (X, y ,sub) this will take an hour+ to run")
     x_train, y_train, x_test, y_test \
                              = shl_load_dataset(use_saved_xysub = False, 
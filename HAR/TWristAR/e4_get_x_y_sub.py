@@ -40,16 +40,22 @@ import shutil #https://docs.python.org/3/library/shutil.html
 from shutil import unpack_archive # to unzip
 #from shutil import make_archive # to create zip for storage
 import requests #for downloading zip file
-from scipy import io #for loadmat, matlab conversion
 import time
 import pandas as pd
 import numpy as np
 from numpy import savetxt
-import matplotlib.pyplot as plt # for plotting - pandas uses matplotlib
-from tabulate import tabulate # for verbose tables
 from time import gmtime, strftime, localtime #for displaying Linux UTC timestamps in hh:mm:ss
 from datetime import datetime
 
+# shared transforms, only used here to save the arrays as an IR3 store
+try:
+    import load_data_transforms as xforms
+except:
+    r = requests.get('https://raw.githubusercontent.com/imics-lab/load_data_time_series/main/load_data_transforms.py')
+    with open('load_data_transforms.py', 'wb') as fd:
+        fd.write(r.content)
+    import load_data_transforms as xforms
+
 #Helper functions especially useful in colab
 from requests import get
 def what_is_my_name():
@@ -176,12 +182,11 @@ def label_df_from_csv (df, labels_ffname):
     # quick check to make sure all subjects are the same - only 1 sub per csv
     if (not (df_labels['sub'].eq(df_labels['sub'].iloc[0]).all())):
         print('Warning: Multiple subjects detected in csv, unusual for e4 data.')
-    df['label']='Undefined' # add column with safe value for labels
-    df['sub'] = np.NaN
-    for index, row in df_labels.iterrows():
-        #print(row['start'], row['finish'],row['label'])
-        df.loc[row['start']:row['finish'],'label'] = row['label']
-        df.loc[row['start']:row['finish'],'sub'] = row['sub']
+    # unlabeled rows get 'Undefined' and NaN sub, a later csv row wins
+    # where intervals overlap (same as applying the rows in order)
+    labels = xforms.get_interval_labels(df.index, df_labels, overlap = 'last')
+    df['label'] = labels['label']
+    df['sub'] = labels['sub']
     return df
 
 def split_df_to_timeslice_nparrays(df, time_steps, step):
@@ -317,32 +322,25 @@ if False: #change to true to save files interactively
     #output_dir = '/content/drive/MyDrive/Processed_Datasets/e4_Nov2019_xys/3s_window_2s_overlap'
     #output_dir = '/content/drive/MyDrive/Processed_Datasets/e4_Nov2019_xys/free_walk_not_labeled'
     if (os.path.isdir(output_dir)):
-        #quick check for existing files, '.ipynb_checkpoints' file 
-        #makes it more complicated to see if directory is empty
-        if (not os.path.isfile(output_dir + '/X.npy')):
+        if (not os.path.isfile(output_dir + '/manifest.json')):
             summary = "e4 Nov 2019 data\n"
             summary += "Saved to " + output_dir + "\n"
             summary += "Generated by " + what_is_my_name() 
             summary += " on " + time.strftime('%b-%d-%Y_%H%M', time.localtime())
-
-            info_fname = output_dir +'/'+'info.txt'
             full_info = summary + "\n" + xys_info + "\n"
             print(full_info)
-
-            with open(info_fname, "w") as file_object:
-                file_object.write(full_info)
-
-            if True:
-                np.save(output_dir + '/'+'X.npy',X)
-                np.save(output_dir + '/'+'y.npy',y)
-                np.save(output_dir + '/'+'sub.npy',sub)
+            # string labels are stored as is, reload with xforms.load_ir3_store
+            xforms.save_ir3_store(output_dir, X, y, sub,
+                                  channel_list = ['accel_x', 'accel_y', 'accel_z', 'accel_ttl'],
+                                  info = full_info)
         else:
-            print("Error "+output_dir+" contains X.npy, please delete files")
+            print("Error "+output_dir+" contains an IR3 store, please delete files")
     else:
         print(output_dir + " not found, please create directory")
 
 # Plot y - must convert to numeric first
 def plot_activities():
+    import matplotlib.pyplot as plt # slow import, only needed for the plots
     uniques, y_num = np.unique(y, return_inverse=True)
     print (uniques)
     plt.plot(y_num) 
@@ -350,6 +348,7 @@ def plot_activities():
 #plot_activities()
 
 def plot_subjects():
+    import matplotlib.pyplot as plt
     uniques, s_num = np.unique(sub, return_inverse=True)
     print (uniques)
     plt.plot(s_num) 
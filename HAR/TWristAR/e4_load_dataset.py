@@ -39,11 +39,6 @@ from shutil import unpack_archive # to unzip
 import requests #for downloading zip file
 import numpy as np
 from tabulate import tabulate # for verbose tables, showing data
-import matplotlib.pyplot as plt
-from tensorflow.keras.utils import to_categorical # for one-hot encoding
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
 
 # use get_x_y_sub to get partially processed numpy arrays
 full_filename = my_path+os.path.join('/HAR/e4_wristband_Nov2019/'+'e4_get_x_y_sub.py')
@@ -79,6 +74,8 @@ def e4_load_dataset(
     #https://machinelearningmastery.com/how-to-one-hot-encode-sequence-data-in-python/
 
     if (one_hot_encode):
+        # sklearn is slow to import so only load it when encoding
+        from sklearn.preprocessing import LabelEncoder, OneHotEncoder
         # integer encode
         y_vector = np.ravel(y) #encoder won't take column vector
         le = LabelEncoder()
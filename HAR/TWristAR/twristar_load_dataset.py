@@ -54,8 +54,6 @@ from datetime import datetime, date
 import pandas as pd
 import numpy as np
 
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import OneHotEncoder
 
 def get_web_file(fname, url):
     """checks for local file, if none downloads from URL.    
@@ -102,10 +100,9 @@ all_channel_list = ['accel_x', 'accel_y', 'accel_z','accel_ttl','bvp','eda','p_t
 # frequency = 32 - unlike some of the other loaders this is hardcoded due to
 # the unique sample freqencies that differ between the individual e4 sensors
 
-# I don't think this gets called when using the loader - moving into the
-# load data method to be sure.
-# xforms.time_steps = 96 # three seconds at 32Hz
-# xforms.stride = 32 # one second step for each sliding window
+# sliding window parameters, passed to xforms rather than setting its globals
+window_cfg = dict(time_steps = 96, # three seconds at 32Hz
+                  stride = 32) # one second step for each sliding window
 
 # The label_map_<dataset> contains a mapping from strings to ints for all
 # possible labels in the entire dataset.   This allows for predictable conversion
@@ -247,35 +244,44 @@ if interactive:
     ir1_acc_df = process_e4_accel(ir1_acc_df)
     display(ir1_acc_df.head())
 
-def get_ir1_from_e4_dir():
+def get_ir1_from_e4_dir(channels = None):
     """processes the four e4 sensor files in global working directory into a 
-    single IR1 datetime indexed dataframe. Labeled columns are channels"""
+    single IR1 datetime indexed dataframe. Labeled columns are channels.
+    channels = list of all_channel_list entries, None = all.  ACC.csv is
+    always read since it sets the 32Hz time base, the BVP, EDA and TEMP files
+    are only read if one of their channels is requested.  Their joins add or
+    remove a few rows at the session edges so the IR1 of a channel subset
+    can be slightly shorter or longer than the full one."""
     # Note: IBI.csv is the inter-beat interval, a calculated value with a 
     # different format.  HR.csv is also calculated from BVP but format is same.
     # TODO:  Should check directory for all four files and uniform start/stop
     # times.
     # TODO: Might be better to use a different interpolation.  See
     # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.interpolate.html
+    source_channels, keep_channels = xforms.get_ir1_source_channels(channels, all_channel_list)
     ffname = working_dir + '/ACC.csv'
     col_labels = ['accel_x', 'accel_y', 'accel_z']
     ir1_acc_df = df_from_e4_csv(ffname, col_labels)
-    ir1_acc_df = process_e4_accel(ir1_acc_df)
-
-    ffname = working_dir + '/BVP.csv'
-    col_labels = ['bvp']
-    ir1_bvp_df = df_from_e4_csv(ffname, col_labels)
-
-    ffname = working_dir + '/EDA.csv'
-    col_labels = ['eda']
-    ir1_eda_df = df_from_e4_csv(ffname, col_labels)
-
-    ffname = working_dir + '/TEMP.csv'
-    col_labels = ['p_temp']
-    ir1_ptemp_df = df_from_e4_csv(ffname, col_labels)
-
-    ir1_df = ir1_acc_df.join(ir1_bvp_df, how="inner") # this drops bvp to 32Hz
-    ir1_df = ir1_df.join(ir1_eda_df, how="outer") # stays at 32Hz, eda fill NaN
-    ir1_df = ir1_df.join(ir1_ptemp_df, how="outer") # stays at 32Hz, p_temp fill NaN
+    ir1_df = process_e4_accel(ir1_acc_df)
+
+    if 'bvp' in source_channels:
+        ffname = working_dir + '/BVP.csv'
+        col_labels = ['bvp']
+        ir1_bvp_df = df_from_e4_csv(ffname, col_labels)
+        ir1_df = ir1_df.join(ir1_bvp_df, how="inner") # this drops bvp to 32Hz
+
+    if 'eda' in source_channels:
+        ffname = working_dir + '/EDA.csv'
+        col_labels = ['eda']
+        ir1_eda_df = df_from_e4_csv(ffname, col_labels)
+        ir1_df = ir1_df.join(ir1_eda_df, how="outer") # stays at 32Hz, eda fill NaN
+
+    if 'p_temp' in source_channels:
+        ffname = working_dir + '/TEMP.csv'
+        col_labels = ['p_temp']
+        ir1_ptemp_df = df_from_e4_csv(ffname, col_labels)
+        ir1_df = ir1_df.join(ir1_ptemp_df, how="outer") # stays at 32Hz, p_temp fill NaN
+    ir1_df = ir1_df[keep_channels] # drop the accel columns that weren't requested
     ir1_df = ir1_df.interpolate() # default is linear interpolation
     ir1_df = ir1_df.astype('float32') # no need for 64 precision with these sensors
     if verbose:
@@ -322,12 +328,11 @@ def label_df_from_csv (df, labels_ffname):
     # quick check to make sure all subjects are the same - only 1 sub per csv
     if (not (df_labels['sub'].eq(df_labels['sub'].iloc[0]).all())):
         print('Warning: Multiple subjects detected in csv, unusual for e4 data.')
-    df['label']='Undefined' # add column with safe value for labels
-    df['sub'] = np.NaN
-    for index, row in df_labels.iterrows():
-        #print(row['start'], row['finish'],row['label'])
-        df.loc[row['start']:row['finish'],'label'] = row['label']
-        df.loc[row['start']:row['finish'],'sub'] = row['sub']
+    # unlabeled rows get 'Undefined' and NaN sub, a later csv row wins
+    # where intervals overlap (same as applying the rows in order)
+    labels = xforms.get_interval_labels(df.index, df_labels, overlap = 'last')
+    df['label'] = labels['label']
+    df['sub'] = labels['sub']
     return df
 if interactive:
     labels_ffname = os.path.splitext(zip_ffname)[0] + '_labels.csv'
@@ -338,20 +343,37 @@ if interactive:
     print ("Label Counts - # samples before sliding window")
     print (ir1_df['label'].value_counts())
 
-def get_twristar_ir1_dict():
-    """reads the TWRistAR dataset and converts each "session file" to an IR1
-    dataframe.  The goal here is to capture and convert all raw data into
-    a 2D dataframe of rows = datetime index of each sample, columns = {channels,
-    label(s), subject_num}.  Additional methods may be used to drop channels,
-    and convert the string labels to mapped ints prior to switch to ndarrays.
-    Args:
-    none but uses global scripted (boolean):
-     True (default) returns scripted activity dataframes,
-     False returns unscripted activity dataframes.
-    Returns: a dict containing key = df_name and item = IR1 dataframes."""
-    # A few notes - TWRristAR (or more specifically e4 wristband datafiles)
-    # require a lot of processing, if trying to leverage from a more traditional
-    # .csv file format see Gesture Phase version.
+ir1_cache_version = '1' # change when the IR1 code below changes, see xforms.get_cached_ir1
+
+def get_twristar_session_ir1(zip_ffname, labels_ffname, channels = None):
+    """builds the IR1 dataframe for one TWristAR session zip file and the
+    matching labels csv file, called by get_twristar_ir1_dict.  Only
+    channels (None = all_channel_list) are read, see get_ir1_from_e4_dir"""
+    if not os.path.exists(working_dir):
+        os.makedirs(working_dir)
+    unzip_e4_file(zip_ffname)
+    df = get_ir1_from_e4_dir(channels)
+    if verbose:
+        print('Tag info (button presses) from tags.csv')
+        tag_ffname = working_dir + '/tags.csv'
+        show_e4_tag_time(tag_ffname)
+    df = label_df_from_csv (df, labels_ffname)
+    if verbose:
+        print ("Label Counts - # samples before sliding window\n",df['label'].value_counts())
+    # tighten up the column types for space savings.
+    # change to 32-bit, credit/ref https://stackoverflow.com/questions/69188132/how-to-convert-all-float64-columns-to-float32-in-pandas
+    # Select columns with 'float64' dtype  
+    float64_cols = list(df.select_dtypes(include='float64'))
+    # The same code again calling the columns
+    df[float64_cols] = df[float64_cols].astype('float32')
+    # Seems better to explicitly type the other columns vs object.
+    df['label']=df['label'].astype('category')
+    df['sub']=df['sub'].astype('category') # this is before convert to int
+    return df
+
+def get_twristar_session_files():
+    """Returns (root_fname, zip_ffname, labels_ffname) for each session of
+    the scripted or unscripted (global scripted) TWristAR recordings."""
     if scripted:
         fn_list = ['sub1/1574621345_A01F11.zip',
                     'sub1/1574622389_A01F11.zip',
@@ -365,37 +387,38 @@ def get_twristar_ir1_dict():
     else:
         fn_list = ['sub1/1574625540_A01F11.zip',
                     'sub2/1633111849_A01F11.zip']
-    get_TWristAR()
-    ir1_df_dict = dict() # an empty dictionary
+    session_files = []
     for item in fn_list:
         zip_ffname = os.path.join(my_dir,'TWristAR',item)
-        if verbose:
-            print('Processing ', zip_ffname)
-        if not os.path.exists(working_dir):
-            os.makedirs(working_dir)
-        unzip_e4_file(zip_ffname)
-        df = get_ir1_from_e4_dir()
-        if verbose:
-            print('Tag info (button presses) from tags.csv')
-            tag_ffname = working_dir + '/tags.csv'
-            show_e4_tag_time(tag_ffname)
         # Generate associated csv filename, forces the long numbered filenames to match
         labels_ffname = os.path.splitext(zip_ffname)[0] + '_labels.csv'
-        df = label_df_from_csv (df, labels_ffname)
-        df['label'].value_counts()
-        if verbose:
-            print ("Label Counts - # samples before sliding window\n",df['label'].value_counts())
-        # tighten up the column types for space savings.
-        # change to 32-bit, credit/ref https://stackoverflow.com/questions/69188132/how-to-convert-all-float64-columns-to-float32-in-pandas
-        # Select columns with 'float64' dtype  
-        float64_cols = list(df.select_dtypes(include='float64'))
-        # The same code again calling the columns
-        df[float64_cols] = df[float64_cols].astype('float32')
-        # Seems better to explicitly type the other columns vs object.
-        df['label']=df['label'].astype('category')
-        df['sub']=df['sub'].astype('category') # this is before convert to int
-
         root_fname = (item.split('/')[1].split('.')[0]) # between / and .
+        session_files.append((root_fname, zip_ffname, labels_ffname))
+    return session_files
+
+def get_twristar_ir1_dict(channels = None):
+    """reads the TWRistAR dataset and converts each "session file" to an IR1
+    dataframe.  The goal here is to capture and convert all raw data into
+    a 2D dataframe of rows = datetime index of each sample, columns = {channels,
+    label(s), subject_num}.  Additional methods may be used to drop channels,
+    and convert the string labels to mapped ints prior to switch to ndarrays.
+    Args:
+    channels = list of all_channel_list entries to read, None = all
+    also uses global scripted (boolean):
+     True (default) returns scripted activity dataframes,
+     False returns unscripted activity dataframes.
+    Returns: a dict containing key = df_name and item = IR1 dataframes."""
+    # A few notes - TWRristAR (or more specifically e4 wristband datafiles)
+    # require a lot of processing, if trying to leverage from a more traditional
+    # .csv file format see Gesture Phase version.
+    get_TWristAR()
+    ir1_df_dict = dict() # an empty dictionary
+    for root_fname, zip_ffname, labels_ffname in get_twristar_session_files():
+        if verbose:
+            print('Processing ', zip_ffname)
+        df = xforms.get_cached_ir1(root_fname, [zip_ffname, labels_ffname],
+                                   ir1_cache_version, get_twristar_session_ir1,
+                                   zip_ffname, labels_ffname, channels)
         ir1_df_dict[root_fname]=df # key is root name in the file
     return ir1_df_dict
 if interactive:
@@ -416,17 +439,37 @@ if interactive:
 
 """# The dataset specific code to generate the dictionary of IR1 dataframes is complete.  Now use Shared Transforms to generate the final output arrays."""
 
+def get_twristar_ir3(store_dir, label_method, assembly = 'prealloc', executor = 'serial',
+                     window_cfg = window_cfg, channels = None):
+    """builds the IR3 for all subjects, called by xforms.get_cached_ir3 when
+    the IR3 is not in the cache.  Only channels (None = all) are read.
+    Returns X, y, sub, ss_times, channel_list"""
+    ir1_dict = get_twristar_ir1_dict(channels)
+    if assembly != 'prealloc':
+        store_dir = None # only prealloc can write the store, saved after
+    X, y, sub, ss_times, xys_info = xforms.get_ir3_from_dict(ir1_dict, 
+                                                            label_map = label_map_twristar,
+                                                            label_method = label_method,
+                                                            assembly = assembly,
+                                                            store_dir = store_dir,
+                                                            executor = executor,
+                                                            window_cfg = window_cfg)
+    channel_list = [ch for ch in all_channel_list if channels is None or ch in channels]
+    return X, y, sub, ss_times, channel_list
+
 def twristar_load_dataset(
     incl_val_group = False, # split train into train and validate
-    keep_channel_list = ['accel_ttl'],
+    keep_channel_list = ['accel_ttl'], # only these are read from the e4 files
     one_hot_encode = False, # make y into multi-column one-hot, one for each activity
-    suppress_warn = False # special case for stratified warning
+    suppress_warn = False, # special case for stratified warning
+    ir3_assembly = 'prealloc', # or 'vstack', see xforms.get_ir3_from_dict
+    ir3_executor = 'serial', # 'thread' or 'process' to window sessions in parallel
+    ir3_store_dir = None # IR3 cache directory, None = xforms.ir3_cache_dir (None = off)
     ):
     """Downloads the TWristAR dataset from Zenodo, processes the data, and
     returns arrays by separating into _train, _validate, and _test arrays for
-    X and y based on split_sub dictionary."""
-    xforms.time_steps = 96 # three seconds at 32Hz
-    xforms.stride = 32 # one second step for each sliding window
+    X and y based on split_sub dictionary.  The IR1 and IR3 are only cached
+    if xforms.ir1_cache_dir / ir3_store_dir (or xforms.ir3_cache_dir) are set."""
     global log_info
     log_info = "Generated by TWristAR_load_data.ipynb\n"
     today = date.today()
@@ -436,37 +479,42 @@ def twristar_load_dataset(
         label_xform = 'drop' # for scripted activities used to train drop mixed
     else:
         label_xform = 'mode' # for unscripted assign mode label to every window 
-    ir1_dict = get_twristar_ir1_dict()
-    X, y, sub, ss_times, xys_info = xforms.get_ir3_from_dict(ir1_dict, 
-                                                            label_map = label_map_twristar,
-                                                            label_method = label_xform) 
-    # Drop unwanted channels from X
+    # everything that changes the IR3, the subject split is done afterwards
+    # so it is not part of the cache key
+    ir3_params = dict(dataset = 'TWristAR', scripted = scripted,
+                      time_steps = window_cfg['time_steps'], stride = window_cfg['stride'],
+                      resample = None, label_method = label_xform,
+                      label_map = label_map_twristar, drop_labels = [99],
+                      channels = keep_channel_list, ir1_version = ir1_cache_version)
+    source_files = [ffname for root_fname, zip_ffname, labels_ffname in get_twristar_session_files()
+                    for ffname in (zip_ffname, labels_ffname)]
+    X, y, sub, ss_times, cache_info = xforms.get_cached_ir3(ir3_params, get_twristar_ir3,
+                                                            label_xform, ir3_assembly, ir3_executor,
+                                                            window_cfg, keep_channel_list,
+                                                            cache_dir = ir3_store_dir,
+                                                            source_files = source_files)
+    log_info += cache_info
     log_info += "Keeping channels" + str(keep_channel_list) + "\n"
-    X = xforms.limit_channel_ir3(X, all_channel_list = all_channel_list, keep_channel_list = keep_channel_list)
+    # the IR3 channels are in all_channel_list order, reorder if needed
+    ir3_channel_list = [ch for ch in all_channel_list if ch in keep_channel_list]
+    if ir3_channel_list != list(keep_channel_list):
+        X = xforms.limit_channel_ir3(X, all_channel_list = ir3_channel_list, keep_channel_list = keep_channel_list)
     # write initial array info to log_info
     log_info += "Initial Arrays\n"
     log_info += utils.tabulate_numpy_arrays({'X':X,'y':y,'sub':sub,'ss_times':ss_times})+'\n'
 
     if (one_hot_encode):
-        # tried to specify list to make sure all possible classes are encoded
-        # label_list = list(label_map_twristar['label'].keys())
-        # then pass categories=label_list but this does not work because the
-        # list is longer than the classes due to the inclusion of undefined.
-        # Note sparse was changed to sparse_output but that fails on my Mac
-        enc = OneHotEncoder(categories='auto', sparse=False)
-        y = enc.fit_transform(y)
-        y=y.astype('uint8')
-        # print(enc.categories_)
-        log_info += "y has been one hot encoded" + str(enc.categories_) + '\n'
+        # the classes come from the label map (Undefined is dropped) so the
+        # columns are the same even if a class is missing from y
+        y = xforms.one_hot_encode_labels(y, label_map = label_map_twristar)
+        log_info += "y has been one hot encoded" + str(xforms.get_one_hot_classes(label_map_twristar)) + '\n'
 
     sub_num = np.ravel(sub[ : , 0] ) # convert shape to (1047,)
     # this code is different from typical due to limited subjects,
     # all not test subjects data is placed into train which is then 
     # split using stratification - validation group is not sub independent
     train_index = np.nonzero(np.isin(sub_num, subj_alloc_dict['train_subj'] + 
-                                        subj_alloc_dict['valid_subj']))
-    x_train = X[train_index]
-    y_train = y[train_index]
+                                        subj_alloc_dict['valid_subj']))[0]
     if (incl_val_group):
         if not suppress_warn:
             print("Warning: Due to limited subjects the validation group is a stratified")
@@ -478,7 +526,19 @@ def twristar_load_dataset(
         # activities for inclusion in validation.  See
         # https://github.com/imics-lab/Semi-Supervised-HAR-e4-Wristband
         # https://scikit-learn.org/stable/modules/generated/sklearn.model_selection.train_test_split.html
-        x_train, x_valid, y_train, y_valid = train_test_split(x_train, y_train, test_size=0.10, random_state=42, stratify=y_train)
+        # the split is done on the indices so X is only copied once into each group
+        # Note: this split is not the one train_test_split(random_state = 42)
+        # gave before, the same seed picks different windows (numpy Generator
+        # permutation per class, not sklearn's StratifiedShuffleSplit) and the
+        # arrays stay in time order instead of being shuffled.  Class
+        # proportions are the same, earlier validation scores are not directly
+        # comparable.
+        train_index, valid_index = xforms.get_stratified_split_index(
+            xforms.get_class_index(y, train_index), test_size = 0.10, seed = 42)
+        x_valid = X[valid_index]
+        y_valid = y[valid_index]
+    x_train = X[train_index]
+    y_train = y[train_index]
 
     test_index = np.nonzero(np.isin(sub_num, subj_alloc_dict['test_subj']))
     x_test = X[test_index]
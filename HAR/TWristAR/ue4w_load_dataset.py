@@ -27,18 +27,24 @@ import shutil #https://docs.python.org/3/library/shutil.html
 from shutil import unpack_archive # to unzip
 #from shutil import make_archive # to create zip for storage
 import requests #for downloading zip file
-from scipy import io #for loadmat, matlab conversion
 import time
 import pandas as pd
 import numpy as np
 from numpy import savetxt
-import matplotlib.pyplot as plt # for plotting - pandas uses matplotlib
-from tabulate import tabulate # for g_verbose tables
+# tabulate (verbose tables) is imported by the cells using it, keeps the import light
 from time import gmtime, strftime, localtime #for displaying Linux UTC timestamps in hh:mm:ss
 from datetime import datetime
 from datetime import timedelta
 import urllib.request # to get files from web w/o !wget
 
+# shared transforms, only used here to save the arrays as an IR3 store
+try:
+    import load_data_transforms as xforms
+except:
+    urllib.request.urlretrieve('https://raw.githubusercontent.com/imics-lab/load_data_time_series/main/load_data_transforms.py',
+                               filename = 'load_data_transforms.py')
+    import load_data_transforms as xforms
+
 my_dir = "." # replace with absolute path if desired
 zip_baseURL = 'https://zenodo.org/record/6898244/files'
 interactive = True # change to True if you want to run each cell function
@@ -297,6 +303,7 @@ if interactive:
             ("my_y:", my_y.shape ,type(my_y), my_y.dtype),
             ("my_sub:", my_sub.shape, type(my_sub), my_sub.dtype)]
     print("IR2 array info")
+    from tabulate import tabulate
     print(tabulate(mydata, headers=headers))
     print("Returned all_channel_list", all_channel_list)
 
@@ -364,6 +371,7 @@ def ue4w_load_dataset(
 """# Main Function"""
 
 if __name__ == "__main__":
+    from tabulate import tabulate
     # Test the defaults
     X, y, sub, ch_list = ue4w_load_dataset()
     headers = ("Array","shape", "data type")
@@ -383,7 +391,8 @@ if __name__ == "__main__":
     print("\n",tabulate(mydata, headers=headers))
     print("Channels:", ch_list)
 
-# run this cell to save the numpy arrays
+# run this cell to save the numpy arrays as an IR3 store (X.npy, y.npy, sub.npy
+# plus manifest.json), reload with xforms.load_ir3_store(my_dir)
 if interactive:  
     readme = 'Unlabeled data from UE4W Repository, three files\n'
     readme += 'this version for fusion learned reps paper.\n'
@@ -397,9 +406,7 @@ if interactive:
 
     with open(my_dir+'/README.txt', "w") as file_object:
         file_object.write(readme)
-    np.save(my_dir + '/'+'X.npy',X)
-    np.save(my_dir + '/'+'y.npy',y)
-    np.save(my_dir + '/'+'sub.npy',sub)
+    xforms.save_ir3_store(my_dir, X, y, sub, channel_list = ch_list, info = readme)
 
 """# Example code that can be used to call this function when saved as .py"""
 
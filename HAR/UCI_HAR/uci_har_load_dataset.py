@@ -38,9 +38,7 @@ import shutil #https://docs.python.org/3/library/shutil.html
 from shutil import unpack_archive # to unzip
 import requests #for downloading zip file
 import numpy as np
-from tabulate import tabulate # for verbose tables, showing data
-from tensorflow.keras.utils import to_categorical # for one-hot encoding
-from sklearn.model_selection import train_test_split
+# tabulate (verbose tables) is imported by the functions using it, keeps the import light
 
 #credit https://stackoverflow.com/questions/9419162/download-returned-zip-file-from-url
 #many other methods I tried failed to download the file properly
@@ -51,6 +49,14 @@ def download_url(url, save_path, chunk_size=128):
         for chunk in r.iter_content(chunk_size=chunk_size):
             fd.write(chunk)
 
+# shared transform (xforms) functions from IMICS Public Repo, used for one-hot
+try:
+    import load_data_transforms as xforms
+except:
+    download_url('https://raw.githubusercontent.com/imics-lab/load_data_time_series/main/load_data_transforms.py',
+                 'load_data_transforms.py')
+    import load_data_transforms as xforms
+
 def uci_har_load_dataset(
     verbose = True,
     incl_xyz_accel = False, #include component accel_x/y/z in ____X data
@@ -59,6 +65,7 @@ def uci_har_load_dataset(
     one_hot_encode = True
     ):
     """processes UCI HAR zip file into numpy arrays, returns x_train, y_train, x_test, y_test"""
+    from tabulate import tabulate
     #Download and unzip original dataset
     if (not os.path.isfile('./UCI_HAR_Dataset.zip')):
         print("Downloading UCI_HAR_Dataset.zip file")
@@ -95,13 +102,14 @@ def uci_har_load_dataset(
     if (one_hot_encode):
         y_train = y_train - 1 #original was 1 - 6
         y_test = y_test -1
-        y_train = to_categorical(y_train, num_classes=6)
-        y_test = to_categorical(y_test, num_classes=6)
+        y_train = xforms.one_hot_encode_labels(y_train, num_classes=6)
+        y_test = xforms.one_hot_encode_labels(y_test, num_classes=6)
 
     if (incl_val_group):
         print('\nWarning: UCI HAR is already split into train/test')
         print('The validation group is generated using sklearn stratify on train')
         print('It is not subject independent - confirm accuracy with test set')
+        from sklearn.model_selection import train_test_split # slow import
         x_train, x_validation, y_train, y_validation = train_test_split(x_train, y_train, test_size=0.25, random_state=42, stratify=y_train)
         return x_train, y_train, x_validation, y_validation, x_test, y_test
     else:
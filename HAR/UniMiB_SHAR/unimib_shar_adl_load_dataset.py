@@ -42,12 +42,10 @@ import shutil #https://docs.python.org/3/library/shutil.html
 from shutil import unpack_archive # to unzip
 #from shutil import make_archive # to create zip for storage
 import requests #for downloading zip file
-from scipy import io #for loadmat, matlab conversion
 import pandas as pd
 import numpy as np
 #import matplotlib.pyplot as plt # for plotting - pandas uses matplotlib
-from tabulate import tabulate # for verbose tables
-from tensorflow.keras.utils import to_categorical # for one-hot encoding
+# tabulate (verbose tables) is imported by the functions using it, keeps the import light
 
 #credit https://stackoverflow.com/questions/9419162/download-returned-zip-file-from-url
 #many other methods I tried failed to download the file properly
@@ -57,6 +55,14 @@ def download_url(url, save_path, chunk_size=128):
         for chunk in r.iter_content(chunk_size=chunk_size):
             fd.write(chunk)
 
+# shared transform (xforms) functions from IMICS Public Repo, used for one-hot
+try:
+    import load_data_transforms as xforms
+except:
+    download_url('https://raw.githubusercontent.com/imics-lab/load_data_time_series/main/load_data_transforms.py',
+                 'load_data_transforms.py')
+    import load_data_transforms as xforms
+
 def unimib_load_dataset(
     verbose = True,
     incl_xyz_accel = False, #include component accel_x/y/z in ____X data
@@ -68,6 +74,7 @@ def unimib_load_dataset(
                 validation_subj = [1,9,16,23,25,28],
                 test_subj = [2,3,13,17,18,30]),
     one_hot_encode = True):
+    from tabulate import tabulate
     #Download and unzip original dataset
     if (not os.path.isfile('./UniMiB-SHAR.zip')):
         print("Downloading UniMiB-SHAR.zip file")
@@ -80,6 +87,7 @@ def unimib_load_dataset(
     #Convert .mat files to numpy ndarrays
     path_in = './UniMiB-SHAR/data'
     #loadmat loads matlab files as dictionary, keys: header, version, globals, data
+    from scipy import io # slow import, only needed for the .mat conversion
     adl_data = io.loadmat(path_in + '/adl_data.mat')['adl_data']
     adl_names = io.loadmat(path_in + '/adl_names.mat', chars_as_strings=True)['adl_names']
     adl_labels = io.loadmat(path_in + '/adl_labels.mat')['adl_labels']
@@ -137,14 +145,13 @@ def unimib_load_dataset(
         if (incl_val_group):
             print("x/y_validation shape ",x_validation.shape,y_validation.shape)
         print("x/y_test shape  ",x_test.shape,y_test.shape)
-    #If selected one-hot encode y_* using keras to_categorical, reference:
-    #https://keras.io/api/utils/python_utils/#to_categorical-function and
-    #https://machinelearningmastery.com/how-to-one-hot-encode-sequence-data-in-python/
+    #If selected one-hot encode y_* (uint8) using the shared xforms encoder,
+    #the 9 ADL classes are 0 indexed so this matches keras to_categorical
     if (one_hot_encode):
-        y_train = to_categorical(y_train, num_classes=9)
+        y_train = xforms.one_hot_encode_labels(y_train, num_classes=9)
         if (incl_val_group):
-            y_validation = to_categorical(y_validation, num_classes=9)
-        y_test = to_categorical(y_test, num_classes=9)
+            y_validation = xforms.one_hot_encode_labels(y_validation, num_classes=9)
+        y_test = xforms.one_hot_encode_labels(y_test, num_classes=9)
         if (verbose):
             print("After one-hot encoding")
             print("x/y_train shape ",x_train.shape,y_train.shape)
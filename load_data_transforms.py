@@ -19,7 +19,6 @@ Set interactive to true to run the Jupyter Notebook version.  Note most of the c
 TODO:
 * This is in-progress - current focus is on the Gesture dataset so testing will need to be done with the others.
 * Issue with !gdown not running in a function is a pain.
-* assign_ints_ir1_labels() seems to still return an int64 instead of int8
 * get_ir2_from_ir1(df) only handles a single 'label' column, needs update based on the keys in the label_map dict.  Sub column is also hardcoded in this function, should at least check for 'sub' and 'subject'
 * Same basic issue for get_ir2_y_string_labels(), it needs to be updated to handle multilabel cases.
 * Needs at least a basic _init_ unit test to be able to generate some output when checking as a .py
@@ -29,25 +28,32 @@ import os
 import shutil #https://docs.python.org/3/library/shutil.html
 from shutil import unpack_archive # to unzip
 import time
+import json # for the IR3 store manifest
+import hashlib # for the IR1 cache keys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+import threading # for the prefetching batch iterator
+import queue
+import heapq # for the interval labeling sweep
 import pandas as pd
 import numpy as np
 from numpy import savetxt
-from tabulate import tabulate # for verbose tables, showing data
-from tensorflow.keras.utils import to_categorical # for one-hot encoding
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
 from time import gmtime, strftime, localtime #for displaying Linux UTC timestamps in hh:mm:ss
 from datetime import datetime, date
-import urllib.request # to get files from web w/o !wget
-import matplotlib.pyplot as plt
-from scipy import stats as st # for assigning labels as mode of sliding window
+# Only numpy and pandas are imported here so the windowing and label paths
+# stay fast to import on workers, tabulate and scipy are imported on first
+# use.  See load_data_utils.check_import_budget.
 
 """# Global Parameters"""
 
 # environment and execution parameters
 my_dir = '.' # replace with absolute path if desired
 dataset_dir = os.path.join(my_dir,'gesture_phase_dataset') # Where dataset will be unzipped
+# The caches write to disk so they are opt-in, e.g. to enable both:
+# ir1_cache_dir = os.path.join(my_dir,'ir1_cache') # see get_cached_ir1
+# ir3_cache_dir = os.path.join(my_dir,'ir3_cache') # see get_cached_ir3
+ir1_cache_dir = None # None = no IR1 cache
+ir3_cache_dir = None # None = no IR3 cache
 
 interactive = True # for exploring data and functions interactively
 verbose = True
@@ -59,10 +65,11 @@ verbose = True
 time_steps = 32 
 stride = 8
 
-# example of how to load these transforms and set params in loader:
+# The globals are only the defaults, loaders should pass their own
+# window_cfg dict so several datasets / window sizes can be built at once:
 # import load_data_transforms as xform
-# xform.time_steps = 96 # three seconds at 32Hz
-# xform.stride = 32 # one second step for each sliding window
+# window_cfg = dict(time_steps = 96, stride = 32) # 3 seconds, 1 second step at 32Hz
+# X, y, sub, ss_times, xys_info = xform.get_ir3_from_dict(..., window_cfg = window_cfg)
 
 interactive = False # don't run if interactive, automatically runs for .py version
 verbose = False # to limit the called functions output, overwrite per above
@@ -106,6 +113,63 @@ def tabulate_numpy_arrays(dict_name_npy):
 Much of the conversion from raw data and/or csv files to IR1 is dataset unique but there are several IR1 transforms that are useful for multiple datasets and plotting etc.
 """
 
+def encode_labels(values, mapping, unknown = 99):
+    """Converts label values to the ints in mapping with a lookup table.
+    The values are factorized (categorical codes are used directly) so
+    mapping is only consulted once per distinct value, the table is then
+    applied to every row with np.take.
+    Args:
+        values - array-like or Series of labels, strings or ints
+        mapping - dict key = label, item = int, e.g. label_map['label']
+        unknown - int for labels that are not in mapping (and NaN), numeric
+            labels that are not in mapping are kept as is if they are
+            whole numbers that fit in int8, otherwise they are unknown too
+    Returns:
+        ndarray of int8"""
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    numeric = pd.api.types.is_numeric_dtype(uniques.dtype)
+    lut = np.empty(len(uniques) + 1, dtype = 'int8') # last entry is for NaN
+    missing = []
+    for i, value in enumerate(uniques):
+        if value in mapping:
+            lut[i] = mapping[value]
+        elif numeric and value == int(value) and -128 <= value <= 127:
+            lut[i] = value
+        else:
+            lut[i] = unknown
+            missing.append(value)
+    lut[-1] = unknown # factorize codes NaN as -1
+    if len(missing) > 0 or (codes < 0).any():
+        print("WARNING: labels not in mapping set to", unknown, missing)
+    return np.take(lut, codes)
+
+def decode_labels(labels, mapping):
+    """The reverse of encode_labels without building an array of strings.
+    Args:
+        labels - ndarray of int labels, any shape
+        mapping - dict key = label string, item = int, e.g. label_map['label']
+    Returns:
+        codes - ndarray of int16 same shape as labels, index into names,
+            -1 for ints not in mapping
+        names - list of the label strings ordered by their int value.
+        pd.Categorical.from_codes(codes.ravel(), names) or np.array(names)[codes]
+        convert to strings when needed."""
+    names = sorted(mapping, key = mapping.get)
+    int_labels = np.array([mapping[name] for name in names], dtype = 'int64')
+    offset = min(0, int(int_labels.min()))
+    lut = np.full(int(int_labels.max()) - offset + 2, -1, dtype = 'int16') # last entry = out of range
+    lut[int_labels - offset] = np.arange(len(names))
+    idx = np.asarray(labels).astype('int64') - offset
+    idx[(idx < 0) | (idx >= lut.shape[0] - 1)] = lut.shape[0] - 1
+    return np.take(lut, idx), names
+if interactive:
+    my_codes, my_names = decode_labels(encode_labels(['Hold', 'Rest', 'Stroke'], {"Rest": 0, "Stroke": 2, "Hold": 3}),
+                                       {"Rest": 0, "Stroke": 2, "Hold": 3})
+    print("codes", my_codes, "names", my_names)
+
 def assign_ints_ir1_labels(df, label_mapping_dict):
     """Uses the mapping in the passed dictionary to assign integers to each
     string value predictably.  This is important because all labels may not
@@ -125,14 +189,14 @@ def assign_ints_ir1_labels(df, label_mapping_dict):
     # numpy arrays - not an issue for small datasets but a big memory user
     # for larger ones.
     # Credit to this nice writeup https://pbpython.com/categorical-encoding.html
+    # replace() on 10M row frames was slow, encode_labels uses a lookup table.
     if verbose:
         print("assign_ints_ir1_labels() converting categorical strings to ints")
     for label_name in label_mapping_dict: 
         if verbose:  
             print("df["+label_name+"] value counts before")
             print(df[label_name].value_counts())
-        df[label_name] = df[label_name].replace(label_mapping_dict[label_name])
-        df[label_name]=df[label_name].astype('int8') # force smaller type
+        df[label_name] = encode_labels(df[label_name], label_mapping_dict[label_name])
         if verbose:
             print("df["+label_name+"] value counts after")
             print(df[label_name].value_counts())
@@ -153,20 +217,15 @@ def convert_ir1_labels_to_strings(df,label_map):
         label_map - dict with key = string, item = cooresponding int 
     returns:
         df - with categorical string labels"""
-    # this seems to work but only when run once?   Needs to be checked and
-    # moved to xforms notebook
-    str_to_key_dict = label_map['label']
-    key_to_str_dict = dict([(value, key) for key, value in str_to_key_dict.items()])
-    
+    # the categories are all of the labels in label_map, ints that are not
+    # in the map become NaN
     if verbose:
-        "Converting integer encoded labels to strings"
-        print(str_to_key_dict)
-        print(key_to_str_dict)
+        print("Converting integer encoded labels to strings", label_map['label'])
         print("Labels and counts before conversion")
         print(df['label'].value_counts())
 
-    df['label'] = df['label'].map(key_to_str_dict)
-    df['label'] = df['label'].astype('category')
+    codes, names = decode_labels(df['label'].to_numpy(), label_map['label'])
+    df['label'] = pd.Categorical.from_codes(codes, names)
 
     if verbose:
         print("Labels and counts after conversion")
@@ -177,30 +236,207 @@ if interactive:
     df_string = convert_ir1_labels_to_strings(df = ir1_df, label_map = label_map_gps)
     df_string.info()
 
-def to_fixed_ir1_timedelta(df_in, new_time_step='50ms'):
-    """resamples an IR1 dataframe to new_time_step.  Labels must be int not
-    categorical strings.  Will  return NaN per resample method (happens on
-    irregular samples). 'label' and 'sub' columns resample to floats and are
-    typed back to int16
+def fill_ir1_nan_linear(X, fill_limit = None):
+    """Linear interpolation of NaN along axis 0 for each column of X, in
+    place.  Same as pandas interpolate(limit = fill_limit): leading NaN are
+    kept, trailing NaN repeat the last value, at most fill_limit consecutive
+    NaN are filled in each gap.  Returns the number of entries filled."""
+    num_filled = 0
+    positions = np.arange(X.shape[0])
+    for col in np.flatnonzero(np.isnan(X).any(axis = 0)): # usually all or none
+        valid = np.flatnonzero(~np.isnan(X[:, col]))
+        if valid.shape[0] == 0:
+            continue
+        fill = np.isnan(X[:, col])
+        fill[:valid[0]] = False # nothing to interpolate from
+        if fill_limit is not None:
+            # distance back to the last valid sample
+            prev_valid = valid[np.maximum(np.searchsorted(valid, positions) - 1, 0)]
+            fill &= (positions - prev_valid) <= fill_limit
+        X[fill, col] = np.interp(positions[fill], valid, X[valid, col])
+        num_filled += np.count_nonzero(fill)
+    return num_filled
+
+def resample_ir1_fixed(df, new_time_step = '50ms', channel_method = 'mean',
+                       label_method = 'nearest', fill_limit = None):
+    """Resamples an IR1 dataframe onto a fixed rate grid using int64
+    nanosecond timestamps and searchsorted instead of pandas resample.
+    Channels are processed all at once, 'label', 'sub' and any non-numeric
+    columns are taken from a single source sample so they are never averaged
+    into a different class.  The grid is the same as pandas resample (bins
+    aligned to midnight, labelled by the bin start).
+    Args:
+        df - IR1 dataframe, the datetime index must be sorted
+        new_time_step - pandas compatible time string e.g. '50ms'
+        channel_method - 'mean' average of the samples in each bin, same as
+            resample().mean(), use for downsampling.
+            'interp' linear interpolation at the bin start, use for
+            upsampling or to correct jitter at the same rate.
+        label_method - 'nearest' sample to the bin start or 'previous' sample
+            at or before the bin start
+        fill_limit - None or max number of consecutive empty bins filled by
+            linear interpolation ('mean' only), same as interpolate(limit = )
+    Returns:
+        resampled dataframe and a dict of counts: orig_rows, new_rows,
+        filled (bins without a source sample), dropped (source samples that
+        did not get their own row, averaged or skipped)"""
+    if channel_method not in ('mean', 'interp'):
+        raise ValueError("resample_ir1_fixed channel_method must be 'mean' or 'interp', got "
+                         + repr(channel_method))
+    if label_method not in ('nearest', 'previous'):
+        raise ValueError("resample_ir1_fixed label_method must be 'nearest' or 'previous', got "
+                         + repr(label_method))
+    step = pd.Timedelta(new_time_step).value
+    times = df.index.to_numpy(dtype = 'datetime64[ns]').view('int64')
+    day = pd.Timedelta('1D').value
+    origin = times[0] - times[0] % day # pandas default origin = 'start_day'
+    first = origin + (times[0] - origin) // step * step
+    src_bins = (times - first) // step
+    num_rows = int(src_bins[-1]) + 1
+    grid = first + np.arange(num_rows, dtype = 'int64') * step
+    label_cols = [col for col in df.columns if col in ('label', 'sub')
+                  or not pd.api.types.is_numeric_dtype(df[col])]
+    channel_cols = [col for col in df.columns if col not in label_cols]
+    X = df[channel_cols].to_numpy()
+    out_dtype = X.dtype if X.dtype.kind == 'f' else np.dtype('float64')
+    # first source sample of each occupied bin
+    bin_starts = np.flatnonzero(np.diff(src_bins, prepend = -1))
+    occupied = np.zeros(num_rows, dtype = bool)
+    occupied[src_bins[bin_starts]] = True
+    if channel_method == 'mean':
+        # channels as rows so reduceat runs over contiguous memory
+        X_t = np.ascontiguousarray(X.T, dtype = 'float64')
+        isnan = np.isnan(X_t)
+        if isnan.any():
+            X_t[isnan] = 0
+            counts = np.add.reduceat(~isnan, bin_starts, axis = 1).T
+        else:
+            counts = np.diff(bin_starts, append = len(times))[:, np.newaxis]
+        sums = np.add.reduceat(X_t, bin_starts, axis = 1).T
+        del X_t, isnan
+        new_X = np.full((num_rows, len(channel_cols)), np.nan, dtype = out_dtype)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            new_X[src_bins[bin_starts]] = sums / counts # 0/0 = NaN like mean
+        fill_ir1_nan_linear(new_X, fill_limit)
+    else:
+        # weights between the samples either side of each grid time
+        right = np.clip(np.searchsorted(times, grid), 1, len(times) - 1)
+        left = right - 1
+        span = (times[right] - times[left]).astype('float64')
+        span[span == 0] = 1 # duplicate timestamps
+        w = np.clip((grid - times[left]) / span, 0, 1)[:, np.newaxis]
+        new_X = (X[left] * (1 - w) + X[right] * w).astype(out_dtype)
+    # label and sub come from one source sample, no averaging
+    if label_method == 'previous':
+        src_idx = np.maximum(np.searchsorted(times, grid, side = 'right') - 1, 0)
+    else:
+        right = np.minimum(np.searchsorted(times, grid), len(times) - 1)
+        left = np.maximum(right - 1, 0)
+        src_idx = np.where(grid - times[left] <= times[right] - grid, left, right)
+    df_out = pd.DataFrame(new_X, columns = channel_cols,
+                          index = pd.DatetimeIndex(grid.view('datetime64[ns]'), name = df.index.name))
+    for col in label_cols:
+        df_out[col] = df[col].to_numpy()[src_idx]
+    df_out = df_out[list(df.columns)] # original column order
+    report = {'orig_rows': len(times), 'new_rows': num_rows,
+              'filled': int(num_rows - np.count_nonzero(occupied)),
+              'dropped': int(len(times) - bin_starts.shape[0])}
+    return df_out, report
+
+def to_fixed_ir1_timedelta(df_in, new_time_step='50ms', channel_method = 'mean',
+                           label_method = 'nearest'):
+    """resamples an IR1 dataframe to new_time_step.  Will return NaN only for
+    leading samples that can not be interpolated.  'label' and 'sub' columns
+    are copied from the nearest (or previous) sample and keep their dtype.
     args:
         df_in - an IR1 format dataframe
         new_time_step - string of pandas compatible times e.g. '50ms'
+        channel_method, label_method - see resample_ir1_fixed
     returns:
         resampled pandas dataframe
-    Note this has only been tested as a downsample.  Also if the same sample
-    rate is given it can be used to 'correct' sample jitter in phone data"""
-    orig_rows = len(df_in.index)
-    df_out = df_in.resample(new_time_step).mean()
-    df_out = df_out.interpolate() #linear interpolation for nan
-    df_out['label'] = df_out['label'].astype(np.int8) # change from float to int
-    df_out['sub'] = df_out['sub'].astype(np.int8) # change from float to int
+    Note 'mean' is for downsampling.  'interp' at the same sample rate can
+    be used to 'correct' sample jitter in phone data"""
+    df_out, report = resample_ir1_fixed(df_in, new_time_step, channel_method, label_method)
     if verbose:
-        print("Resampled at ",new_time_step,": Original/New # rows = ",orig_rows,len(df_out.index))
+        print("Resampled at ",new_time_step,": Original/New # rows = ",report['orig_rows'],report['new_rows'],
+              "filled",report['filled'],"dropped",report['dropped'])
     return df_out
 if interactive:
     df_temp = to_fixed_ir1_timedelta(ir1_df,new_time_step='20ms')
     df_temp.info()
 
+def get_decimation_filter(factor, num_taps = None):
+    """Returns the taps of a linear phase low pass FIR (Hamming windowed sinc,
+    same design as scipy.signal.decimate) with the cutoff at the new Nyquist
+    frequency.  num_taps defaults to 20 * factor + 1, must be odd so the
+    filter delay is a whole number of samples."""
+    if num_taps is None:
+        num_taps = 20 * factor + 1
+    if num_taps % 2 == 0:
+        print("WARNING: get_decimation_filter num_taps must be odd, using", num_taps + 1)
+        num_taps += 1
+    n = np.arange(num_taps) - (num_taps - 1) // 2
+    taps = np.sinc(n / factor) * np.hamming(num_taps)
+    return taps / taps.sum() # unity gain at DC
+
+def decimate_ir1_arrays(X, factor, taps = None, chunk_rows = 1000000):
+    """Anti-aliased replacement for X[::factor].  Low pass filters all
+    channels and keeps every factor-th sample, polyphase style: each tap
+    reads a strided slice of the input so only the kept outputs are ever
+    computed.  Processed chunk_rows output rows at a time so multi-hour
+    recordings only need the output array plus one chunk.
+    Args:
+        X - ndarray shape (samples, channels), a 1D array is treated as one channel
+        factor - int decimation factor, e.g. 2 for 200Hz to 100Hz
+        taps - FIR taps, None = get_decimation_filter(factor)
+        chunk_rows - output rows per chunk
+    Returns:
+        ndarray shape (ceil(samples / factor), channels), same dtype as X.
+        Output row i is centered on input row i * factor, the ends are edge
+        padded.  NaN spread to the neighbouring num_taps / factor rows."""
+    if taps is None:
+        taps = get_decimation_filter(factor)
+    X_2d = X.reshape(X.shape[0], -1)
+    num_taps = taps.shape[0]
+    half = (num_taps - 1) // 2
+    num_out = -(-X_2d.shape[0] // factor) # ceil
+    out = np.empty((num_out, X_2d.shape[1]), dtype = X.dtype)
+    taps_rev = taps[::-1].astype('float64')
+    for first in range(0, num_out, chunk_rows):
+        last = min(first + chunk_rows, num_out)
+        # input rows first * factor - half to (last - 1) * factor + half
+        rows = np.arange(first * factor - half, (last - 1) * factor + half + 1)
+        chunk = np.take(X_2d, rows, axis = 0, mode = 'clip').astype('float64')
+        acc = np.zeros((last - first, X_2d.shape[1]), dtype = 'float64')
+        for i in range(num_taps):
+            acc += taps_rev[i] * chunk[i:i + (last - first - 1) * factor + 1:factor]
+        out[first:last] = acc
+    return out.reshape((num_out,) + X.shape[1:])
+
+def decimate_ir1(df, factor, num_taps = None, chunk_rows = 1000000):
+    """Decimates an IR1 dataframe by an integer factor with
+    decimate_ir1_arrays.  The IR1 must be at a fixed sample rate (see
+    to_fixed_ir1_timedelta).  The index and the 'label', 'sub' and other
+    non-numeric columns are the samples at every factor-th row so labels
+    are never filtered.
+    Returns the decimated dataframe."""
+    label_cols = [col for col in df.columns if col in ('label', 'sub')
+                  or not pd.api.types.is_numeric_dtype(df[col])]
+    channel_cols = [col for col in df.columns if col not in label_cols]
+    X = decimate_ir1_arrays(df[channel_cols].to_numpy(), factor,
+                            taps = get_decimation_filter(factor, num_taps),
+                            chunk_rows = chunk_rows)
+    df_out = pd.DataFrame(X, columns = channel_cols, index = df.index[::factor])
+    for col in label_cols:
+        df_out[col] = df[col].to_numpy()[::factor]
+    df_out = df_out[list(df.columns)] # original column order
+    if verbose:
+        print("Decimated by", factor, ": Original/New # rows = ", len(df.index), len(df_out.index))
+    return df_out
+if interactive:
+    df_temp = decimate_ir1(ir1_df, factor = 2)
+    df_temp.info()
+
 def drop_ir1_columns(df, drop_col_list):
     """Used to remove IR1 columns, typically channels or labels that are not
     required.   Benefit is that IR1 dataframes have named columns and by doing
@@ -233,17 +469,432 @@ if interactive:
     ir1_df.info()
     display(ir1_df.head())
 
+def get_ir1_source_channels(channels, all_channels, derived = None):
+    """Projection pushdown for the raw readers.  Instead of parsing every
+    column and calling drop_ir1_columns afterwards a loader can ask which
+    channels it actually has to read to produce the requested ones.
+    Args:
+        channels = list of requested channels, None = all_channels
+        all_channels = every channel the reader can produce, raw and derived,
+            in the order the IR1 columns should appear
+        derived = optional dict of derived channel: list of the channels it
+            is computed from, ex {'accel_ttl':['accel_x','accel_y','accel_z']}
+    Returns:
+        source_channels = all_channels entries to be read or computed, this
+            includes the inputs of requested derived channels
+        keep_channels = the requested channels in all_channels order"""
+    if derived is None:
+        derived = {}
+    if channels is None:
+        channels = all_channels
+    unknown = [ch for ch in channels if ch not in all_channels]
+    if unknown:
+        print("WARNING: get_ir1_source_channels ignoring unknown channels", unknown)
+    needed = set(channels)
+    for ch in channels:
+        needed.update(derived.get(ch, []))
+    source_channels = [ch for ch in all_channels if ch in needed]
+    keep_channels = [ch for ch in all_channels if ch in channels]
+    if verbose:
+        print('get_ir1_source_channels reading', source_channels,
+              'keeping', keep_channels)
+    return source_channels, keep_channels
+if interactive:
+    print(get_ir1_source_channels(['accel_ttl'],
+                                  ['accel_x','accel_y','accel_z','accel_ttl'],
+                                  {'accel_ttl':['accel_x','accel_y','accel_z']}))
+
+def get_interval_index(points, starts, stops, overlap = 'last'):
+    """Finds the interval containing each point, e.g. the row of a label csv
+    (start, finish, label, sub) that covers each IR1 timestamp.  Intervals
+    include both ends like df.loc[start:finish].  The interval table is swept
+    once into non-overlapping segments, then each point is located with
+    searchsorted, O((N+M) log M) for N points and M intervals.
+    Args:
+        points - ndarray or index of datetime64 or ints (e.g. frame numbers)
+        starts, stops - array-like of the same type, one entry per interval
+        overlap - which interval a point covered by several gets, by table row:
+            'last' the later row wins, same as applying the rows in a loop
+            'first' the earlier row wins, same as returning on the first match
+    Returns:
+        ndarray of int64, the interval row for each point, -1 = unlabeled"""
+    if overlap not in ('first', 'last'):
+        raise ValueError("get_interval_index overlap must be 'first' or 'last', got " + repr(overlap))
+    to_int = lambda a: np.asarray(a).astype('datetime64[ns]').view('int64') \
+        if np.asarray(a).dtype.kind == 'M' else np.asarray(a).astype('int64')
+    points, starts, stops = to_int(points), to_int(starts), to_int(stops) + 1 # exclusive
+    bounds = np.unique(np.concatenate((starts, stops)))
+    # sweep the boundaries keeping a heap of the open intervals, the winner
+    # of a segment is the highest (last) or lowest (first) open row
+    sign = -1 if overlap == 'last' else 1
+    order = np.argsort(starts, kind = 'stable')
+    seg_row = np.full(bounds.shape[0], -1, dtype = 'int64')
+    open_rows = []
+    next_start = 0
+    for k, bound in enumerate(bounds):
+        while next_start < order.shape[0] and starts[order[next_start]] <= bound:
+            row = order[next_start]
+            heapq.heappush(open_rows, (sign * row, row))
+            next_start += 1
+        while open_rows and stops[open_rows[0][1]] <= bound: # lazy removal
+            heapq.heappop(open_rows)
+        if open_rows:
+            seg_row[k] = open_rows[0][1]
+    seg = np.searchsorted(bounds, points, side = 'right') - 1
+    return np.where(seg >= 0, seg_row[np.maximum(seg, 0)], -1)
+
+def get_interval_labels(points, intervals, start_col = 'start', stop_col = 'finish',
+                        label_cols = ['label', 'sub'], fill_values = ['Undefined', np.nan],
+                        overlap = 'last'):
+    """Labels each point from an interval table with get_interval_index.
+    Args:
+        points - see get_interval_index
+        intervals - dataframe with one row per interval
+        start_col, stop_col - interval column names
+        label_cols - columns copied to the points
+        fill_values - value of each label_col for unlabeled points
+        overlap - see get_interval_index
+    Returns:
+        dict key = label_col, item = ndarray with one entry per point"""
+    idx = get_interval_index(points, intervals[start_col], intervals[stop_col], overlap)
+    labels = {}
+    for col, fill in zip(label_cols, fill_values):
+        # index -1 takes the fill value appended at the end
+        labels[col] = np.append(intervals[col].to_numpy(), [fill])[idx]
+    return labels
+if interactive:
+    my_intervals = pd.DataFrame({'start':[0, 10, 15], 'finish':[9, 20, 17],
+                                 'label':['Rest', 'Stroke', 'Hold'], 'sub':[1, 1, 1]})
+    print(get_interval_labels(np.arange(0, 25, 3), my_intervals))
+
+def get_ir1_runs(timestamps, sample_period = None, tolerance = 0.5, max_fill = 0):
+    """Splits an IR1 into contiguous runs.  There is a gap wherever the time
+    between two samples is more than sample_period * (1 + tolerance).
+    Args:
+        timestamps - IR1 datetime index or datetime64 ndarray
+        sample_period - pandas time string e.g. '10ms', None = median
+            time between samples
+        tolerance - fraction of the sample period allowed as jitter
+        max_fill - gaps missing at most this many samples do not split the
+            IR1, they can be filled with fill_ir1_gaps
+    Returns:
+        run_starts, run_stops - ndarrays of int64 rows, stop is exclusive"""
+    times = np.asarray(timestamps).astype('datetime64[ns]').view('int64')
+    diffs = np.diff(times)
+    if sample_period is None:
+        period = np.median(diffs) if diffs.shape[0] > 0 else 1
+    else:
+        period = pd.Timedelta(sample_period).value
+    missing = np.rint(diffs / period).astype('int64') - 1 # samples missing from each gap
+    breaks = np.flatnonzero((diffs > period * (1 + tolerance)) & (missing > max_fill)) + 1
+    run_starts = np.concatenate(([0], breaks)).astype('int64')
+    run_stops = np.concatenate((breaks, [times.shape[0]])).astype('int64')
+    return run_starts, run_stops
+
+def get_ir1_gap_fill_index(timestamps, max_fill, sample_period = None, tolerance = 0.5):
+    """Computes the rows fill_ir1_gaps inserts into gaps that are missing at
+    most max_fill samples, from the timestamps alone.
+    Returns:
+        new_times - ndarray of int64 ns timestamps of the filled IR1
+        left - ndarray of int64 source row at or before each new row
+        frac - ndarray of float64 position between left and the next source
+            row, 0 for rows that are not inserted"""
+    times = np.asarray(timestamps).astype('datetime64[ns]').view('int64')
+    diffs = np.diff(times)
+    if sample_period is None:
+        period = np.median(diffs) if diffs.shape[0] > 0 else 1
+    else:
+        period = pd.Timedelta(sample_period).value
+    missing = np.rint(diffs / period).astype('int64') - 1
+    fillable = (diffs > period * (1 + tolerance)) & (missing <= max_fill)
+    rows_after = np.append(np.where(fillable, missing, 0), 0) # inserted after each row
+    left = np.repeat(np.arange(times.shape[0]), rows_after + 1)
+    first_new = np.cumsum(rows_after + 1) - (rows_after + 1)
+    k = np.arange(left.shape[0]) - np.repeat(first_new, rows_after + 1) # 0 = the source row
+    gap = np.append(diffs, 1)[left].astype('float64')
+    frac = k * period / gap
+    return times[left] + np.rint(k * period).astype('int64'), left, frac
+
+def fill_ir1_gaps(df, max_fill, sample_period = None, tolerance = 0.5):
+    """Inserts rows into IR1 gaps that are missing at most max_fill samples.
+    Channels are linearly interpolated, 'label', 'sub' and other non-numeric
+    columns repeat the sample before the gap.  Larger gaps are left for
+    get_ir1_runs / the window_cfg gap_tolerance to split on.
+    Returns the filled dataframe, or df itself if nothing was filled."""
+    new_times, left, frac = get_ir1_gap_fill_index(df.index, max_fill, sample_period, tolerance)
+    if new_times.shape[0] == len(df.index):
+        return df
+    label_cols = [col for col in df.columns if col in ('label', 'sub')
+                  or not pd.api.types.is_numeric_dtype(df[col])]
+    channel_cols = [col for col in df.columns if col not in label_cols]
+    X = df[channel_cols].to_numpy()
+    right = np.minimum(left + 1, X.shape[0] - 1)
+    w = frac[:, np.newaxis]
+    new_X = (X[left] * (1 - w) + X[right] * w).astype(X.dtype if X.dtype.kind == 'f' else 'float64')
+    df_out = pd.DataFrame(new_X, columns = channel_cols,
+                          index = pd.DatetimeIndex(new_times.view('datetime64[ns]'), name = df.index.name))
+    for col in label_cols:
+        df_out[col] = df[col].to_numpy()[left]
+    df_out = df_out[list(df.columns)] # original column order
+    if verbose:
+        print("fill_ir1_gaps inserted", new_times.shape[0] - len(df.index), "rows")
+    return df_out
+if interactive:
+    my_starts, my_stops = get_ir1_runs(ir1_df.index)
+    print(len(my_starts), "contiguous runs, lengths", my_stops - my_starts)
+
+"""# IR1 columnar cache
+Building the IR1 dataframes from the raw csv/txt files is by far the slowest
+step for several datasets (CMU ~15 minutes, SHL an hour+).  get_cached_ir1
+wraps a per-session loader function and stores the resulting IR1 as one .npy
+file per column, floats as float32 and labels as categorical codes.  The key
+combines the content hash of the session source files, the loader function
+and a loader version string so editing one source file or bumping the loader
+version only rebuilds the sessions affected.  The cache is off until
+ir1_cache_dir is set.
+"""
+
+def get_file_hash(ffname, chunk_size = 1024*1024):
+    """Returns the sha1 of a file's contents.  The hashes are remembered in
+    ir1_cache_dir/file_hashes.json by path, size and modification time so a
+    multi-GB zip is only read once."""
+    stat = os.stat(ffname)
+    hash_fname = os.path.join(ir1_cache_dir, 'file_hashes.json')
+    known_hashes = {}
+    if os.path.isfile(hash_fname):
+        with open(hash_fname, 'r') as file_object:
+            known_hashes = json.load(file_object)
+    entry = known_hashes.get(os.path.abspath(ffname))
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha1']
+    file_hash = hashlib.sha1()
+    with open(ffname, 'rb') as file_object:
+        for chunk in iter(lambda: file_object.read(chunk_size), b''):
+            file_hash.update(chunk)
+    known_hashes[os.path.abspath(ffname)] = {'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns, 'sha1': file_hash.hexdigest()}
+    with open(hash_fname, 'w') as file_object:
+        json.dump(known_hashes, file_object, indent = 1)
+    return file_hash.hexdigest()
+
+def get_ir1_cache_key(source_files, loader_fn, loader_version, loader_args = ()):
+    """Returns the cache key string for one session.  Raises
+    FileNotFoundError if any of the source files is missing (e.g. not
+    downloaded yet)."""
+    key = hashlib.sha1()
+    key.update((loader_fn.__module__ + '.' + loader_fn.__qualname__).encode())
+    key.update(str(loader_version).encode())
+    key.update(repr(loader_args).encode())
+    for ffname in source_files:
+        if not os.path.isfile(ffname):
+            raise FileNotFoundError("IR1 source file " + ffname + " not found")
+        key.update(get_file_hash(ffname).encode())
+    return key.hexdigest()
+
+def save_ir1_columnar(df, ir1_dir, key = ''):
+    """Writes an IR1 dataframe as index.npy plus one .npy per column and a
+    manifest describing how to rebuild each column.  float columns are stored
+    as float32, category and object (string) columns as codes + categories."""
+    if not os.path.isdir(ir1_dir):
+        os.makedirs(ir1_dir)
+    manifest_fname = os.path.join(ir1_dir, 'ir1_manifest.json')
+    if os.path.isfile(manifest_fname):
+        os.remove(manifest_fname) # invalid until the new columns are written
+    np.save(os.path.join(ir1_dir, 'index.npy'), df.index.to_numpy())
+    columns = []
+    for i, col in enumerate(df.columns):
+        col_info = {'name': col, 'file': 'col_' + str(i) + '.npy', 'dtype': str(df[col].dtype)}
+        if isinstance(df[col].dtype, pd.CategoricalDtype) or df[col].dtype == object:
+            cat = pd.Categorical(df[col])
+            values = cat.codes
+            col_info['categories'] = cat.categories.tolist()
+            col_info['categories_dtype'] = str(cat.categories.dtype)
+            col_info['ordered'] = bool(cat.ordered)
+        elif pd.api.types.is_float_dtype(df[col].dtype):
+            values = df[col].to_numpy(dtype = 'float32')
+        else:
+            values = df[col].to_numpy()
+        np.save(os.path.join(ir1_dir, col_info['file']), values)
+        columns.append(col_info)
+    manifest = {'key': key, 'index_name': df.index.name, 'columns': columns}
+    with open(manifest_fname, 'w') as file_object:
+        json.dump(manifest, file_object, indent = 1, default = str)
+
+def load_ir1_columnar(ir1_dir, key = None):
+    """Reads an IR1 written by save_ir1_columnar.  Raises FileNotFoundError if
+    there is no complete cache entry or, when key is given, the stored entry
+    has a different key (a stale entry is not the entry asked for)."""
+    manifest_fname = os.path.join(ir1_dir, 'ir1_manifest.json')
+    if not os.path.isfile(manifest_fname):
+        raise FileNotFoundError("no IR1 cache entry in " + ir1_dir)
+    with open(manifest_fname, 'r') as file_object:
+        manifest = json.load(file_object)
+    if key is not None and manifest['key'] != key:
+        raise FileNotFoundError("no IR1 cache entry for key " + key + " in " + ir1_dir)
+    index = np.load(os.path.join(ir1_dir, 'index.npy'), allow_pickle = False)
+    if np.issubdtype(index.dtype, np.datetime64):
+        index = pd.DatetimeIndex(index, name = manifest['index_name'])
+    else:
+        index = pd.Index(index, name = manifest['index_name'])
+    data = {}
+    for col_info in manifest['columns']:
+        values = np.load(os.path.join(ir1_dir, col_info['file']), allow_pickle = False)
+        if 'categories' in col_info:
+            categories = pd.Index(col_info['categories'], dtype = col_info['categories_dtype'])
+            values = pd.Categorical.from_codes(values, categories = categories,
+                                               ordered = col_info['ordered'])
+            if col_info['dtype'] == 'object':
+                values = np.asarray(values, dtype = object)
+        data[col_info['name']] = values
+    return pd.DataFrame(data, index = index)
+
+def get_cached_ir1(session_name, source_files, loader_version, loader_fn,
+                   *loader_args):
+    """Returns loader_fn(*loader_args) from the IR1 cache if the source files,
+    loader function and version match the stored entry, otherwise runs the
+    loader and stores the result.  Does nothing extra if ir1_cache_dir = None.
+    Args:
+        session_name - unique name of the session, e.g. the IR1 dict key
+        source_files - list of raw files the session is built from
+        loader_version - string, change it when the loader code changes
+        loader_fn, loader_args - the per-session function returning an IR1
+    Returns:
+        IR1 dataframe"""
+    if ir1_cache_dir is None:
+        return loader_fn(*loader_args)
+    if not os.path.isdir(ir1_cache_dir):
+        os.makedirs(ir1_cache_dir)
+    ir1_dir = os.path.join(ir1_cache_dir, loader_fn.__qualname__, session_name)
+    try:
+        key = get_ir1_cache_key(source_files, loader_fn, loader_version, loader_args)
+        df = load_ir1_columnar(ir1_dir, key = key)
+        if verbose:
+            print('IR1 cache hit for', session_name)
+        return df
+    except FileNotFoundError: # missing source or cache entry, build it
+        pass
+    if verbose:
+        print('IR1 cache miss for', session_name)
+    df = loader_fn(*loader_args)
+    try: # the loader may have downloaded the source files
+        key = get_ir1_cache_key(source_files, loader_fn, loader_version, loader_args)
+    except FileNotFoundError as e:
+        print("WARNING:", e, "- IR1 for", session_name, "not cached")
+        return df
+    save_ir1_columnar(df, ir1_dir, key = key)
+    return df
+
 """# Start of IR2 (Numpy Array) transforms"""
 
-def get_ir2_from_ir1(df):
+def get_window_cfg(window_cfg = None):
+    """Returns time_steps and stride from a window_cfg dict, missing entries
+    (or window_cfg = None) fall back to the module globals.  Every function
+    that windows takes window_cfg so nothing has to change the globals.
+    Optional gap handling keys, see get_ir2_window_offsets:
+      gap_tolerance - None (default) windows ignore the timestamps, a float
+          splits the IR1 at gaps so no window spans one
+      sample_period - expected time between samples, None = median
+      gap_fill - gaps of up to this many samples are filled, not split"""
+    if window_cfg is None:
+        window_cfg = {}
+    return (window_cfg.get('time_steps', time_steps),
+            window_cfg.get('stride', stride))
+
+def get_ir2_window_count(num_rows, window_cfg = None):
+    """Returns the number of sliding windows get_ir2_from_ir1 will generate
+    for an IR1 with num_rows samples using the window_cfg time_steps and stride.
+    This is an upper bound for the IR2 since windows may be dropped later."""
+    time_steps, stride = get_window_cfg(window_cfg)
+    if num_rows < time_steps:
+        return 0
+    return (num_rows - time_steps) // stride + 1
+if interactive:
+    print("Window count for IR1 of 1000 rows", get_ir2_window_count(1000))
+
+def get_ir2_window_offsets(timestamps, window_cfg = None):
+    """Returns the start row of every sliding window as an int64 ndarray.
+    Normally every stride rows.  If the window_cfg has a 'gap_tolerance'
+    the IR1 is split into contiguous runs (see get_ir1_runs, 'sample_period'
+    is also used if given) and the windows restart at the beginning of each
+    run, no window spans a gap."""
+    time_steps, stride = get_window_cfg(window_cfg)
+    num_rows = len(timestamps)
+    if window_cfg is None or window_cfg.get('gap_tolerance') is None:
+        return np.arange(get_ir2_window_count(num_rows, window_cfg), dtype = 'int64') * stride
+    run_starts, run_stops = get_ir1_runs(timestamps, window_cfg.get('sample_period'),
+                                         window_cfg['gap_tolerance'])
+    run_lens = run_stops - run_starts
+    counts = np.where(run_lens >= time_steps, (run_lens - time_steps) // stride + 1, 0)
+    first = np.cumsum(counts) - counts
+    k = np.arange(counts.sum()) - np.repeat(first, counts) # window number within its run
+    return np.repeat(run_starts, counts) + k * stride
+
+def get_ir1_gap_fill_args(window_cfg = None):
+    """Returns the (max_fill, sample_period, tolerance) arguments of
+    fill_ir1_gaps for the window_cfg, None means no fill (no 'gap_fill' or
+    gap_fill = 0).  The fill applies with or without a gap_tolerance, every
+    windowing path (and the window count used to preallocate) goes through
+    this.  Raises ValueError if gap_fill is not a non-negative int."""
+    if window_cfg is None or window_cfg.get('gap_fill') is None:
+        return None
+    max_fill = window_cfg['gap_fill']
+    if isinstance(max_fill, bool) or not isinstance(max_fill, (int, np.integer)) or max_fill < 0:
+        raise ValueError("window_cfg gap_fill must be a non-negative int (samples), got "
+                         + repr(max_fill))
+    if max_fill == 0:
+        return None
+    return (max_fill, window_cfg.get('sample_period'),
+            0.5 if window_cfg.get('gap_tolerance') is None else window_cfg['gap_tolerance'])
+
+def get_ir1_gap_filled(df, window_cfg = None):
+    """Applies the window_cfg 'gap_fill' (max samples) with fill_ir1_gaps,
+    returns df unchanged if there is no gap_fill."""
+    fill_args = get_ir1_gap_fill_args(window_cfg)
+    if fill_args is None:
+        return df
+    return fill_ir1_gaps(df, *fill_args)
+
+def get_ir1_window_count(df, window_cfg = None):
+    """The number of windows get_ir2_view_from_ir1 will generate for the IR1
+    df before any are dropped, takes the window_cfg gap settings into
+    account.  Only the timestamps are used."""
+    timestamps = df.index
+    fill_args = get_ir1_gap_fill_args(window_cfg)
+    if fill_args is not None:
+        timestamps = get_ir1_gap_fill_index(df.index, *fill_args)[0].view('datetime64[ns]')
+    return get_ir2_window_offsets(timestamps, window_cfg).shape[0]
+
+def get_ir1_arrays(df):
+    """Converts an IR1 dataframe into the contiguous numpy arrays that all of
+    the IR2 windowing is built on.  Labels must already be ints.
+    Returns:
+    X : ndarray of float32 shape (samples, channels)
+    y : ndarray of int8 labels shape (samples,)
+    sub : ndarray of int16 subject numbers shape (samples,)
+    timestamps : ndarray of datetime64 shape (samples,), the IR1 index
+    channel_list : list of channels, df column names minus 'label' and 'sub'
+    """
+    # the channel list is in dataframe but not in the numpy arrays
+    channel_list = list(df.columns)
+    channel_list.remove('label') # need to make sure this is defined for IR1
+    channel_list.remove('sub') # ditto - should probably add a check
+    if verbose:
+        print('Channels in X:',channel_list)
+    X = df[channel_list].to_numpy(dtype = 'float32')
+    y = df['label'].to_numpy(dtype = 'int8') # doesn't work for strings
+    sub = df['sub'].to_numpy(dtype = 'int16') # for datasets with sub #s > 255
+    timestamps = df.index.to_numpy(dtype = 'datetime64')
+    return X, y, sub, timestamps, channel_list
+
+def get_ir2_from_ir1(df, window_cfg = None):
     """slice the IR1 dataframe into sliding window segments of
     time_steps length and return X, y, sub, ss_times ndarrays.
     If stride = time_steps there is no overlap of the sliding window.
     This version does not use append, better for RAM
     df: pandas datetime indexed dataframe columns - channel(s), label (as int), sub
-    Global params used
-    time_steps: number of samples in window, will discard a partial final window
-    stride:  how far to move window, no overlap if equal to time_steps.
+    window_cfg: dict, None = global defaults, see get_window_cfg
+      time_steps: number of samples in window, will discard a partial final window
+      stride:  how far to move window, no overlap if equal to time_steps.
     Returns:
     X : ndarray of float32 shape(instances,timesteps,channels))
     y : ndarray of int8 labels of shape (instances, labels)
@@ -251,35 +902,32 @@ def get_ir2_from_ir1(df):
     ss_times : ndarray of datetime64 containing the start and stop time of 
         each window for label cleaning shape (instances, 2)
     channel_list : list of channels, df column names minus 'label' and 'sub'
+    Note: X is a strided view of the IR1 data, see IR2WindowView for a
+    version that also avoids the copies made by later filtering.
     """    
     # this was copied from SHL with improved memory capabilities
     # TODO:  Update with multi-label version from PSG-Audio
-    # TODO:  Should confirm IR1 datetimes are contiguous and warn if not.
-    
-    # the channel list is in dataframe but not in the numpy arrays
-    channel_list = list(df.columns)
-    channel_list.remove('label') # need to make sure this is defined for IR1
-    channel_list.remove('sub') # ditto - should probably add a check
-    if verbose:
-        print('Channels in X:',channel_list)
-    X = df[channel_list].to_numpy(dtype = 'float32')
-    y = df['label'].to_numpy(dtype = 'int8') # doesn't work for strings
-    sub = df['sub'].to_numpy(dtype = 'int16') # for datasets with sub #s > 255
+    time_steps, stride = get_window_cfg(window_cfg)
+    df = get_ir1_gap_filled(df, window_cfg)
+    X, y, sub, timestamps_np, channel_list = get_ir1_arrays(df)
+    # window start rows, with a window_cfg gap_tolerance no window spans a gap
+    offsets = get_ir2_window_offsets(timestamps_np, window_cfg)
+    if np.array_equal(offsets, np.arange(get_ir2_window_count(X.shape[0], window_cfg)) * stride):
+        offsets = slice(None, None, stride) # no gaps, keep the strided views
     if verbose:
         print('X,y,sub array shapes before sliding window', X.shape, y.shape, sub.shape)
     #https://numpy.org/devdocs/reference/generated/numpy.lib.stride_tricks.sliding_window_view.html
     shapex = (time_steps,X.shape[1]) # samples (rows to include) and n-dim of original (all channels)
     shapey = (time_steps,) # samples (rows to include) and only one column
     shapesub = (time_steps,) # samples (rows to include) and only one column
-    X = np.lib.stride_tricks.sliding_window_view(X, shapex)[::stride, :]
+    X = np.lib.stride_tricks.sliding_window_view(X, shapex)[offsets]
     X = X[:,0,:,:] # I admit I don't understand why this dimension appears...
-    y = np.lib.stride_tricks.sliding_window_view(y, shapey)[::stride, :]
-    sub = np.lib.stride_tricks.sliding_window_view(sub, shapesub)[::stride, :]
+    y = np.lib.stride_tricks.sliding_window_view(y, shapey)[offsets]
+    sub = np.lib.stride_tricks.sliding_window_view(sub, shapesub)[offsets]
     # Build a numpy array of the start and stop timestamps for each sliding
     # window - the IR1 indices.  This is to help label cleaning if needed.
-    timestamps_np = df.index.to_numpy(dtype = 'datetime64')
     shape_ts = (time_steps,) # samples (rows to include) and only one column
-    timestamps_np = np.lib.stride_tricks.sliding_window_view(timestamps_np, shape_ts)[::stride, :]
+    timestamps_np = np.lib.stride_tricks.sliding_window_view(timestamps_np, shape_ts)[offsets]
     start_times = timestamps_np[:,0]
     stop_times = timestamps_np[:,-1]
     ss_times = np.column_stack((start_times,stop_times))
@@ -291,38 +939,125 @@ if interactive:
     print(tabulate_numpy_arrays({'my_X':my_X,'my_y':my_y,'my_sub':my_sub,'my_ss_times':my_ss_times}))
     print("Returned my_channel_list", my_channel_list)
 
-def drop_ir2_nan(X, y, sub, ss_times):
-    """removes sliding windows containing NaN, multiple labels, or multiple
-    subject numbers.  Collapses y, sub to column arrays.
-    Returns cleaned versions of X, y, sub, ss_times ndarrays"""
-    # TODO:  This really should be split into multiple functions
-    # Check for NaN
-    nans = np.argwhere(np.isnan(X))
-    num_nans = np.unique(nans[:,0]) #[:,0] just 1st column index of rows w/ NaN
+def get_ir2_nan_counts(X, chunk_windows = 4096):
+    """Counts the NaN in an IR2/IR3 X array in one pass, chunk_windows
+    windows at a time so the boolean scratch array stays small even when X
+    is a strided sliding window view of the IR1.
+    Returns:
+        nan_per_window - ndarray of int64 shape (windows,)
+        nan_per_channel - ndarray of int64 shape (channels,)"""
+    nan_per_window = np.zeros(X.shape[0], dtype = 'int64')
+    nan_per_channel = np.zeros(X.shape[2], dtype = 'int64')
+    for i in range(0, X.shape[0], chunk_windows):
+        isnan = np.isnan(X[i:i + chunk_windows])
+        nan_per_window[i:i + chunk_windows] = isnan.sum(axis = (1, 2))
+        nan_per_channel += isnan.sum(axis = (0, 1))
+    return nan_per_window, nan_per_channel
+
+def drop_ir2_nan(X, y, sub, ss_times, return_idx = False, chunk_windows = 4096):
+    """removes sliding windows containing NaN.  The keep mask comes from a
+    single chunked pass (get_ir2_nan_counts) and is applied once to all
+    four arrays, nothing is copied if there are no NaN.
+    Args:
+        X, y, sub, ss_times - IR2 arrays
+        return_idx - True returns only the int indices of the windows to keep
+            so the caller can filter lazily, e.g. a strided get_ir2_from_ir1 X
+        chunk_windows - windows scanned at a time, see get_ir2_nan_counts
+    Returns cleaned versions of X, y, sub, ss_times ndarrays (or the indices)"""
+    nan_per_window, nan_per_channel = get_ir2_nan_counts(X, chunk_windows)
+    keep = nan_per_window == 0
     if verbose:
-        print(num_nans.shape[0], "NaN entries found, removing")
-    idx = ~np.isnan(X).any(axis=2).any(axis=1)
-    # this warrants some explanation!
-    # any(axis=1) and 2 collapses channels and samples
-    # good axis explanation https://www.sharpsightlabs.com/blog/numpy-axes-explained/
-    # the ~ negates so NaN location are now False in the idx which is then
-    # used to filter out the bad windows below
-    X = X[idx]
-    y = y[idx]
-    sub = sub[idx]
-    ss_times = ss_times[idx]
-    # repeat and confirm NaNs have been removed
-    nans = np.argwhere(np.isnan(X))
-    num_nans = np.unique(nans[:,0]) #[:,0] accesses just 1st column
-    if (nans.size!=0):
-        print("WARNING! Cleaned output arrays still contain NaN entries")
-        print("execute print(X[99]) # to view single sample")
-    return X, y, sub, ss_times
+        print(np.count_nonzero(~keep), "windows with NaN entries found, removing")
+        if not keep.all():
+            print("NaN entries per channel", nan_per_channel)
+    if return_idx:
+        return np.flatnonzero(keep)
+    if keep.all():
+        return X, y, sub, ss_times
+    return X[keep], y[keep], sub[keep], ss_times[keep]
 if interactive:
     my_X, my_y, my_sub, my_ss_times = drop_ir2_nan(my_X, my_y, my_sub, my_ss_times)  
     print(tabulate_numpy_arrays({'my_X':my_X,'my_y':my_y,'my_sub':my_sub,'my_ss_times':my_ss_times}))
 
-def unify_ir2_labels(X, y, sub, ss_times, method = 'drop'):
+def get_ir1_label_purity(labels, starts = None, window_cfg = None):
+    """Computes the label purity of every sliding window directly from an IR1
+    label column, before any windows are built.  A prefix sum of the points
+    where the label changes gives the number of changes inside each window in
+    O(samples), a window is pure if there are none.  Uses the same
+    window_cfg as get_ir2_from_ir1 so the windows line up.
+    Args:
+        labels - 1D ndarray of int labels, typically df['label'].to_numpy()
+        starts - optional ndarray of window start offsets into labels, the
+            default is every stride samples as in get_ir2_from_ir1
+        window_cfg - dict, None = global defaults, see get_window_cfg
+    Returns:
+        purity - dict of per-window ndarrays with keys
+            'pure' - bool, True if all labels in the window are the same
+            'majority' - most frequent label (lowest value on a tie, same
+                as scipy.stats.mode)
+            'majority_frac' - float32 fraction of the window with majority
+            'first', 'last', 'center' - label at those window positions"""
+    time_steps, stride = get_window_cfg(window_cfg)
+    labels = np.asarray(labels)
+    if starts is None:
+        starts = np.arange(get_ir2_window_count(labels.shape[0], window_cfg), dtype = 'int64') * stride
+        # pass starts = get_ir2_window_offsets(...) when using gap_tolerance
+    num_windows = starts.shape[0]
+    stops = starts + time_steps - 1 # inclusive, last sample in each window
+    # change_count[i] = number of label changes in labels[0:i+1]
+    change_count = np.zeros(labels.shape[0], dtype = 'int64')
+    if labels.shape[0] > 1:
+        np.cumsum(labels[1:] != labels[:-1], out = change_count[1:])
+    pure = (change_count[stops] - change_count[starts]) == 0
+    purity = {'pure': pure,
+              'first': labels[starts],
+              'last': labels[stops],
+              'center': labels[starts + time_steps // 2]}
+    # majority is the first label for pure windows, only the mixed ones need
+    # counting.  One running count per label value keeps RAM at O(samples).
+    majority = purity['first'].copy()
+    majority_count = np.where(pure, time_steps, 0)
+    mixed_idx = np.flatnonzero(~pure)
+    if mixed_idx.size > 0:
+        label_count = np.zeros(labels.shape[0] + 1, dtype = 'int64')
+        for label_value in np.unique(labels):
+            np.cumsum(labels == label_value, out = label_count[1:])
+            counts = label_count[stops[mixed_idx] + 1] - label_count[starts[mixed_idx]]
+            better = counts > majority_count[mixed_idx] # ties keep lower label
+            majority[mixed_idx[better]] = label_value
+            majority_count[mixed_idx[better]] = counts[better]
+    purity['majority'] = majority
+    purity['majority_frac'] = (majority_count / time_steps).astype('float32')
+    if verbose:
+        print('get_ir1_label_purity', num_windows, 'windows,', mixed_idx.size, 'with mixed labels')
+    return purity
+if interactive:
+    my_purity = get_ir1_label_purity(ir1_df['label'].to_numpy())
+    print("Pure windows", my_purity['pure'].sum(), "of", my_purity['pure'].shape[0])
+
+def get_ir2_label_purity(y):
+    """Same per-window purity dict as get_ir1_label_purity but computed from
+    an IR2 y array of shape (instances, time_steps), for use when the IR1
+    label column is no longer available.  Vectorized, no loop over windows."""
+    win_len = y.shape[1]
+    purity = {'pure': np.all(y == y[:, :1], axis = 1),
+              'first': y[:, 0],
+              'last': y[:, -1],
+              'center': y[:, win_len // 2]}
+    majority = purity['first'].copy()
+    majority_count = np.where(purity['pure'], win_len, 0)
+    mixed_idx = np.flatnonzero(~purity['pure'])
+    for label_value in np.unique(y[mixed_idx]):
+        counts = np.count_nonzero(y[mixed_idx] == label_value, axis = 1)
+        better = counts > majority_count[mixed_idx]
+        majority[mixed_idx[better]] = label_value
+        majority_count[mixed_idx[better]] = counts[better]
+    purity['majority'] = majority
+    purity['majority_frac'] = (majority_count / win_len).astype('float32')
+    return purity
+
+def unify_ir2_labels(X, y, sub, ss_times, method = 'drop', purity = None,
+                     purity_threshold = None):
     """For each sliding window examine all labels and either drop the window
      or assign all labels to the mode value.  Currently this works only for
      single labels, not multi-label datasets.  y and sub arrays are collapsed.
@@ -330,41 +1065,44 @@ def unify_ir2_labels(X, y, sub, ss_times, method = 'drop'):
      X,y,sub,ss_times:  IR2 df prior to collapsing X,y,sub,ss_times
      method: "drop" default - discard windows with mixed labels, typ train set
              "mode" - set all labels to mode value of labels in window
+     purity: dict from get_ir1_label_purity for these windows.  If None it
+             is computed from y using get_ir2_label_purity.
+     purity_threshold: None (default) or float 0.0 to 1.0.  If set, windows
+             are kept if the majority label covers at least this fraction of
+             the window and are labeled with the majority label.  Applies to
+             both methods, 1.0 is the same as "drop".
      returns X,y,sub,ss_times IR2 df with y & sub shapes now (instances, 1)"""
-    # TODO: a threshold setting to determine which method would be nice.
     # TODO: test/fix the drop for multi-label case
-    # Not happy with this code, must be a better way but it seems to work...
-    # Also the interactive outputs should be integrated if verbose = True
-    if method == 'drop':
-        if verbose:
-            print('Dropped windows(rows) with mixed labels:', sep = '',end='')
-        idx = []
-        for i in range(y.shape[0]):
-            if np.all(y[i] == y[i][0]):
-                idx.append(True)        
-            else:
-                idx.append(False)
-                if verbose:
-                    print(i,',',end='')
-        X = X[idx]
-        y = y[idx]
-        sub = sub[idx]
-        ss_times = ss_times[idx]
-        if verbose:
-            print()
-        y = y[:,0] # collapse columns
-        y = y[np.newaxis].T  # convert to single column array
-    if method == 'mode':
+    if (y.ndim == 3): # multi-label (found testing PSG-Audio), mode only
         # scipy stats seems to be the best for mode
         # https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.mode.html
+        from scipy import stats as st
         y, counts = st.mode(y, axis = 1, keepdims = True)
-        if (y.ndim == 3):
-            y = y[:,0,:] # collapse if multi-label (found testing PSG-Audio)
-        # TODO: the counts could be used for threshold to drop if not enough
+        y = y[:,0,:]
+    else:
+        if purity is None:
+            purity = get_ir2_label_purity(y)
+        if purity_threshold is not None:
+            idx = purity['majority_frac'] >= purity_threshold
+            y = purity['majority']
+        elif method == 'drop':
+            idx = purity['pure']
+            y = purity['first']
+        else: # mode - keep all windows
+            idx = None
+            y = purity['majority']
+        if idx is not None:
+            if verbose:
+                print('Dropped windows(rows) with mixed labels:', np.flatnonzero(~idx))
+            X = X[idx]
+            y = y[idx]
+            sub = sub[idx]
+            ss_times = ss_times[idx]
+        y = y[np.newaxis].T  # convert to single column array
     # check subs, warn if delta and collapse
-    for i in range(sub.shape[0]):
-        if np.all(sub[i] != sub[i][0]):
-            print("WARNING:  Mixed subjects found in instance", i)
+    mixed_sub = np.any(sub != sub[:, :1], axis = 1)
+    if mixed_sub.any():
+        print("WARNING:  Mixed subjects found in instances", np.flatnonzero(mixed_sub))
     sub = sub[:,0] # repeat for sub array
     sub = sub[np.newaxis].T
     return X, y, sub, ss_times
@@ -392,25 +1130,22 @@ def get_ir2_y_string_labels(y,label_map):
     """This method reverses the int encoding applied to IR1 when run on an
     IR2/IR3 (sliding window numpy array).  The same label_map dict should be 
     used.  Currently only supports a single label, shape y = (instance,1)
-    NOTE: This greatly increases the size of the array (for GPS dataset 44X)
+    NOTE: This greatly increases the size of the array (for GPS dataset 44X),
+    decode_labels returns int codes plus a list of names instead.
     args:
         y - a IR2 or IR3 numpy array of int class labels, shape (instances,1)
         label_map - a dict containing the string to int encodings
     returns:
         y - a IR2 or IR3 numpy array of string class labels, shape (instances,1)"""
-    # this code adapted from our Semi-Supervised-HAR.ipynb
-    str_to_key_dict = label_map['label']
-    key_to_str_dict = dict([(value, key) for key, value in str_to_key_dict.items()])
-    
     if verbose:
-        "Converting integer encoded labels back to original strings"
-        print(str_to_key_dict)
-        print(key_to_str_dict)
+        print("Converting integer encoded labels back to original strings", label_map['label'])
         print("Labels and counts before conversion")
         unique, counts = np.unique(y, return_counts=True)
         print (np.asarray((unique, counts)).T)
 
-    y_labels = np.vectorize(key_to_str_dict.get)(y)
+    codes, names = decode_labels(y, label_map['label'])
+    # ints not in label_map were None with the old dict.get version
+    y_labels = np.array(names + ['None'])[codes]
     y_labels = y_labels.reshape((-1, 1)) # reshape from (__,) to (__,1)
     
     if verbose:
@@ -425,6 +1160,64 @@ if interactive:
     print("Size of original array",my_y.size * my_y.itemsize, "Bytes")
     print("Size of string array  ",y_strings.size * y_strings.itemsize, "Bytes")
 
+def get_one_hot_classes(label_map):
+    """Returns one sorted list of class ints per label column of label_map,
+    the 'unknown'/'Undefined' (99) entries are not classes since those
+    windows are dropped."""
+    return [sorted(set([v for v in mapping.values() if v != 99]))
+            for mapping in label_map.values()]
+
+def one_hot_encode_labels(y, label_map = None, num_classes = None, classes = None,
+                          out = None):
+    """uint8 one-hot encoding of int labels with a fixed set of classes, so
+    the columns don't depend on which classes are present in y (unlike
+    fit_transform of OneHotEncoder) and without tensorflow's to_categorical.
+    Args:
+        y - (instances, 1) or (instances,) int labels, multi-label datasets
+            such as PSG-Audio (instances, label columns)
+        label_map - the loader label_map, one block of columns per label,
+            see get_one_hot_classes
+        num_classes - instead of label_map, classes 0 to num_classes - 1
+        classes - instead of label_map, sorted list of class ints (or one
+            list per label column), e.g. list(range(1, 9)) for SHL
+        out - optional uint8 array to write into, must be zeroed
+    Returns:
+        uint8 array (instances, total classes), labels that are not a class
+        give an all zero row"""
+    y = np.asarray(y)
+    if y.ndim == 1:
+        y = y[:, np.newaxis]
+    if classes is None:
+        if label_map is not None:
+            classes = get_one_hot_classes(label_map)
+        elif num_classes is not None:
+            classes = [list(range(num_classes))]
+        else:
+            raise ValueError("one_hot_encode_labels needs label_map, num_classes or classes")
+    elif np.ndim(classes[0]) == 0:
+        classes = [classes]
+    if len(classes) != y.shape[1]:
+        raise ValueError("one_hot_encode_labels y has " + str(y.shape[1])
+                         + " label columns, expected " + str(len(classes)))
+    widths = [len(i) for i in classes]
+    if out is None:
+        out = np.zeros((y.shape[0], sum(widths)), dtype = 'uint8')
+    rows = np.arange(y.shape[0])
+    offset = 0
+    for labels, label_classes in zip(y.T, classes):
+        label_classes = np.asarray(label_classes)
+        col = np.searchsorted(label_classes, labels)
+        col[col == len(label_classes)] = 0
+        found = label_classes[col] == labels
+        if not found.all():
+            print("WARNING: one_hot_encode_labels", np.count_nonzero(~found),
+                  "labels not in classes, rows left all zero")
+        out[rows[found], offset + col[found]] = 1
+        offset += len(label_classes)
+    return out
+if interactive:
+    print(one_hot_encode_labels(my_y[:5], label_map = label_map_gps))
+
 def clean_ir2(X, y, sub, ss_times):
     """Deprecated, please use drop_ir2_nan and unify_ir2_labels directly.
     This version calls those two functions using drop for compatibility."
@@ -470,9 +1263,715 @@ if interactive:
             ("my_sub:", my_sub.shape, type(my_sub), my_sub.dtype),
             ("my_ss_times:", my_ss_times.shape, type(my_ss_times), my_ss_times.dtype)]
     print("IR2 array info after label drop")
+    from tabulate import tabulate
     print(tabulate(mydata, headers=headers))
 
-def get_ir3_from_dict(ir1_dict, label_map, label_method = 'drop'):
+"""# Lazy IR2 window view
+get_ir2_from_ir1 returns X as a strided view of the IR1 but the boolean
+masks in the cleaning steps, np.vstack and limit_channel_ir3 all turn it into
+full copies, with overlapping windows that is a multiple of the raw signal.
+The IR2WindowView keeps the IR1 channel array once plus the start offset of
+each window, filtering only shrinks the offsets.
+"""
+
+def get_ir1_window_nan_counts(ir1_X, starts, win_len, chunk_rows = 1000000):
+    """Returns the number of IR1 rows containing NaN inside each window using
+    a prefix sum over the rows, no windows are built.
+    Args:
+        ir1_X - IR1 channel array shape (samples, channels)
+        starts - ndarray of window start offsets
+        win_len - number of samples in each window
+        chunk_rows - rows checked at a time, bounds the boolean scratch array
+    Returns:
+        ndarray of int64, shape (windows,)"""
+    nan_rows = np.zeros(ir1_X.shape[0] + 1, dtype = 'int64')
+    for i in range(0, ir1_X.shape[0], chunk_rows):
+        chunk = ir1_X[i:i + chunk_rows]
+        nan_rows[i + 1:i + 1 + chunk.shape[0]] = np.isnan(chunk).any(axis = 1)
+    np.cumsum(nan_rows, out = nan_rows)
+    return nan_rows[starts + win_len] - nan_rows[starts]
+
+class IR2WindowView:
+    """A lazy IR2.  Stores the contiguous IR1 arrays plus an ndarray of window
+    start offsets instead of the (instances, time_steps, channels) X array.
+    Windows are only copied when a batch is requested.
+    len(view) - number of windows
+    view[i] - a single window, shape (time_steps, channels), a view not a copy
+    view[a:b] or view[idx_array] - copied batch of X windows
+    view.get_batch(key) - copied batch of X, y, sub, ss_times like the IR2
+    The drop_ and keep_ methods return a new view that shares the IR1 arrays.
+    Build with get_ir2_view_from_ir1(df)."""
+    def __init__(self, ir1_X, ir1_times, offsets, y, sub, win_len,
+                 channel_list, channel_idx = None):
+        self.ir1_X = ir1_X # (samples, channels) float32, never copied
+        self.ir1_times = ir1_times # (samples,) datetime64
+        self.offsets = offsets # (windows,) int64 start row of each window
+        self.y = y # (windows,) int label of each window
+        self.sub = sub # (windows,) int subject number of each window
+        self.win_len = win_len
+        self.channel_list = channel_list
+        self.channel_idx = channel_idx # None = all channels
+
+    def __len__(self):
+        return self.offsets.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            start = self.offsets[key]
+            window = self.ir1_X[start:start + self.win_len]
+            if self.channel_idx is not None:
+                window = window[:, self.channel_idx]
+            return window
+        return self.get_batch(key)[0]
+
+    def _subset(self, key):
+        """returns a new view with only the windows selected by key"""
+        return IR2WindowView(self.ir1_X, self.ir1_times, self.offsets[key],
+                             self.y[key], self.sub[key], self.win_len,
+                             self.channel_list, self.channel_idx)
+
+    def get_batch(self, key = slice(None), out = None):
+        """Copies the selected windows into IR2 format arrays.
+        Args:
+            key - int array, boolean mask or slice of windows
+            out - optional float32 array of shape (windows, time_steps,
+                channels) to gather X into, e.g. a slice of a preallocated IR3
+        Returns X, y, sub, ss_times with y and sub shape (windows, 1)"""
+        offsets = self.offsets[key]
+        rows = offsets[:, np.newaxis] + np.arange(self.win_len)
+        if self.channel_idx is None:
+            X = np.take(self.ir1_X, rows, axis = 0, out = out, mode = 'clip')
+        else:
+            X = self.ir1_X[rows[:, :, np.newaxis], self.channel_idx]
+            if out is not None:
+                out[...] = X
+                X = out
+        y = self.y[key][:, np.newaxis]
+        sub = self.sub[key][:, np.newaxis]
+        ss_times = np.column_stack((self.ir1_times[offsets],
+                                    self.ir1_times[offsets + self.win_len - 1]))
+        return X, y, sub, ss_times
+
+    def iter_batches(self, batch_size = 1024):
+        """yields X, y, sub, ss_times batches of up to batch_size windows"""
+        for i in range(0, len(self), batch_size):
+            yield self.get_batch(slice(i, i + batch_size))
+
+    def drop_nan(self):
+        """drops windows containing NaN in any of the kept channels"""
+        ir1_X = self.ir1_X
+        if self.channel_idx is not None:
+            ir1_X = ir1_X[:, self.channel_idx]
+        nan_counts = get_ir1_window_nan_counts(ir1_X, self.offsets, self.win_len)
+        if verbose:
+            print(np.count_nonzero(nan_counts), "windows with NaN entries found, removing")
+        return self._subset(nan_counts == 0)
+
+    def drop_label(self, label_to_drop):
+        """drops windows with label = label_to_drop, e.g. 'unknown' = 99"""
+        return self._subset(self.y != label_to_drop)
+
+    def keep_subjects(self, sub_list):
+        """keeps only the windows whose subject number is in sub_list"""
+        return self._subset(np.isin(self.sub, sub_list))
+
+    def keep_channels(self, keep_channel_list):
+        """same as limit_channel_ir3, applied when batches are copied"""
+        ch_idx = [self.channel_list.index(i) for i in keep_channel_list]
+        if self.channel_idx is not None:
+            ch_idx = [self.channel_idx[i] for i in ch_idx]
+        return IR2WindowView(self.ir1_X, self.ir1_times, self.offsets,
+                             self.y, self.sub, self.win_len,
+                             list(keep_channel_list), ch_idx)
+
+def get_ir2_view_from_ir1(df, label_method = 'drop', purity_threshold = None,
+                          window_cfg = None):
+    """The IR2WindowView version of get_ir2_from_ir1 plus unify_ir2_labels.
+    Window labels come from get_ir1_label_purity so nothing is windowed.
+    Args:
+        df - IR1 dataframe with int labels (see assign_ints_ir1_labels)
+        label_method, purity_threshold - see unify_ir2_labels
+        window_cfg - dict, None = global defaults, see get_window_cfg
+    Returns:
+        an IR2WindowView"""
+    df = get_ir1_gap_filled(df, window_cfg)
+    return get_ir2_view_from_ir1_arrays(get_ir1_arrays(df), label_method,
+                                        purity_threshold, window_cfg)
+
+def get_ir2_view_from_ir1_arrays(ir1_arrays, label_method = 'drop',
+                                 purity_threshold = None, window_cfg = None):
+    """get_ir2_view_from_ir1 for an IR1 that has already been converted by
+    get_ir1_arrays, lets several window configs share one conversion (see
+    get_ir3_sweep_from_dict).  The window_cfg gap_fill must already have
+    been applied to the arrays.  Returns an IR2WindowView."""
+    time_steps, stride = get_window_cfg(window_cfg)
+    X, y, sub, timestamps, channel_list = ir1_arrays
+    offsets = get_ir2_window_offsets(timestamps, window_cfg)
+    purity = get_ir1_label_purity(y, starts = offsets, window_cfg = window_cfg)
+    if purity_threshold is not None:
+        keep = purity['majority_frac'] >= purity_threshold
+        win_y = purity['majority']
+    elif label_method == 'drop':
+        keep = purity['pure']
+        win_y = purity['first']
+    else: # mode
+        keep = np.ones(offsets.shape[0], dtype = bool)
+        win_y = purity['majority']
+    sub_purity = get_ir1_label_purity(sub, starts = offsets, window_cfg = window_cfg)
+    if not sub_purity['pure'].all():
+        print("WARNING:  Mixed subjects found in instances", np.flatnonzero(~sub_purity['pure']))
+    view = IR2WindowView(X, timestamps, offsets, win_y, sub_purity['first'],
+                         time_steps, channel_list)
+    return view._subset(keep)
+if interactive:
+    my_view = get_ir2_view_from_ir1(ir1_df).drop_nan().drop_label(99)
+    print("IR2 view with", len(my_view), "windows, first window shape", my_view[0].shape)
+    my_X, my_y, my_sub, my_ss_times = my_view.get_batch(slice(0, 10))
+    print(tabulate_numpy_arrays({'my_X':my_X,'my_y':my_y,'my_sub':my_sub,'my_ss_times':my_ss_times}))
+
+def get_ir2_batches_from_ir1(df, batch_size = 4096, label_method = 'drop',
+                             purity_threshold = None, label_to_drop = 99,
+                             drop_nan = True, window_cfg = None):
+    """Generator version of get_ir2_from_ir1 + unify_ir2_labels +
+    drop_ir2_nan + drop_label_ir2_ir3 for IR1s too long to window at once
+    (overnight PSG, day long E4 recordings).  The IR1 is read batch_size
+    windows at a time so memory use depends on batch_size, not on the
+    length of the recording.
+    Args:
+        df - IR1 dataframe with int labels (see assign_ints_ir1_labels)
+        batch_size - number of windows read per batch, batches are smaller
+            after the NaN and label filtering
+        label_method, purity_threshold - see unify_ir2_labels
+        label_to_drop - int label of windows to remove, None keeps all
+        drop_nan - remove windows containing NaN as in drop_ir2_nan
+        window_cfg - dict, None = global defaults, see get_window_cfg.  With
+            a gap_fill the filled copy of the IR1 is made up front.
+    Yields:
+        X, y, sub, ss_times for each batch with at least one window left"""
+    time_steps, stride = get_window_cfg(window_cfg)
+    df = get_ir1_gap_filled(df, window_cfg)
+    if window_cfg is None or window_cfg.get('gap_tolerance') is None:
+        runs = [(0, len(df.index))]
+    else:
+        runs = zip(*get_ir1_runs(df.index, window_cfg.get('sample_period'),
+                                 window_cfg['gap_tolerance']))
+    # each run is contiguous so it is windowed without the gap settings
+    run_cfg = dict(time_steps = time_steps, stride = stride)
+    for run_start, run_stop in runs:
+        num_windows = get_ir2_window_count(run_stop - run_start, run_cfg)
+        for first_window in range(0, num_windows, batch_size):
+            batch_windows = min(batch_size, num_windows - first_window)
+            first_row = run_start + first_window * stride
+            last_row = first_row + (batch_windows - 1) * stride + time_steps
+            # windows overlap so consecutive chunks share time_steps - stride rows
+            ir2_view = get_ir2_view_from_ir1(df.iloc[first_row:last_row],
+                                             label_method = label_method,
+                                             purity_threshold = purity_threshold,
+                                             window_cfg = run_cfg)
+            if drop_nan:
+                ir2_view = ir2_view.drop_nan()
+            if label_to_drop is not None:
+                ir2_view = ir2_view.drop_label(label_to_drop)
+            if len(ir2_view) > 0:
+                yield ir2_view.get_batch()
+if interactive:
+    total_windows = 0
+    for my_X, my_y, my_sub, my_ss_times in get_ir2_batches_from_ir1(ir1_df, batch_size = 256):
+        total_windows += my_X.shape[0]
+    print("Streamed", total_windows, "windows, last batch:")
+    print(tabulate_numpy_arrays({'my_X':my_X,'my_y':my_y,'my_sub':my_sub,'my_ss_times':my_ss_times}))
+
+if interactive:
+    # regression check: a gap_fill without gap_tolerance must give the same
+    # windows in the count (prealloc), get_ir2_from_ir1 and the generator
+    gap_times = pd.date_range('2021-01-01', periods = 101, freq = '10ms')
+    gap_df = pd.DataFrame({'accel': np.arange(101, dtype = 'float32'), 'label': 0, 'sub': 1},
+                          index = gap_times).drop(gap_times[50:53]) # 98 rows, 3 sample gap
+    gap_cfg = dict(time_steps = 10, stride = 10, gap_fill = 3)
+    gap_counts = [get_ir1_window_count(gap_df, gap_cfg),
+                  get_ir2_from_ir1(gap_df, gap_cfg)[0].shape[0],
+                  sum([i[0].shape[0] for i in get_ir2_batches_from_ir1(gap_df, window_cfg = gap_cfg)])]
+    print("gap_fill window counts (all should be 10)", gap_counts)
+
+"""# Streaming channel statistics
+Per subject, per channel count/mean/M2/min/max (and optional histograms)
+accumulated block by block while the IR3 is built, so normalizing X doesn't
+need another full pass over x_train.  Keeping the statistics per subject
+means any train split can be merged from them later.  They are stored in the
+IR3 store manifest and applied per batch, see get_ir3_batches(normalize = ).
+"""
+
+# Optional histogram bin edges for the robust (median/IQR) scaling, e.g.
+# np.linspace(-20, 20, 401), values outside are counted in the end bins.
+ir3_stats_hist_edges = None
+
+class IR3ChannelStats:
+    """Running per subject, per channel statistics of IR3 X windows.
+    stats.update(X_block, sub_block) - add a block of windows, thread safe
+    stats.get_stats(subjects) - merged count, mean, std, min, max, hist
+    stats.get_norm(subjects, method) - center and scale for normalize_ir3_batch
+    stats.to_dict() / IR3ChannelStats.from_dict(d) - json for the manifest"""
+    def __init__(self, num_channels, hist_edges = None):
+        self.num_channels = num_channels
+        if hist_edges is None:
+            hist_edges = ir3_stats_hist_edges
+        self.hist_edges = None if hist_edges is None else np.asarray(hist_edges, dtype = 'float64')
+        self.subjects = {} # subject number: dict of per channel arrays
+        self.lock = threading.Lock()
+
+    def get_block_stats(self, x):
+        """stats of x (samples, channels) as float64 arrays"""
+        mean = x.mean(axis = 0, dtype = 'float64')
+        diff = x - mean.astype(x.dtype) # block sized temporary in the X dtype
+        np.square(diff, out = diff)
+        block = dict(count = x.shape[0], mean = mean,
+                     M2 = diff.sum(axis = 0, dtype = 'float64'),
+                     min = x.min(axis = 0).astype('float64'),
+                     max = x.max(axis = 0).astype('float64'))
+        del diff
+        # the M2 above is around the rounded mean, correct it (Chan et al.)
+        block['M2'] -= x.shape[0] * np.square(mean - mean.astype(x.dtype))
+        if self.hist_edges is not None:
+            num_bins = self.hist_edges.shape[0] - 1
+            idx = np.searchsorted(self.hist_edges, x, side = 'right') - 1
+            np.clip(idx, 0, num_bins - 1, out = idx)
+            idx += np.arange(x.shape[1]) * num_bins # one histogram per channel
+            block['hist'] = np.bincount(idx.ravel(), minlength = x.shape[1] * num_bins
+                                        ).reshape(x.shape[1], num_bins)
+        return block
+
+    @staticmethod
+    def merge(a, b):
+        """Chan et al. parallel merge of two stats dicts, returns a new dict"""
+        if a is None:
+            return dict(b)
+        count = a['count'] + b['count']
+        delta = b['mean'] - a['mean']
+        merged = dict(count = count,
+                      mean = a['mean'] + delta * (b['count'] / count),
+                      M2 = a['M2'] + b['M2'] + np.square(delta) * (a['count'] * b['count'] / count),
+                      min = np.minimum(a['min'], b['min']),
+                      max = np.maximum(a['max'], b['max']))
+        if 'hist' in a:
+            merged['hist'] = a['hist'] + b['hist']
+        return merged
+
+    def update(self, X, sub, chunk_windows = 4096):
+        """Adds windows X (windows, time_steps, channels) with subject
+        numbers sub (windows, 1) or (windows,)."""
+        sub = np.asarray(sub).reshape(-1)
+        for start in range(0, X.shape[0], chunk_windows):
+            X_chunk = np.asarray(X[start:start + chunk_windows])
+            sub_chunk = sub[start:start + chunk_windows]
+            subjects = np.unique(sub_chunk) # almost always one
+            for subject in subjects:
+                x = X_chunk if len(subjects) == 1 else X_chunk[sub_chunk == subject]
+                block = self.get_block_stats(x.reshape(-1, self.num_channels))
+                with self.lock:
+                    self.subjects[int(subject)] = self.merge(self.subjects.get(int(subject)), block)
+
+    def get_stats(self, subjects = None):
+        """Merged stats of subjects (None = all) with std added, ValueError
+        if none of the subjects has windows"""
+        if subjects is None:
+            subjects = list(self.subjects)
+        merged = None
+        for subject in subjects:
+            if subject not in self.subjects:
+                print("WARNING: IR3ChannelStats has no windows for subject", subject)
+                continue
+            merged = self.merge(merged, self.subjects[subject])
+        if merged is None:
+            raise ValueError("IR3ChannelStats has no windows for subjects " + str(list(subjects)))
+        merged['std'] = np.sqrt(merged['M2'] / merged['count'])
+        return merged
+
+    def get_hist_quantiles(self, hist, q):
+        """quantiles q (list of 0-1) per channel from histograms, linear within a bin"""
+        cdf = np.cumsum(hist, axis = 1) / hist.sum(axis = 1, keepdims = True)
+        cdf = np.concatenate([np.zeros((hist.shape[0], 1)), cdf], axis = 1)
+        return np.array([[np.interp(i, cdf[ch], self.hist_edges) for ch in range(hist.shape[0])]
+                         for i in q])
+
+    def get_norm(self, subjects = None, method = 'standard'):
+        """Returns dict(center, scale) float32 arrays for normalize_ir3_batch
+        computed from subjects only (typically the train subjects).
+        method - 'standard' mean/std, 'minmax' min/(max-min) or 'robust'
+            median/IQR, robust needs hist_edges"""
+        stats = self.get_stats(subjects)
+        if method == 'standard':
+            center, scale = stats['mean'], stats['std']
+        elif method == 'minmax':
+            center, scale = stats['min'], stats['max'] - stats['min']
+        elif method == 'robust':
+            if 'hist' not in stats:
+                raise ValueError("IR3ChannelStats robust scaling requires hist_edges")
+            q25, q50, q75 = self.get_hist_quantiles(stats['hist'], [0.25, 0.5, 0.75])
+            center, scale = q50, q75 - q25
+        else:
+            raise ValueError("IR3ChannelStats.get_norm unknown method " + repr(method))
+        scale = np.where(scale > 0, scale, 1.0) # constant channels are only shifted
+        return dict(center = center.astype('float32'), scale = scale.astype('float32'))
+
+    def to_dict(self):
+        """json serializable version for the IR3 store manifest"""
+        d = dict(num_channels = self.num_channels, subjects = {},
+                 hist_edges = None if self.hist_edges is None else self.hist_edges.tolist())
+        for subject, stats in self.subjects.items():
+            d['subjects'][str(subject)] = {k: (v.tolist() if isinstance(v, np.ndarray) else v)
+                                           for k, v in stats.items()}
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        channel_stats = cls(d['num_channels'], hist_edges = d['hist_edges'])
+        for subject, stats in d['subjects'].items():
+            channel_stats.subjects[int(subject)] = {k: (v if k == 'count' else np.asarray(v))
+                                                    for k, v in stats.items()}
+        return channel_stats
+if interactive:
+    my_stats = IR3ChannelStats(my_X.shape[2])
+    my_stats.update(my_X, my_sub)
+    print(my_stats.get_norm(subjects = list(my_stats.subjects)[:1]))
+
+def normalize_ir3_batch(x, norm, out = None):
+    """Applies norm = dict(center, scale) from IR3ChannelStats.get_norm to a
+    batch of windows, (x - center) / scale per channel in float32.  out may be
+    x itself to normalize in place."""
+    out = np.subtract(x, norm['center'], out = out, dtype = 'float32')
+    return np.divide(out, norm['scale'], out = out)
+
+"""# Memory-mapped IR3 store
+An IR3 saved as .npy files in a directory plus a manifest.json describing the
+arrays.  get_ir3_from_dict(..., store_dir = ) writes each IR2 into the files
+as it is built so the IR3 never has to fit in RAM, load_ir3_store returns
+memmaps which only page in the windows that are actually used.
+"""
+
+ir3_store_dtypes = {'X':'float32', 'y':'int8', 'sub':'int16', 'ss_times':'datetime64[ns]'}
+
+def create_ir3_store(store_dir, max_windows, num_channels, win_len = None,
+                     dtypes = {}):
+    """Creates X, y, sub, ss_times .npy files sized for max_windows windows,
+    win_len defaults to the global time_steps.  dtypes overrides entries of
+    ir3_store_dtypes, e.g. {'y':'<U10'} for loaders with string labels.  Returns a dict of writeable memmaps, key = array name.  The files are
+    trimmed to the final number of windows by close_ir3_store."""
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    if os.path.isfile(os.path.join(store_dir, 'manifest.json')):
+        print("WARNING:", store_dir, "contains an IR3 store, overwriting")
+        os.remove(os.path.join(store_dir, 'manifest.json'))
+    if win_len is None:
+        win_len = time_steps
+    shapes = {'X':(max_windows, win_len, num_channels), 'y':(max_windows, 1),
+              'sub':(max_windows, 1), 'ss_times':(max_windows, 2)}
+    ir3_store = {}
+    for name, dtype in dict(ir3_store_dtypes, **dtypes).items():
+        ir3_store[name] = np.lib.format.open_memmap(os.path.join(store_dir, name + '.npy'),
+                                                    mode = 'w+', dtype = dtype, shape = shapes[name])
+    return ir3_store
+
+def trim_npy_file(fname, num_rows):
+    """Shrinks a .npy file to the first num_rows rows in place.  The header
+    is rewritten to the same length so the data offset does not change."""
+    with open(fname, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_len = f.tell()
+        new_shape = (num_rows,) + shape[1:]
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                       'fortran_order': fortran_order, 'shape': new_shape})
+        prefix_len = 10 if version == (1, 0) else 12 # magic + version + header size
+        header = header.ljust(header_len - prefix_len - 1) + '\n'
+        f.seek(prefix_len)
+        f.write(header.encode('latin1'))
+        f.truncate(header_len + num_rows * int(np.prod(shape[1:])) * dtype.itemsize)
+
+def close_ir3_store(store_dir, ir3_store, num_windows, channel_list, label_map,
+                    info = '', window_cfg = None, channel_stats = None,
+                    source_dtypes = None):
+    """Flushes the memmaps from create_ir3_store, trims the files to
+    num_windows and writes the manifest.  The memmaps in ir3_store must not be
+    used afterwards, reopen with load_ir3_store.  window_cfg is only used to
+    record the stride, see get_window_cfg.  channel_stats (IR3ChannelStats)
+    is saved in the manifest, see get_ir3_store_channel_stats.  source_dtypes
+    records the dtypes of arrays that were converted when stored."""
+    stride = get_window_cfg(window_cfg)[1]
+    win_len = ir3_store['X'].shape[1]
+    dtypes = {name: str(ir3_store[name].dtype) for name in ir3_store_dtypes}
+    for name in ir3_store_dtypes:
+        ir3_store[name].flush()
+    ir3_store.clear() # trimming a file that is still mapped is asking for trouble
+    for name in ir3_store_dtypes:
+        trim_npy_file(os.path.join(store_dir, name + '.npy'), num_windows)
+    manifest = {'num_windows': int(num_windows),
+                'channels': list(channel_list),
+                'label_map': label_map,
+                'time_steps': win_len,
+                'stride': stride,
+                'dtypes': dtypes,
+                'created': time.strftime('%b-%d-%Y_%H%M', time.localtime()),
+                'info': info}
+    if source_dtypes:
+        manifest['source_dtypes'] = source_dtypes
+    if channel_stats is not None:
+        manifest['channel_stats'] = channel_stats.to_dict()
+    # manifest last, a store without one was interrupted while being written
+    with open(os.path.join(store_dir, 'manifest.json'), 'w') as file_object:
+        json.dump(manifest, file_object, indent = 2, default = str)
+
+def save_ir3_store(store_dir, X, y, sub, ss_times = None, channel_list = [],
+                   label_map = {}, info = '', window_cfg = None):
+    """Writes IR3 arrays that are already in RAM as an IR3 store, replaces
+    the np.save cells in the individual loaders.  ss_times may be None for
+    older loaders, the array is filled with NaT.  y and sub keep their dtype
+    so string labels can be stored as is.  X is always stored as float32
+    (ir3_store_dtypes), a float64 X is downcast and its original dtype is
+    kept in the manifest as source_dtypes.  The channel statistics are
+    accumulated while X is copied, see IR3ChannelStats."""
+    ir3_store = create_ir3_store(store_dir, X.shape[0], X.shape[2], win_len = X.shape[1],
+                                 dtypes = {'y':y.dtype, 'sub':sub.dtype})
+    channel_stats = IR3ChannelStats(X.shape[2])
+    for start in range(0, X.shape[0], 4096):
+        X_chunk = np.asarray(X[start:start + 4096])
+        ir3_store['X'][start:start + 4096] = X_chunk
+        channel_stats.update(X_chunk, np.asarray(sub).reshape(-1)[start:start + 4096])
+    ir3_store['y'][:] = y.reshape(-1, 1)
+    ir3_store['sub'][:] = sub.reshape(-1, 1)
+    if ss_times is None:
+        ir3_store['ss_times'][:] = np.datetime64('NaT')
+    else:
+        ir3_store['ss_times'][:] = ss_times
+    source_dtypes = None
+    if X.dtype != ir3_store['X'].dtype:
+        source_dtypes = {'X': str(X.dtype)}
+        if verbose:
+            print("save_ir3_store converting X from", X.dtype, "to", ir3_store['X'].dtype)
+    close_ir3_store(store_dir, ir3_store, X.shape[0], channel_list, label_map, info,
+                    window_cfg = window_cfg, channel_stats = channel_stats,
+                    source_dtypes = source_dtypes)
+
+def load_ir3_store(store_dir, mmap_mode = 'r'):
+    """Opens an IR3 store written by get_ir3_from_dict or save_ir3_store.
+    Args:
+        store_dir - directory containing manifest.json and the .npy files
+        mmap_mode - passed to np.load, 'r' (default), 'r+', 'c' or None to
+            read the arrays into RAM
+    Returns:
+        X, y, sub, ss_times (memmaps unless mmap_mode = None) and the
+        manifest dict"""
+    manifest_fname = os.path.join(store_dir, 'manifest.json')
+    if not os.path.isfile(manifest_fname):
+        raise FileNotFoundError("no IR3 store manifest found in " + store_dir)
+    with open(manifest_fname, 'r') as file_object:
+        manifest = json.load(file_object)
+    arrays = [np.load(os.path.join(store_dir, name + '.npy'), mmap_mode = mmap_mode)
+              for name in ir3_store_dtypes]
+    if verbose:
+        print('Loaded IR3 store', store_dir, 'with', manifest['num_windows'], 'windows')
+    return arrays[0], arrays[1], arrays[2], arrays[3], manifest
+
+def get_cached_ir3(ir3_params, build_fn, *build_args, refresh = False,
+                   cache_dir = None, source_files = None):
+    """Returns the IR3 for ir3_params from the IR3 cache, building and storing
+    it on a miss.  Loaders should cache the IR3 for all subjects so different
+    subject splits are just an index into the same (memory-mapped) arrays.
+    Only the loaders that build an IR3 from an IR1 dictionary use it
+    (TWristAR, Gesture Phase Segmentation, Leotta and SHL).  UCI HAR, UniMiB,
+    MobiAct, e4 and ue4w read ready made arrays without an IR1/IR3 step and
+    CMU-MMAC only caches its IR1s, see get_cached_ir1.
+    Args:
+        ir3_params - dict of everything that changes the IR3, typically dataset,
+            time_steps, stride, resample, label_method, label_map,
+            drop_labels and channels.  Must be json serializable (str is
+            used for anything else).
+        build_fn - called as build_fn(store_dir, *build_args) on a miss,
+            returns X, y, sub, ss_times (None allowed), channel_list.  It
+            may write the IR3 store itself, e.g. with
+            get_ir3_from_dict(..., store_dir = store_dir), otherwise the
+            returned arrays are saved with save_ir3_store.
+        refresh - True rebuilds the IR3 even if it is in the cache
+        cache_dir - overrides the global ir3_cache_dir, None in both = no cache
+            (the default, the cache is opt-in)
+        source_files - list of the raw dataset files, their sizes and
+            modification times are part of the key so a re-downloaded or
+            edited source rebuilds the IR3
+    Returns:
+        X, y, sub, ss_times and a one line cache report for log_info"""
+    store_dir = get_ir3_cache_store_dir(ir3_params, cache_dir, source_files)
+    if store_dir is None:
+        X, y, sub, ss_times, channel_list = build_fn(None, *build_args)
+        # the build may have downloaded the missing source files
+        store_dir = get_ir3_cache_store_dir(ir3_params, cache_dir, source_files)
+        if store_dir is None:
+            return X, y, sub, ss_times, "IR3 cache disabled\n"
+        save_ir3_store(store_dir, X, y, sub, ss_times, channel_list,
+                       label_map = ir3_params.get('label_map', {}),
+                       window_cfg = ir3_params)
+        add_ir3_params_to_manifest(store_dir, ir3_params)
+        X, y, sub, ss_times, manifest = load_ir3_store(store_dir)
+        return X, y, sub, ss_times, "IR3 cache miss, saved to " + store_dir + "\n"
+    manifest_fname = os.path.join(store_dir, 'manifest.json')
+    if os.path.isfile(manifest_fname) and not refresh:
+        X, y, sub, ss_times, manifest = load_ir3_store(store_dir)
+        return X, y, sub, ss_times, "IR3 cache hit " + store_dir + "\n"
+    if os.path.isfile(manifest_fname):
+        os.remove(manifest_fname)
+    X, y, sub, ss_times, channel_list = build_fn(store_dir, *build_args)
+    if not os.path.isfile(manifest_fname): # build_fn didn't write the store
+        save_ir3_store(store_dir, X, y, sub, ss_times, channel_list,
+                       label_map = ir3_params.get('label_map', {}),
+                       window_cfg = ir3_params)
+    add_ir3_params_to_manifest(store_dir, ir3_params)
+    X, y, sub, ss_times, manifest = load_ir3_store(store_dir)
+    return X, y, sub, ss_times, "IR3 cache miss, saved to " + store_dir + "\n"
+
+def get_source_files_stat(source_files):
+    """Returns [file name, size, modification time] for each source file,
+    None if any of them is missing (e.g. not downloaded yet)."""
+    files_stat = []
+    for ffname in source_files:
+        if not os.path.isfile(ffname):
+            return None
+        stat = os.stat(ffname)
+        files_stat.append([os.path.basename(ffname), stat.st_size, stat.st_mtime_ns])
+    return files_stat
+
+def get_ir3_cache_store_dir(ir3_params, cache_dir = None, source_files = None):
+    """Returns the IR3 store directory for ir3_params, the key is a hash of
+    the params and the size and modification time of the source_files.
+    None if caching is disabled (cache_dir and the global ir3_cache_dir both
+    None) or a source file is missing."""
+    if cache_dir is None:
+        cache_dir = ir3_cache_dir
+    if cache_dir is None:
+        return None
+    key_params = ir3_params
+    if source_files is not None:
+        files_stat = get_source_files_stat(source_files)
+        if files_stat is None:
+            return None
+        key_params = dict(ir3_params, source_files = files_stat)
+    params_json = json.dumps(key_params, sort_keys = True, default = str)
+    key = hashlib.sha1(params_json.encode()).hexdigest()
+    return os.path.join(cache_dir, str(ir3_params.get('dataset', 'unknown')), key)
+
+def add_ir3_params_to_manifest(store_dir, ir3_params):
+    """Records the ir3_params in the manifest of a newly cached IR3 store so
+    the cache directory can be inspected without the hashes."""
+    manifest_fname = os.path.join(store_dir, 'manifest.json')
+    with open(manifest_fname, 'r') as file_object:
+        manifest = json.load(file_object)
+    manifest['ir3_params'] = json.loads(json.dumps(ir3_params, sort_keys = True, default = str))
+    with open(manifest_fname, 'w') as file_object:
+        json.dump(manifest, file_object, indent = 2, default = str)
+
+def get_ir3_store_channel_stats(store_dir):
+    """Returns the IR3ChannelStats saved in an IR3 store manifest.  Stores
+    written before the statistics were added get them from one chunked pass
+    over X, they are then saved in the manifest."""
+    manifest_fname = os.path.join(store_dir, 'manifest.json')
+    with open(manifest_fname, 'r') as file_object:
+        manifest = json.load(file_object)
+    if 'channel_stats' in manifest:
+        return IR3ChannelStats.from_dict(manifest['channel_stats'])
+    if verbose:
+        print("No channel_stats in", manifest_fname, "computing from X")
+    X, y, sub, ss_times, manifest = load_ir3_store(store_dir)
+    channel_stats = IR3ChannelStats(X.shape[2])
+    channel_stats.update(X, sub)
+    del X, y, sub, ss_times
+    manifest['channel_stats'] = channel_stats.to_dict()
+    with open(manifest_fname, 'w') as file_object:
+        json.dump(manifest, file_object, indent = 2, default = str)
+    return channel_stats
+
+def get_cached_ir3_channel_stats(ir3_params, cache_dir = None, source_files = None):
+    """IR3ChannelStats of the IR3 cached by get_cached_ir3 for ir3_params
+    (and source_files), None if caching is disabled or the IR3 isn't cached.
+    Typical use:
+    norm = get_cached_ir3_channel_stats(ir3_params).get_norm(train_subj)"""
+    store_dir = get_ir3_cache_store_dir(ir3_params, cache_dir, source_files)
+    if store_dir is None or not os.path.isfile(os.path.join(store_dir, 'manifest.json')):
+        print("WARNING: no cached IR3 found for", ir3_params.get('dataset'))
+        return None
+    return get_ir3_store_channel_stats(store_dir)
+
+"""# Parallel IR1 to IR2 processing
+Each IR1 in the dictionary is windowed and cleaned independently so the
+sessions can be processed concurrently, see executor in get_ir3_from_dict.
+The results are always copied into the IR3 in dictionary order.
+"""
+
+def get_clean_ir2_view(ir1_df, label_map, label_method = 'drop',
+                       purity_threshold = None, window_cfg = None):
+    """The per-session step of get_ir3_from_dict: int labels, windowing,
+    label unification, NaN and 'Undefined' (99) window removal.
+    Returns an IR2WindowView."""
+    ir1_df = assign_ints_ir1_labels(ir1_df, label_mapping_dict = label_map)
+    ir2_view = get_ir2_view_from_ir1(ir1_df, label_method = label_method,
+                                     purity_threshold = purity_threshold,
+                                     window_cfg = window_cfg)
+    return ir2_view.drop_nan().drop_label(99)
+
+def gather_ir2_view(ir2_view, ir3_X, ir3_y, ir3_sub, ir3_ss_times, start,
+                    batch_size = 4096, channel_stats = None):
+    """Copies all windows of ir2_view into the IR3 arrays beginning at row
+    start.  batch_size bounds the row index array used by the gather.
+    channel_stats (IR3ChannelStats) is updated with each batch while it is
+    still in cache.  Returns the next free row."""
+    for i in range(0, len(ir2_view), batch_size):
+        key = slice(i, i + batch_size)
+        stop = start + len(ir2_view.offsets[key])
+        _, ir3_y[start:stop], ir3_sub[start:stop], ir3_ss_times[start:stop] = \
+            ir2_view.get_batch(key, out = ir3_X[start:stop])
+        if channel_stats is not None:
+            channel_stats.update(ir3_X[start:stop], ir3_sub[start:stop])
+        start = stop
+    return start
+
+def init_ir2_worker(worker_verbose):
+    """ProcessPoolExecutor initializer, a spawned worker re-imports this module
+    so verbose has to be copied over, the window_cfg is passed explicitly."""
+    global verbose
+    verbose = worker_verbose
+
+def get_ir2_block_worker(ir1_df, label_map, label_method, purity_threshold,
+                         window_cfg):
+    """Process worker for get_ir3_from_dict.  The windows are written to a new
+    shared memory block instead of being pickled back to the parent, the
+    parent copies them into the IR3 and unlinks the block (the parent owns it
+    from then on).  y, sub and
+    ss_times are small and are returned normally.  Only this return path uses
+    shared memory, ir1_df is still pickled to the worker by the executor.
+    Returns shm name, number of windows, y, sub, ss_times, channel_list"""
+    ir2_view = get_clean_ir2_view(ir1_df, label_map, label_method, purity_threshold,
+                                  window_cfg)
+    num_windows = len(ir2_view)
+    X_shape = (num_windows, ir2_view.win_len, len(ir2_view.channel_list))
+    shm = shared_memory.SharedMemory(create = True,
+                                     size = max(1, int(np.prod(X_shape)) * 4))
+    X = np.ndarray(X_shape, dtype = 'float32', buffer = shm.buf)
+    y = np.empty((num_windows, 1), dtype = 'int8')
+    sub = np.empty((num_windows, 1), dtype = 'int16')
+    ss_times = np.empty((num_windows, 2), dtype = 'datetime64[ns]')
+    gather_ir2_view(ir2_view, X, y, sub, ss_times, 0)
+    del X # the buffer can't be closed while an array still points at it
+    shm.close()
+    # the parent unlinks the block, so this process must not track it too or
+    # the resource_tracker reports it as leaked (and fails to unlink it again).
+    # Only posix blocks are tracked, under the name with its leading slash.
+    if os.name == 'posix':
+        resource_tracker.unregister('/' + shm.name, 'shared_memory')
+    return shm.name, num_windows, y, sub, ss_times, ir2_view.channel_list
+
+def get_ir3_from_dict(ir1_dict, label_map, label_method = 'drop',
+                      assembly = 'prealloc', purity_threshold = None,
+                      store_dir = None, executor = 'serial', num_workers = None,
+                      window_cfg = None, channel_stats = None):
     """Processes a dictionary and combines the IR1 dataframes into a single
     IR3 set of numpy arrays.  Converts string labels to integers based on the
     passed label map.
@@ -483,6 +1982,30 @@ def get_ir3_from_dict(ir1_dict, label_map, label_method = 'drop'):
          all possible strings and item = corresponding int.)
     label_method: string if 'drop' all mixed labels will be discarded
                          if 'mode' all labels in window set to mode of labels
+    purity_threshold: None or float 0.0-1.0, keep windows where the majority
+                         label covers at least this fraction of the window,
+                         see unify_ir2_labels.
+    assembly: string if 'prealloc' (default) the number of windows for each
+                         IR1 is computed first, the IR3 arrays are allocated
+                         once and the windows of each IR2WindowView are
+                         gathered directly into its slice.
+                     if 'vstack' the original method of stacking each IR2
+                         onto the IR3, RAM use is roughly 2X the final IR3.
+    store_dir: None or directory, if given the IR3 is written to a memory-mapped
+                         IR3 store there as it is built (requires 'prealloc')
+                         and the returned arrays are read-only memmaps.
+    executor: string 'serial' (default) one IR1 at a time
+                     'thread' IR1s are windowed and copied into the IR3 by a
+                         thread pool, numpy releases the GIL for the copies
+                     'process' IR1s are processed by a process pool, the
+                         windows come back through shared memory.
+                         Requires 'prealloc'.
+    num_workers: None (all cores) or int, pool size for thread and process
+    window_cfg: dict with time_steps and stride, None = the module globals,
+                         see get_window_cfg
+    channel_stats: None or an IR3ChannelStats updated with every block of
+                         windows as it is added to the IR3.  With a store_dir
+                         one is always kept and saved in the manifest.
     Returns:
     X - ndarray (float32) of all channels
     y - ndarray (int8) of labels, for multi-label datasets # labels = # columns
@@ -494,6 +2017,20 @@ def get_ir3_from_dict(ir1_dict, label_map, label_method = 'drop'):
     # I've been just working on it in the TWRistAR loader paste the working code here.
     # Also this treats train and test the same - newer method being worked on
     # in the Leotta loader.
+    time_steps, stride = get_window_cfg(window_cfg)
+    # explicit values, a spawned process worker has its own default globals
+    window_cfg = dict(window_cfg or {}, time_steps = time_steps, stride = stride)
+    if assembly not in ('prealloc', 'vstack'):
+        raise ValueError("get_ir3_from_dict assembly must be 'prealloc' or 'vstack', got "
+                         + repr(assembly))
+    if store_dir is not None and assembly != 'prealloc':
+        raise ValueError("get_ir3_from_dict store_dir requires assembly = 'prealloc'")
+    if executor not in ('serial', 'thread', 'process'):
+        raise ValueError("get_ir3_from_dict executor must be 'serial', 'thread' or 'process', got "
+                         + repr(executor))
+    if executor != 'serial' and assembly != 'prealloc':
+        raise ValueError("get_ir3_from_dict executor " + repr(executor)
+                         + " requires assembly = 'prealloc'")
     df_list = list(ir1_dict) # ir1_dict.keys() returns a dict_keys type
     col_list = list(ir1_dict[df_list[0]].columns) # all columns in df
     label_list = list(label_map) # in case of multi-labeled dataset
@@ -507,29 +2044,123 @@ def get_ir3_from_dict(ir1_dict, label_map, label_method = 'drop'):
             pass
 
     num_channels = len(col_list)
-    ir3_X = np.zeros(shape=(1,time_steps,num_channels), dtype = 'float32')
-    ir3_y = np.zeros(shape=(1,1),dtype='int8') # ints - strings take too much space
-    #ir3_y = np.full(shape=(1,1), fill_value='n/a',dtype='<U10') # unicode 10 char
-    ir3_sub = np.zeros(shape=(1,1),dtype='int16') # some dataset have sub# > 255
-    ir3_ss_times = np.zeros(shape=(1,2),dtype='datetime64') # start/stop times of sliding window
-    for ir1_fname, ir1_df in ir1_dict.items():
+    if channel_stats is None and store_dir is not None:
+        channel_stats = IR3ChannelStats(num_channels)
+    if assembly == 'prealloc':
+        # First pass - the number of windows only depends on the IR1 length so
+        # the IR3 can be sized before any of the IR2s are built.  This is an
+        # upper bound, windows dropped during cleaning are trimmed at the end.
+        max_windows = 0
+        for ir1_df in ir1_dict.values():
+            max_windows += get_ir1_window_count(ir1_df, window_cfg)
         if verbose:
-            print('Processing ', ir1_fname)
-        ir1_df = assign_ints_ir1_labels(ir1_df, label_mapping_dict = label_map)
-        ir2_X, ir2_y, ir2_sub, ir2_ss_time, channel_list = get_ir2_from_ir1(ir1_df)
-        ir2_X, ir2_y, ir2_sub, ir2_ss_time = drop_ir2_nan(ir2_X, ir2_y, ir2_sub, ir2_ss_time)
-        ir2_X, ir2_y, ir2_sub, ir2_ss_time = unify_ir2_labels(ir2_X, ir2_y, ir2_sub, ir2_ss_time, method = label_method)
-        ir2_X, ir2_y, ir2_sub, ir2_ss_time = drop_label_ir2_ir3(ir2_X, ir2_y, ir2_sub, ir2_ss_time, 99)
-        ir3_X = np.vstack([ir3_X, ir2_X])
-        ir3_y = np.vstack([ir3_y, ir2_y])
-        ir3_sub = np.vstack([ir3_sub, ir2_sub])
-        ir3_ss_times = np.vstack([ir3_ss_times, ir2_ss_time])
-    #delete first row placeholders
-    X = np.delete(ir3_X, (0), axis=0) 
-    y = np.delete(ir3_y, (0), axis=0) 
-    sub = np.delete(ir3_sub, (0), axis=0)
-    sub = np.delete(ir3_sub, (0), axis=0)
-    ss_times = np.delete(ir3_ss_times, (0), axis=0)
+            print('get_ir3_from_dict preallocating IR3 for', max_windows, 'windows')
+        if store_dir is None:
+            ir3_X = np.empty(shape=(max_windows,time_steps,num_channels), dtype = 'float32')
+            ir3_y = np.empty(shape=(max_windows,1),dtype='int8')
+            ir3_sub = np.empty(shape=(max_windows,1),dtype='int16')
+            ir3_ss_times = np.empty(shape=(max_windows,2),dtype='datetime64[ns]')
+        else:
+            ir3_store = create_ir3_store(store_dir, max_windows, num_channels, win_len = time_steps)
+            ir3_X, ir3_y = ir3_store['X'], ir3_store['y']
+            ir3_sub, ir3_ss_times = ir3_store['sub'], ir3_store['ss_times']
+        num_windows = 0 # next free row in the IR3 arrays
+    else:
+        ir3_X = np.zeros(shape=(1,time_steps,num_channels), dtype = 'float32')
+        ir3_y = np.zeros(shape=(1,1),dtype='int8') # ints - strings take too much space
+        #ir3_y = np.full(shape=(1,1), fill_value='n/a',dtype='<U10') # unicode 10 char
+        ir3_sub = np.zeros(shape=(1,1),dtype='int16') # some dataset have sub# > 255
+        ir3_ss_times = np.zeros(shape=(1,2),dtype='datetime64') # start/stop times of sliding window
+    if executor == 'thread':
+        with ThreadPoolExecutor(max_workers = num_workers) as pool:
+            # views are only offsets so build them all first, then the row
+            # each one starts at in the IR3 is known and the copies can run
+            # concurrently into their own slices.
+            ir2_views = list(pool.map(get_clean_ir2_view, ir1_dict.values(),
+                                      [label_map] * len(ir1_dict),
+                                      [label_method] * len(ir1_dict),
+                                      [purity_threshold] * len(ir1_dict),
+                                      [window_cfg] * len(ir1_dict)))
+            view_starts = np.cumsum([0] + [len(i) for i in ir2_views])
+            list(pool.map(gather_ir2_view, ir2_views, [ir3_X] * len(ir2_views),
+                          [ir3_y] * len(ir2_views), [ir3_sub] * len(ir2_views),
+                          [ir3_ss_times] * len(ir2_views), view_starts[:-1],
+                          [4096] * len(ir2_views), [channel_stats] * len(ir2_views)))
+        num_windows = int(view_starts[-1])
+        channel_list = ir2_views[0].channel_list
+    elif executor == 'process':
+        with ProcessPoolExecutor(max_workers = num_workers, initializer = init_ir2_worker,
+                                 initargs = (verbose,)) as pool:
+            results = pool.map(get_ir2_block_worker, ir1_dict.values(),
+                               [label_map] * len(ir1_dict),
+                               [label_method] * len(ir1_dict),
+                               [purity_threshold] * len(ir1_dict),
+                               [window_cfg] * len(ir1_dict))
+            # map returns in submission order, so the IR3 is in dict order
+            for shm_name, num_block, y_block, sub_block, ss_block, channel_list in results:
+                shm = shared_memory.SharedMemory(name = shm_name)
+                X_block = np.ndarray((num_block, time_steps, num_channels),
+                                     dtype = 'float32', buffer = shm.buf)
+                next_num_windows = num_windows + num_block
+                ir3_X[num_windows:next_num_windows] = X_block
+                ir3_y[num_windows:next_num_windows] = y_block
+                ir3_sub[num_windows:next_num_windows] = sub_block
+                ir3_ss_times[num_windows:next_num_windows] = ss_block
+                if channel_stats is not None:
+                    channel_stats.update(X_block, sub_block)
+                num_windows = next_num_windows
+                del X_block
+                shm.close()
+                shm.unlink()
+    else: # serial
+        for ir1_fname, ir1_df in ir1_dict.items():
+            if verbose:
+                print('Processing ', ir1_fname)
+            if assembly == 'prealloc':
+                # the windows are gathered straight from the IR1 into the IR3
+                # slice, the only full size copy is the IR3 itself.
+                ir2_view = get_clean_ir2_view(ir1_df, label_map, label_method, purity_threshold,
+                                              window_cfg)
+                channel_list = ir2_view.channel_list
+                num_windows = gather_ir2_view(ir2_view, ir3_X, ir3_y, ir3_sub, ir3_ss_times, num_windows,
+                                              channel_stats = channel_stats)
+                continue
+            ir1_df = assign_ints_ir1_labels(ir1_df, label_mapping_dict = label_map)
+            ir1_df = get_ir1_gap_filled(ir1_df, window_cfg) # so purity sees the same rows
+            # purity comes from the IR1 label column so it lines up with the raw
+            # windows, unify before drop_ir2_nan which would shift the rows.
+            # Both are per-window filters so the order does not change the result.
+            purity = get_ir1_label_purity(ir1_df['label'].to_numpy(),
+                                          starts = get_ir2_window_offsets(ir1_df.index, window_cfg),
+                                          window_cfg = window_cfg)
+            ir2_X, ir2_y, ir2_sub, ir2_ss_time, channel_list = get_ir2_from_ir1(ir1_df, window_cfg)
+            ir2_X, ir2_y, ir2_sub, ir2_ss_time = unify_ir2_labels(ir2_X, ir2_y, ir2_sub, ir2_ss_time, method = label_method,
+                                                                  purity = purity, purity_threshold = purity_threshold)
+            ir2_X, ir2_y, ir2_sub, ir2_ss_time = drop_ir2_nan(ir2_X, ir2_y, ir2_sub, ir2_ss_time)
+            ir2_X, ir2_y, ir2_sub, ir2_ss_time = drop_label_ir2_ir3(ir2_X, ir2_y, ir2_sub, ir2_ss_time, 99)
+            if channel_stats is not None:
+                channel_stats.update(ir2_X, ir2_sub)
+            ir3_X = np.vstack([ir3_X, ir2_X])
+            ir3_y = np.vstack([ir3_y, ir2_y])
+            ir3_sub = np.vstack([ir3_sub, ir2_sub])
+            ir3_ss_times = np.vstack([ir3_ss_times, ir2_ss_time])
+    if store_dir is not None:
+        del ir3_X, ir3_y, ir3_sub, ir3_ss_times # release the maps before trimming
+        close_ir3_store(store_dir, ir3_store, num_windows, channel_list, label_map,
+                        info = 'Generated by get_ir3_from_dict, label_method = ' + label_method,
+                        window_cfg = window_cfg, channel_stats = channel_stats)
+        X, y, sub, ss_times, manifest = load_ir3_store(store_dir)
+    elif assembly == 'prealloc':
+        # trim the unused rows with a view, no copy of the IR3.  The rows past
+        # num_windows stay allocated until the arrays are released.
+        X, y, sub, ss_times = [ir3_array[:num_windows] for ir3_array in
+                               (ir3_X, ir3_y, ir3_sub, ir3_ss_times)]
+    else:
+        #delete first row placeholders
+        X = np.delete(ir3_X, (0), axis=0) 
+        y = np.delete(ir3_y, (0), axis=0) 
+        sub = np.delete(ir3_sub, (0), axis=0)
+        ss_times = np.delete(ir3_ss_times, (0), axis=0)
 
     xys_info = 'Needs work!\n'
     # xys_info += '\n'.join([str(elem) for elem in zip_flist]) # conv list to string
@@ -589,4 +2220,480 @@ if interactive:
     my_new_X = limit_channel_ir3(my_X, all_channel_list,
                                  keep_channel_list = ['lhx', 'lhy', 'lhz'])
     print("ending X shape", my_new_X.shape)
-    print("first row", my_new_X[0,0,:])
\ No newline at end of file
+    print("first row", my_new_X[0,0,:])
+
+"""# Window configuration sweep
+Tuning the window length with get_ir3_from_dict means one full pass over the
+IR1 dictionary per (time_steps, stride) pair.  The sweep converts each IR1
+once (int labels, get_ir1_arrays) and builds every configuration's IR3 from
+the same float32 buffers.
+"""
+
+def get_ir3_sweep_from_dict(ir1_dict, label_map, window_cfgs, label_method = 'drop',
+                            purity_threshold = None, store_dirs = None):
+    """Builds one IR3 per window config in a single pass over ir1_dict.  Each
+    IR3 is the same as get_ir3_from_dict(..., assembly = 'prealloc',
+    window_cfg = window_cfgs[i]) would return.
+    Args:
+        ir1_dict, label_map, label_method, purity_threshold - see get_ir3_from_dict
+        window_cfgs - list of window_cfg dicts, see get_window_cfg
+        store_dirs - None or a list the same length as window_cfgs, entries
+            that are not None write that IR3 to a memory-mapped IR3 store
+    Returns:
+        list of (X, y, sub, ss_times, xys_info) tuples, one per window config"""
+    # explicit values so a later change to the globals can't mix configs
+    window_cfgs = [dict(i or {}, **dict(zip(('time_steps', 'stride'), get_window_cfg(i))))
+                   for i in window_cfgs]
+    if any([i.get('gap_fill') for i in window_cfgs]):
+        raise ValueError("get_ir3_sweep_from_dict can't share the IR1 arrays with a gap_fill,"
+                         " fill the IR1s first with fill_ir1_gaps")
+    if store_dirs is None:
+        store_dirs = [None] * len(window_cfgs)
+    if len(store_dirs) != len(window_cfgs):
+        raise ValueError("get_ir3_sweep_from_dict needs one store_dir per window config")
+    channel_list = [col for col in ir1_dict[list(ir1_dict)[0]].columns
+                    if col not in list(label_map) + ['sub']]
+    ir3s = [] # per config [X, y, sub, ss_times, ir3_store or None]
+    for window_cfg, store_dir in zip(window_cfgs, store_dirs):
+        max_windows = sum([get_ir1_window_count(ir1_df, window_cfg)
+                           for ir1_df in ir1_dict.values()])
+        if store_dir is None:
+            ir3s.append([np.empty((max_windows, window_cfg['time_steps'], len(channel_list)), dtype = 'float32'),
+                         np.empty((max_windows, 1), dtype = 'int8'),
+                         np.empty((max_windows, 1), dtype = 'int16'),
+                         np.empty((max_windows, 2), dtype = 'datetime64[ns]'), None])
+        else:
+            ir3_store = create_ir3_store(store_dir, max_windows, len(channel_list),
+                                         win_len = window_cfg['time_steps'])
+            ir3s.append([ir3_store['X'], ir3_store['y'], ir3_store['sub'],
+                         ir3_store['ss_times'], ir3_store])
+    num_windows = [0] * len(window_cfgs) # next free row of each IR3
+    for ir1_fname, ir1_df in ir1_dict.items():
+        if verbose:
+            print('Sweeping', len(window_cfgs), 'window configs over', ir1_fname)
+        ir1_df = assign_ints_ir1_labels(ir1_df, label_mapping_dict = label_map)
+        ir1_arrays = get_ir1_arrays(ir1_df) # the only conversion of this IR1
+        for i, window_cfg in enumerate(window_cfgs):
+            ir2_view = get_ir2_view_from_ir1_arrays(ir1_arrays, label_method,
+                                                    purity_threshold, window_cfg)
+            ir2_view = ir2_view.drop_nan().drop_label(99)
+            num_windows[i] = gather_ir2_view(ir2_view, *ir3s[i][:4], num_windows[i])
+    results = []
+    for i, window_cfg in enumerate(window_cfgs):
+        X, y, sub, ss_times, ir3_store = ir3s[i]
+        if ir3_store is None: # trim with a view, see get_ir3_from_dict
+            X, y, sub, ss_times = [ir3_array[:num_windows[i]] for ir3_array in
+                                   (X, y, sub, ss_times)]
+        else:
+            del X, y, sub, ss_times # release the maps before trimming
+            ir3s[i] = None
+            close_ir3_store(store_dirs[i], ir3_store, num_windows[i], channel_list, label_map,
+                            info = 'Generated by get_ir3_sweep_from_dict, label_method = ' + label_method,
+                            window_cfg = window_cfg)
+            X, y, sub, ss_times, manifest = load_ir3_store(store_dirs[i])
+        xys_info = 'time_steps = ' + str(window_cfg['time_steps'])
+        xys_info += ', stride = ' + str(window_cfg['stride']) + '\n'
+        xys_info += "IR1 Channel names:" + str(channel_list) + "\n"
+        results.append((X, y, sub, ss_times, xys_info))
+    return results
+
+def get_cached_ir3_sweep(ir3_params, window_cfgs, ir1_dict_fn, *ir1_dict_args,
+                         refresh = False, cache_dir = None, source_files = None):
+    """get_cached_ir3 for a list of window configs.  Each config is cached
+    under ir3_params with its time_steps and stride filled in, all of the
+    misses are built together by one get_ir3_sweep_from_dict pass.
+    Args:
+        ir3_params - see get_cached_ir3, must include label_map and
+            label_method, time_steps and stride are set from window_cfgs
+        window_cfgs - list of window_cfg dicts
+        ir1_dict_fn - called as ir1_dict_fn(*ir1_dict_args) only if at least
+            one config is not cached, returns the IR1 dictionary
+        refresh, cache_dir, source_files - see get_cached_ir3
+    Returns:
+        list of (X, y, sub, ss_times, cache report) tuples, one per config"""
+    window_cfgs = [dict(i or {}, **dict(zip(('time_steps', 'stride'), get_window_cfg(i))))
+                   for i in window_cfgs]
+    cfg_params = [dict(ir3_params, **window_cfg) for window_cfg in window_cfgs]
+    store_dirs = [get_ir3_cache_store_dir(params, cache_dir, source_files)
+                  for params in cfg_params]
+    results = [None] * len(window_cfgs)
+    misses = []
+    for i, store_dir in enumerate(store_dirs):
+        if (store_dir is not None and not refresh
+                and os.path.isfile(os.path.join(store_dir, 'manifest.json'))):
+            X, y, sub, ss_times, manifest = load_ir3_store(store_dir)
+            results[i] = (X, y, sub, ss_times, "IR3 cache hit " + store_dir + "\n")
+        else:
+            misses.append(i)
+    if len(misses) == 0:
+        return results
+    if verbose:
+        print("get_cached_ir3_sweep building", len(misses), "of", len(window_cfgs), "window configs")
+    ir1_dict = ir1_dict_fn(*ir1_dict_args)
+    sweep = get_ir3_sweep_from_dict(ir1_dict, ir3_params['label_map'],
+                                    [window_cfgs[i] for i in misses],
+                                    label_method = ir3_params['label_method'],
+                                    purity_threshold = ir3_params.get('purity_threshold'),
+                                    store_dirs = [store_dirs[i] for i in misses])
+    for i, (X, y, sub, ss_times, xys_info) in zip(misses, sweep):
+        if store_dirs[i] is None:
+            # the build may have downloaded the missing source files
+            store_dirs[i] = get_ir3_cache_store_dir(cfg_params[i], cache_dir, source_files)
+            if store_dirs[i] is None:
+                results[i] = (X, y, sub, ss_times, "IR3 cache disabled\n")
+                continue
+            channel_list = [col for col in ir1_dict[list(ir1_dict)[0]].columns
+                            if col not in list(ir3_params['label_map']) + ['sub']]
+            save_ir3_store(store_dirs[i], X, y, sub, ss_times, channel_list,
+                           label_map = ir3_params['label_map'], window_cfg = cfg_params[i])
+        add_ir3_params_to_manifest(store_dirs[i], cfg_params[i])
+        results[i] = (X, y, sub, ss_times, "IR3 cache miss, saved to " + store_dirs[i] + "\n")
+    return results
+# Like get_ir3_from_dict this needs an IR1 dictionary, e.g. in TWristAR
+# if interactive:
+#     for X, y, sub, ss_times, cache_info in get_cached_ir3_sweep(
+#             ir3_params, [dict(time_steps = 64, stride = 32), dict(time_steps = 96, stride = 32)],
+#             get_twristar_ir1_dict):
+#         print(cache_info, tabulate_numpy_arrays({'X':X, 'y':y, 'sub':sub, 'ss_times':ss_times}))
+
+"""# IR3 feature extraction
+Per window, per channel feature vectors for classical baselines (Random
+Forest, SVM etc.) computed over all windows at once instead of a loop over
+windows.  X is processed in chunks of windows so a memory-mapped IR3 is
+never read in full, the features can be cached next to the IR3 cache.
+"""
+
+ir3_feature_cfg = dict(
+    # feature groups in the order they appear in the feature vector
+    features = ['mean', 'std', 'min', 'max', 'rms', 'percentiles',
+                'zero_crossings', 'jerk', 'fft_bands'],
+    percentiles = [25, 50, 75],
+    # band edges as a fraction of the Nyquist frequency, so at 20Hz the
+    # default bands are 0-1, 1-2, 2-4 and 4-10Hz
+    fft_bands = [0.0, 0.1, 0.2, 0.4, 1.0])
+
+def get_ir3_feature_names(channel_list, feature_cfg = None):
+    """Returns the feature names in the column order of get_ir3_features,
+    e.g. 'accel_x_mean', feature major (all channels of the first feature,
+    then the second...).  feature_cfg defaults to ir3_feature_cfg."""
+    feature_cfg = dict(ir3_feature_cfg, **(feature_cfg or {}))
+    names = []
+    for feature in feature_cfg['features']:
+        if feature == 'percentiles':
+            names += ['p' + str(q) for q in feature_cfg['percentiles']]
+        elif feature == 'jerk':
+            names += ['jerk_abs_mean', 'jerk_std']
+        elif feature == 'fft_bands':
+            names += ['fft_band' + str(i) for i in range(len(feature_cfg['fft_bands']) - 1)]
+        else:
+            names.append(feature)
+    return [ch + '_' + name for name in names for ch in channel_list]
+
+def get_ir3_features_chunk(X, feature_cfg = None):
+    """Computes the features of a block of windows, see get_ir3_features.
+    Returns a float32 array (windows, features * channels)."""
+    feature_cfg = dict(ir3_feature_cfg, **(feature_cfg or {}))
+    X = np.asarray(X, dtype = 'float32')
+    features = [] # each entry (windows, channels)
+    mean = X.mean(axis = 1)
+    centered = X - mean[:, np.newaxis, :]
+    for feature in feature_cfg['features']:
+        if feature == 'mean':
+            features.append(mean)
+        elif feature == 'std':
+            features.append(X.std(axis = 1))
+        elif feature == 'min':
+            features.append(X.min(axis = 1))
+        elif feature == 'max':
+            features.append(X.max(axis = 1))
+        elif feature == 'rms':
+            features.append(np.sqrt(np.square(X).mean(axis = 1)))
+        elif feature == 'percentiles':
+            features += list(np.percentile(X, feature_cfg['percentiles'], axis = 1))
+        elif feature == 'zero_crossings':
+            # crossings of the window mean so a gravity offset doesn't hide them
+            signs = np.signbit(centered)
+            features.append((signs[:, 1:] != signs[:, :-1]).sum(axis = 1))
+        elif feature == 'jerk':
+            # first difference per sample, divide by the sample period for units/s
+            jerk = np.diff(X, axis = 1)
+            features.append(np.abs(jerk).mean(axis = 1))
+            features.append(jerk.std(axis = 1))
+        elif feature == 'fft_bands':
+            # power of the mean removed window, the DC component is the mean
+            power = np.square(np.abs(np.fft.rfft(centered, axis = 1))) / X.shape[1]
+            edges = np.round(np.asarray(feature_cfg['fft_bands']) * (power.shape[1] - 1)).astype(int)
+            edges[-1] = power.shape[1] # last band includes the Nyquist bin
+            for lo, hi in zip(edges[:-1], edges[1:]):
+                features.append(power[:, lo:hi].sum(axis = 1))
+        else:
+            raise ValueError("get_ir3_features unknown feature " + repr(feature))
+    return np.concatenate(features, axis = 1).astype('float32')
+
+def get_ir3_features(X, channel_list = None, feature_cfg = None,
+                     chunk_windows = 4096, out = None):
+    """Computes a feature vector for every window of an IR3 X.
+    Args:
+        X - IR3 X (windows, time_steps, channels), ndarray or memmap
+        channel_list - names for the feature names, default ch0, ch1...
+        feature_cfg - dict overriding entries of ir3_feature_cfg, features
+            is the list of groups: mean, std, min, max, rms, percentiles,
+            zero_crossings, jerk (abs mean and std of the first difference),
+            fft_bands (band powers of a batched rfft)
+        chunk_windows - windows per chunk, bounds the temporary arrays
+        out - optional float32 array to write into, e.g. an open_memmap
+    Returns:
+        features - float32 array (windows, features * channels)
+        feature_names - list of column names, see get_ir3_feature_names"""
+    if channel_list is None:
+        channel_list = ['ch' + str(i) for i in range(X.shape[2])]
+    feature_names = get_ir3_feature_names(channel_list, feature_cfg)
+    if out is None:
+        out = np.empty((X.shape[0], len(feature_names)), dtype = 'float32')
+    for start in range(0, X.shape[0], chunk_windows):
+        stop = min(start + chunk_windows, X.shape[0])
+        out[start:stop] = get_ir3_features_chunk(X[start:stop], feature_cfg)
+    if verbose:
+        print('get_ir3_features', X.shape, '->', out.shape)
+    return out, feature_names
+if interactive:
+    my_features, my_feature_names = get_ir3_features(my_X, all_channel_list)
+    print(my_features.shape, my_feature_names[:6])
+
+def get_cached_ir3_features(X, channel_list, ir3_params, feature_cfg = None,
+                            refresh = False, cache_dir = None, chunk_windows = 4096,
+                            source_files = None):
+    """get_ir3_features with the result cached in the IR3 cache.  The key is
+    ir3_params and source_files (the same passed to get_cached_ir3 for X)
+    plus the feature_cfg, the features are written chunk by chunk into a .npy.
+    Returns features (memmap), feature_names and a cache report line"""
+    feature_cfg = dict(ir3_feature_cfg, **(feature_cfg or {}))
+    store_dir = get_ir3_cache_store_dir(dict(ir3_params, feature_cfg = feature_cfg), cache_dir,
+                                        source_files)
+    if store_dir is None:
+        features, feature_names = get_ir3_features(X, channel_list, feature_cfg, chunk_windows)
+        return features, feature_names, "IR3 feature cache disabled\n"
+    manifest_fname = os.path.join(store_dir, 'manifest.json')
+    features_fname = os.path.join(store_dir, 'features.npy')
+    if os.path.isfile(manifest_fname) and not refresh:
+        with open(manifest_fname, 'r') as file_object:
+            manifest = json.load(file_object)
+        features = np.load(features_fname, mmap_mode = 'r')
+        return features, manifest['feature_names'], "IR3 feature cache hit " + store_dir + "\n"
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    if os.path.isfile(manifest_fname):
+        os.remove(manifest_fname)
+    feature_names = get_ir3_feature_names(channel_list, feature_cfg)
+    features = np.lib.format.open_memmap(features_fname, mode = 'w+', dtype = 'float32',
+                                         shape = (X.shape[0], len(feature_names)))
+    get_ir3_features(X, channel_list, feature_cfg, chunk_windows, out = features)
+    features.flush()
+    del features
+    manifest = {'num_windows': int(X.shape[0]),
+                'feature_names': feature_names,
+                'created': time.strftime('%b-%d-%Y_%H%M', time.localtime())}
+    # manifest last, same as the IR3 store
+    with open(manifest_fname, 'w') as file_object:
+        json.dump(manifest, file_object, indent = 2, default = str)
+    add_ir3_params_to_manifest(store_dir, dict(ir3_params, feature_cfg = feature_cfg))
+    features = np.load(features_fname, mmap_mode = 'r')
+    return features, feature_names, "IR3 feature cache miss, saved to " + store_dir + "\n"
+
+"""# Index based sampling
+Class balancing and stratified splits as index arrays into the IR3 instead of
+fancy-indexed copies of X.  The per-class index is built once from y, the
+samplers only shuffle and combine integers so they work the same on
+in-memory and memory-mapped arrays.  Pass the result to
+get_ir3_batches(index = ) or use X[index] for a single copy.
+"""
+
+def get_class_index(y, index = None):
+    """Returns a dict of label: sorted int64 array of the IR3 rows with that
+    label.  y is (windows, 1) int labels or one-hot encoded.  index
+    (int array or boolean mask) limits the rows, e.g. the train subjects.
+    A y with several columns that isn't one-hot (e.g. multi-label PSG) is
+    an error, there is no single class per window to balance on."""
+    y = np.asarray(y)
+    if index is None:
+        index = np.arange(y.shape[0])
+    else:
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.nonzero(index)[0]
+    if y.ndim == 2 and y.shape[1] > 1: # one-hot
+        y = y[index]
+        if not (y.sum(axis = 1) == 1).all():
+            raise ValueError("get_class_index y has " + str(y.shape[1]) +
+                             " columns but is not one-hot (every row must sum to 1),"
+                             " pass one label column of a multi-label y")
+        labels = y.argmax(axis = 1)
+    else:
+        labels = y.reshape(-1)[index]
+    order = np.argsort(labels, kind = 'stable') # keeps the rows sorted within a class
+    classes, starts = np.unique(labels[order], return_index = True)
+    return {c.item(): index[i] for c, i in zip(classes, np.split(order, starts[1:]))}
+if interactive:
+    my_class_index = get_class_index(my_y)
+    print({label: len(idx) for label, idx in my_class_index.items()})
+
+def get_class_weights(class_index):
+    """Returns a dict of label: weight, total / (num_classes * class count)
+    which is the sklearn 'balanced' heuristic and the format Keras fit
+    class_weight expects."""
+    total = sum([len(idx) for idx in class_index.values()])
+    return {label: total / (len(class_index) * len(idx)) for label, idx in class_index.items()}
+
+def get_sample_weights(class_index, num_windows, class_weights = None):
+    """Returns a float32 weight per IR3 window (0 for windows not in
+    class_index), for fit(sample_weight = ) or a weighted loss."""
+    if class_weights is None:
+        class_weights = get_class_weights(class_index)
+    weights = np.zeros(num_windows, dtype = 'float32')
+    for label, idx in class_index.items():
+        weights[idx] = class_weights[label]
+    return weights
+
+def get_balanced_index(class_index, method = 'under', num_per_class = None,
+                       seed = None):
+    """Returns a sorted index array with num_per_class windows of every class.
+    method - 'under' default num_per_class is the smallest class count,
+             'over' the largest.  Classes with more windows are sampled
+             without replacement, classes with fewer keep all of their windows
+             plus repeats drawn with replacement.
+    Repeated windows are repeated indices, the signal data is not copied."""
+    if method not in ('under', 'over'):
+        raise ValueError("get_balanced_index method must be 'under' or 'over', got " + repr(method))
+    rng = np.random.default_rng(seed)
+    counts = [len(idx) for idx in class_index.values()]
+    if num_per_class is None:
+        num_per_class = min(counts) if method == 'under' else max(counts)
+    balanced = []
+    for label, idx in class_index.items():
+        if len(idx) >= num_per_class:
+            balanced.append(rng.choice(idx, num_per_class, replace = False))
+        else:
+            balanced.append(idx)
+            balanced.append(rng.choice(idx, num_per_class - len(idx), replace = True))
+    if verbose:
+        print("get_balanced_index", num_per_class, "windows of", len(class_index), "classes")
+    return np.sort(np.concatenate(balanced))
+if interactive:
+    print("undersampled", get_balanced_index(my_class_index, 'under', seed = 42).shape)
+    print("oversampled", get_balanced_index(my_class_index, 'over', seed = 42).shape)
+
+def get_stratified_split_index(class_index, test_size = 0.1, seed = None):
+    """Index version of train_test_split(..., stratify = y), each class is
+    split test_size / 1 - test_size.  Also gives a stratified subset, e.g.
+    the second index of test_size = 0.2 is a 20% sample with the same class
+    proportions.  The same seed does not select the same windows as
+    train_test_split(random_state = seed) and the indices are sorted rather
+    than shuffled.  Returns sorted train_index, test_index."""
+    rng = np.random.default_rng(seed)
+    train, test = [], []
+    for label, idx in class_index.items():
+        idx = rng.permutation(idx)
+        num_test = int(round(test_size * len(idx)))
+        test.append(idx[:num_test])
+        train.append(idx[num_test:])
+    return np.sort(np.concatenate(train)), np.sort(np.concatenate(test))
+
+"""# Mini-batch iterator
+Feeds an IR3 to a model in shuffled mini-batches without loading all of X,
+works the same for in-memory and memory-mapped (load_ir3_store) arrays.
+Plain numpy so it can be passed to Keras fit (with steps_per_epoch) or
+wrapped for PyTorch.
+"""
+
+def get_ir3_batches(X, y, batch_size = 32, shuffle = True, reshuffle = True,
+                    epochs = 1, prefetch = 4, seed = None, drop_last = False,
+                    normalize = None, index = None, one_hot = None):
+    """Generator of (x_batch, y_batch) mini-batches over index permutations.
+    Args:
+        X, y - IR3 arrays, ndarray or memmap, first dimension = windows
+        batch_size - windows per batch
+        shuffle - shuffle the window order
+        reshuffle - new permutation every epoch, False reuses the first
+        epochs - number of passes over the data, None = repeat forever
+            (Keras fit needs steps_per_epoch = len(X) // batch_size)
+        prefetch - batches prepared ahead by a background thread, 0 = none
+        seed - seed for the permutations so runs can be repeated
+        drop_last - skip the final partial batch of each epoch
+        normalize - None or dict(center, scale) from IR3ChannelStats.get_norm,
+            applied to each x_batch in place, X itself is never copied
+        index - None (all windows) or an int array of the windows in an
+            epoch, e.g. from get_balanced_index, repeats are allowed
+        one_hot - None or a dict of one_hot_encode_labels args, e.g.
+            dict(label_map = label_map), int y is expanded per batch so a
+            one-hot y for the whole IR3 is never built
+    Yields:
+        x_batch, y_batch as in-memory ndarrays"""
+    if index is None:
+        index = np.arange(X.shape[0])
+    index = np.asarray(index)
+    num_windows = index.shape[0]
+    rng = np.random.default_rng(seed)
+    order = index
+    if shuffle:
+        order = index[rng.permutation(num_windows)]
+    def get_batches():
+        nonlocal order
+        epoch = 0
+        while epochs is None or epoch < epochs:
+            if shuffle and reshuffle and epoch > 0:
+                order = index[rng.permutation(num_windows)]
+            for i in range(0, num_windows, batch_size):
+                batch_idx = order[i:i + batch_size]
+                if drop_last and batch_idx.shape[0] < batch_size:
+                    break
+                # sorted reads are much faster on a memmap, the order inside
+                # a batch doesn't matter to the model
+                batch_idx = np.sort(batch_idx)
+                x_batch = np.asarray(X[batch_idx])
+                if normalize is not None:
+                    x_batch = normalize_ir3_batch(x_batch, normalize,
+                                                  out = x_batch if x_batch.dtype == np.float32 else None)
+                y_batch = np.asarray(y[batch_idx])
+                if one_hot is not None:
+                    y_batch = one_hot_encode_labels(y_batch, **one_hot)
+                yield x_batch, y_batch
+            epoch += 1
+    if prefetch == 0:
+        yield from get_batches()
+        return
+    batch_queue = queue.Queue(maxsize = prefetch)
+    stop = threading.Event()
+    def put(item):
+        """queue.put that gives up once the consumer has stopped, returns
+        False in that case"""
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def producer():
+        try:
+            for batch in get_batches():
+                if not put(batch):
+                    return
+            put(None) # end of the batches
+        except Exception as e: # hand the error to the consumer
+            put(e)
+    thread = threading.Thread(target = producer, daemon = True)
+    thread.start()
+    try:
+        while True:
+            batch = batch_queue.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally: # also runs when the consumer stops early
+        stop.set()
+if interactive:
+    for my_x_batch, my_y_batch in get_ir3_batches(my_X, my_y, batch_size = 64, seed = 42):
+        pass
+    print("last batch", my_x_batch.shape, my_y_batch.shape)
@@ -43,9 +43,12 @@ import os # for get_env_info
 import shutil # for unzipping archives
 import time # for timestamp in get_log_fname
 import numpy as np # for get_shapes
-import pandas as pd # currently only used for testing not functions themselves
+import pandas as pd # for the run_channel_subsets results table
 import urllib.request # to get files from web w/o !wget
 import csv # to read csv files
+import subprocess # for the clean interpreter in get_import_report
+from concurrent.futures import ProcessPoolExecutor # for run_channel_subsets
+from multiprocessing import shared_memory
 
 """# Start of the utility functions"""
 
@@ -189,6 +192,146 @@ if (interactive):
     for x in channel_powerset(sth):
         print(list(x)) #print(', '.join(list(x))) # to print w/o brackets
 
+def init_channel_subset_worker(shm_name, X_shape, X_dtype, experiment_fn, fn_args):
+    """ProcessPoolExecutor initializer for run_channel_subsets.  Each worker
+    attaches to the shared X once, experiment_fn and fn_args are also only
+    pickled once per worker instead of once per subset."""
+    global subset_shm, subset_X, subset_experiment_fn, subset_fn_args
+    subset_shm = shared_memory.SharedMemory(name = shm_name)
+    subset_X = np.ndarray(X_shape, dtype = X_dtype, buffer = subset_shm.buf)
+    subset_X.flags.writeable = False # shared by every worker
+    subset_experiment_fn = experiment_fn
+    subset_fn_args = fn_args
+
+def get_channel_subset_result(ch_idx):
+    """Process worker for run_channel_subsets, only the subset channels are
+    copied out of the shared X."""
+    return subset_experiment_fn(subset_X[:, :, ch_idx], *subset_fn_args)
+
+def run_channel_subsets(X, channel_list, experiment_fn, *fn_args, subsets = None,
+                        executor = 'process', num_workers = None):
+    """Runs experiment_fn once for each channel subset and collects the
+    results into one table.  Unlike looping over channel_powerset with
+    xforms.limit_channel_ir3 the full X is placed in shared memory once, each
+    worker only copies the channels of the subset it is running.
+    Args:
+        X = IR3 X array (windows, time_steps, channels)
+        channel_list = channel names of X in order
+        experiment_fn = called as experiment_fn(X_subset, *fn_args), returns
+            a dict of results (e.g. {'accuracy':0.9}) or a single value.  Must
+            be a module level function so it can be pickled, typically fn_args
+            holds y, sub, split info etc.
+        subsets = list of channel name lists, default all channel_powerset
+        executor = 'process' (default) a ProcessPoolExecutor using the shared
+            X or 'serial' to run in this process, easier to debug
+        num_workers = max number of processes, default os.cpu_count()
+    Returns:
+        pandas dataframe with one row per subset in subsets order, columns
+        channels, num_channels and the experiment_fn results"""
+    if subsets is None:
+        subsets = channel_powerset(channel_list)
+    subsets = [list(i) for i in subsets]
+    if executor not in ('serial', 'process'):
+        raise ValueError("run_channel_subsets executor must be 'serial' or 'process', got "
+                         + repr(executor))
+    unknown = [ch for i in subsets for ch in i if ch not in channel_list]
+    if unknown:
+        raise ValueError("run_channel_subsets channels not in channel_list " + str(unknown))
+    ch_idx = [[channel_list.index(ch) for ch in i] for i in subsets]
+    # the run time grows with the number of channels, starting the largest
+    # subsets first keeps the short ones at the end to fill idle workers.
+    order = sorted(range(len(subsets)), key = lambda i: len(subsets[i]), reverse = True)
+    if verbose:
+        print("run_channel_subsets running", len(subsets), "subsets of", channel_list)
+    if executor == 'serial':
+        results = [experiment_fn(X[:, :, ch_idx[i]], *fn_args) for i in order]
+    else:
+        X = np.asarray(X)
+        shm = shared_memory.SharedMemory(create = True, size = max(1, X.nbytes))
+        try:
+            X_shared = np.ndarray(X.shape, dtype = X.dtype, buffer = shm.buf)
+            X_shared[:] = X
+            del X_shared # the buffer can't be closed while an array still points at it
+            with ProcessPoolExecutor(max_workers = num_workers,
+                                     initializer = init_channel_subset_worker,
+                                     initargs = (shm.name, X.shape, X.dtype.str,
+                                                 experiment_fn, fn_args)) as pool:
+                results = list(pool.map(get_channel_subset_result,
+                                        [ch_idx[i] for i in order]))
+        finally:
+            shm.close()
+            shm.unlink()
+    rows = [None] * len(subsets)
+    for i, result in zip(order, results):
+        if not isinstance(result, dict):
+            result = {'result': result}
+        rows[i] = dict(channels = subsets[i], num_channels = len(subsets[i]), **result)
+    return pd.DataFrame(rows)
+if (interactive):
+    def mean_abs(X_subset):
+        return {'mean_abs': float(np.abs(X_subset).mean())}
+    print(run_channel_subsets(np.random.rand(42,10,3).astype('float32'),
+                              ['A','B','C'], mean_abs, executor = 'serial'))
+
+# Imported on first use only, load_data_transforms and the loaders should not
+# pull these in at module level, see check_import_budget.
+heavy_import_modules = ['tensorflow', 'keras', 'torch', 'sklearn', 'scipy',
+                        'matplotlib', 'seaborn', 'tabulate']
+
+def get_import_report(module_name, module_dirs = None):
+    """Imports module_name in a fresh python interpreter so the modules that
+    are already loaded in this session (colab has tensorflow etc. loaded
+    before the first cell runs) don't hide the real cost of the import.
+    Args:
+        module_name = e.g. 'load_data_transforms'
+        module_dirs = list of directories added to sys.path, default the
+            current working directory.  For a loader pass both the loader
+            and repo directories so the local load_data_transforms is used.
+    Returns:
+        dict with seconds (import time) and heavy (heavy_import_modules that
+        were loaded) or None if the import failed"""
+    if module_dirs is None:
+        module_dirs = [os.getcwd()]
+    code = ("import sys, time\n"
+            "sys.path[:0] = " + repr([os.path.abspath(i) for i in module_dirs]) + "\n"
+            "start = time.perf_counter()\n"
+            "import " + module_name + "\n"
+            "print(time.perf_counter() - start)\n"
+            "print(' '.join(sorted(i for i in sys.modules if '.' not in i)))\n")
+    result = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True)
+    if result.returncode != 0:
+        print("ERROR: get_import_report could not import", module_name)
+        print(result.stderr)
+        return
+    lines = result.stdout.strip().splitlines()
+    loaded = set(lines[-1].split())
+    return dict(seconds = float(lines[-2]),
+                heavy = [i for i in heavy_import_modules if i in loaded])
+
+def check_import_budget(module_name, max_seconds = 2.0, module_dirs = None):
+    """Checks that importing module_name stays under max_seconds and loads
+    none of the heavy_import_modules.  The time is machine dependent, the
+    heavy module list is the part that catches a new top level import.
+    Returns True if within budget, prints the problem and returns False if
+    not."""
+    report = get_import_report(module_name, module_dirs = module_dirs)
+    if report is None:
+        return False
+    within_budget = True
+    if report['heavy']:
+        print("ERROR: importing", module_name, "loads", report['heavy'],
+              "- import these on first use instead")
+        within_budget = False
+    if report['seconds'] > max_seconds:
+        print("ERROR: importing", module_name, "took %.2f s," % report['seconds'],
+              "budget is", max_seconds, "s")
+        within_budget = False
+    if verbose:
+        print("import", module_name, "%.2f s" % report['seconds'], report)
+    return within_budget
+if (interactive):
+    print(check_import_budget('load_data_transforms'))
+
 def unzip_into_dir(zip_ffname,target_dir):
     """takes files from zip archive and puts them into the target_dir.  This is
     intended for zip archives that are flat (without embedded dir) so that 
@@ -247,6 +390,9 @@ if __name__ == "__main__":
     print ('\n------ Example of a powerset (all channel combos) ------')
     for x in channel_powerset(['Ch1','Ch2','Ch3']):
         print(list(x))
+    print ('\n------ Import budget of the shared transforms ------')
+    if os.path.exists('load_data_transforms.py'):
+        print(check_import_budget('load_data_transforms'))
 
 """# Example calling code - paste this into another notebook to use public version"""
 